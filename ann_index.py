@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+from cache import CACHE_DIR, cache_key
+from neighbors import nearest_neighbors
+
+
+def assign_to_centroids(vectors, centroids, block_size=4096):
+    """
+    Returns the index of the most similar centroid of every vector.
+
+    Parameters
+    ----------
+    vectors : np.ndarray
+        the vectors, with shape (N, dim)
+    centroids : np.ndarray
+        the centroids, with shape (num_centroids, dim)
+    block_size : int
+        the number of vectors compared with the centroids at once
+
+    Returns
+    -------
+    np.ndarray
+        the index of the nearest centroid of each vector
+    """
+    assignment = np.zeros(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+
+def spherical_kmeans(vectors, num_clusters, num_iters=10, rng=None, block_size=4096):
+    """
+    Clusters unit-normalized vectors by cosine similarity (k-means with the
+    centroids renormalized after every update).
+
+    Parameters
+    ----------
+    vectors : np.ndarray
+        the vectors to cluster, with shape (N, dim)
+    num_clusters : int
+        the number of clusters
+    num_iters : int
+        the number of assignment/update iterations
+    rng : np.random.Generator or int
+        the random number generator (or the seed of one) for the initial centroids
+    block_size : int
+        the number of vectors assigned at once
+
+    Returns
+    -------
+    np.ndarray
+        the unit-normalized centroids, with shape (num_clusters, dim)
+    """
+    rng = np.random.default_rng(rng)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        assignment = assign_to_centroids(vectors, centroids, block_size)
+        order = np.argsort(assignment, kind="stable")
+        sizes = np.bincount(assignment, minlength=num_clusters)
+        nonempty = np.flatnonzero(sizes)
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])[nonempty]
+        centroids[nonempty] = np.add.reduceat(vectors[order], starts, axis=0)
+        # clusters that lost all their vectors restart from random vectors
+        empty = np.flatnonzero(sizes == 0)
+        centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids /= np.where(norms > 0, norms, 1)
+    return centroids
+
+
+class IVFIndex:
+    """
+    An inverted-file (IVF) index for approximate nearest-neighbor search by
+    cosine similarity. The vectors are partitioned into nlist lists by their
+    nearest centroid (from spherical k-means), and a query is only compared
+    with the vectors of the nprobe lists whose centroids are closest to it.
+    Larger values of nprobe trade speed for recall; nprobe = nlist is exact.
+
+    The index stores the centroids and the ids of the vectors in each list
+    (in compressed sparse row form), not the vectors themselves, which are
+    passed to search (e.g. as the memory-mapped SimCSE embeddings).
+    """
+
+    def __init__(self, centroids, offsets, ids):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, vectors, nlist=None, num_iters=10, train_size=200000, seed=0, block_size=4096):
+        """
+        Builds an index over unit-normalized vectors.
+
+        Parameters
+        ----------
+        vectors : np.ndarray
+            the vectors to index, with shape (N, dim)
+        nlist : int
+            the number of lists (defaults to about 4 * sqrt(N))
+        num_iters : int
+            the number of k-means iterations
+        train_size : int
+            the maximum number of (randomly sampled) vectors the centroids are trained on
+        seed : int
+            the seed of the sample and the initial centroids
+        block_size : int
+            the number of vectors assigned to lists at once
+
+        Returns
+        -------
+        IVFIndex
+            the index
+        """
+        if nlist is None:
+            nlist = max(1, int(4 * np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(vectors), min(train_size, len(vectors)), replace=False))
+        centroids = spherical_kmeans(vectors[sample], nlist, num_iters, rng, block_size)
+        assignment = assign_to_centroids(vectors, centroids, block_size)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=offsets[1:])
+        ids = np.argsort(assignment, kind="stable").astype(np.int64)
+        return cls(centroids, offsets, ids)
+
+    def search(self, vectors, queries, k=2, nprobe=8, query_block=65536):
+        """
+        Finds the (approximate) k nearest neighbors of every query among the
+        indexed vectors.
+
+        Parameters
+        ----------
+        vectors : np.ndarray
+            the indexed vectors, with shape (N, dim)
+        queries : np.ndarray
+            the query vectors, with shape (num_queries, dim)
+        k : int
+            the number of neighbors to find for each query
+        nprobe : int
+            the number of lists searched for each query
+        query_block : int
+            the number of queries searched at once
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+            the indices and similarities of the k nearest neighbors of each
+            query, both with shape (num_queries, k), most similar first
+            (missing neighbors have index -1 and similarity -inf)
+        """
+        nprobe = min(nprobe, self.nlist)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for start in range(0, len(queries), query_block):
+            block = np.asarray(queries[start:start + query_block], dtype=np.float32)
+            probes = nearest_neighbors(block, self.centroids, k=nprobe)[0]
+            # groups the (query, list) pairs by list, so each list is compared with all its queries at once
+            pair_lists = probes.ravel()
+            order = np.argsort(pair_lists, kind="stable")
+            pair_lists = pair_lists[order]
+            pair_queries = np.repeat(np.arange(len(block)), nprobe)[order]
+            bounds = np.concatenate([[0], np.flatnonzero(np.diff(pair_lists)) + 1, [len(pair_lists)]])
+            best_indices = indices[start:start + len(block)]
+            best_scores = scores[start:start + len(block)]
+            for pair_start, pair_end in zip(bounds[:-1], bounds[1:]):
+                list_num = pair_lists[pair_start]
+                ids = self.ids[self.offsets[list_num]:self.offsets[list_num + 1]]
+                if len(ids) == 0:
+                    continue
+                rows = pair_queries[pair_start:pair_end]
+                similarities = block[rows] @ np.asarray(vectors[ids], dtype=np.float32).T
+                candidate_scores = np.concatenate([best_scores[rows], similarities], axis=1)
+                candidate_indices = np.concatenate([best_indices[rows], np.broadcast_to(ids, similarities.shape)],
+                                                   axis=1)
+                top = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+                best_scores[rows] = np.take_along_axis(candidate_scores, top, axis=1)
+                best_indices[rows] = np.take_along_axis(candidate_indices, top, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind="stable")
+            best_indices[:] = np.take_along_axis(best_indices, order, axis=1)
+            best_scores[:] = np.take_along_axis(best_scores, order, axis=1)
+        return indices, scores
+
+    def save(self, index_dir):
+        """
+        Saves the index to a directory (atomically, so that concurrent runs
+        never load a partial index).
+
+        Parameters
+        ----------
+        index_dir : String
+            the directory to write the index to
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(index_dir)), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(index_dir)))
+        np.save(os.path.join(tmp_dir, "centroids.npy"), self.centroids)
+        np.save(os.path.join(tmp_dir, "offsets.npy"), self.offsets)
+        np.save(os.path.join(tmp_dir, "ids.npy"), self.ids)
+        with open(os.path.join(tmp_dir, "meta.json"), 'w') as writer:
+            json.dump({"type": "ivf", "nlist": self.nlist, "size": len(self.ids)}, writer)
+        try:
+            os.rename(tmp_dir, index_dir)
+        except OSError:
+            # another process saved an index to the same directory first
+            shutil.rmtree(tmp_dir)
+
+    @classmethod
+    def load(cls, index_dir):
+        """
+        Loads an index saved by save (memory-mapping the list ids).
+
+        Parameters
+        ----------
+        index_dir : String
+            the directory of the index
+
+        Returns
+        -------
+        IVFIndex
+            the index
+        """
+        return cls(np.load(os.path.join(index_dir, "centroids.npy")),
+                   np.load(os.path.join(index_dir, "offsets.npy")),
+                   np.load(os.path.join(index_dir, "ids.npy"), mmap_mode='r'))
+
+
+def cached_ivf_index(vectors, key, nlist=None, cache_dir=CACHE_DIR, seed=0):
+    """
+    Returns an IVFIndex over the vectors, building it only the first time it
+    is requested for the same corpus (identified by key) and settings.
+
+    Parameters
+    ----------
+    vectors : np.ndarray
+        the vectors to index
+    key : String
+        identifies the vectors (e.g. the embedding model and the corpus hash)
+    nlist : int
+        the number of lists (see IVFIndex.build)
+    cache_dir : String
+        the root directory of the cache
+    seed : int
+        the seed used to build the index
+
+    Returns
+    -------
+    IVFIndex
+        the index
+    """
+    index_dir = os.path.join(cache_dir, "ann", cache_key(key, len(vectors), nlist, seed))
+    if not os.path.exists(index_dir):
+        IVFIndex.build(vectors, nlist, seed=seed).save(index_dir)
+    return IVFIndex.load(index_dir)
+
+
+def recall_report(index, vectors, k=2, nprobes=(1, 2, 4, 8, 16, 32), sample_size=1000, seed=0):
+    """
+    Measures the recall and speed of an index for several values of nprobe,
+    against exact search, for a random sample of the indexed vectors as
+    queries.
+
+    Parameters
+    ----------
+    index : IVFIndex
+        the index
+    vectors : np.ndarray
+        the indexed vectors
+    k : int
+        the number of neighbors to find for each query
+    nprobes : Iterable[int]
+        the values of nprobe to measure
+    sample_size : int
+        the number of queries
+    seed : int
+        the seed of the sample
+
+    Returns
+    -------
+    list[dict]
+        for exact search and every value of nprobe, the recall@k (the
+        fraction of the exact k nearest neighbors that were found) and the
+        search time
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))
+    queries = np.asarray(vectors[sample], dtype=np.float32)
+    start = time.perf_counter()
+    exact = nearest_neighbors(queries, vectors, k=k)[0]
+    report = [{"nprobe": None, "recall": 1.0, "seconds": time.perf_counter() - start}]
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        approximate = index.search(vectors, queries, k=k, nprobe=nprobe)[0]
+        seconds = time.perf_counter() - start
+        found = sum(len(set(row_exact) & set(row_approximate))
+                    for row_exact, row_approximate in zip(exact.tolist(), approximate.tolist()))
+        report.append({"nprobe": nprobe, "recall": found / exact.size, "seconds": seconds})
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', "--lines", type=str, required=True, help="the file of sentences to index")
+    parser.add_argument('-m', "--model_name", type=str, default="princeton-nlp/sup-simcse-bert-base-uncased")
+    parser.add_argument("--nlist", type=int)
+    parser.add_argument("--nprobes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--sample_size", type=int, default=1000)
+    args = parser.parse_args()
+    from cache import lines_hash
+    from embedding_cache import cached_embeddings
+    from paralleldata import enumerate_lines
+    from simcse import SimCSE
+    lines = enumerate_lines(args.lines)
+    embeddings = cached_embeddings(SimCSE(args.model_name), args.model_name, lines)
+    index = cached_ivf_index(embeddings, cache_key(args.model_name, lines_hash(lines)), args.nlist)
+    for row in recall_report(index, embeddings, nprobes=args.nprobes, sample_size=args.sample_size):
+        print(json.dumps(row))
@@ -1,6 +1,9 @@
+from itertools import islice
 from random import shuffle
-from ranker import Ranker
-from transformers import AutoTokenizer
+import numpy as np
+from ranker import Ranker, ranked_indices
+from sample_weighted import weighted_permutation
+from tokenization import tokenize_lines
 
 class LengthRanker(Ranker):
     """
@@ -11,23 +14,26 @@ class LengthRanker(Ranker):
     def __init__(self, tokenizer_fn=lambda sent: sent.split()):
         self.tokenizer_fn = tokenizer_fn
 
-    def rank(self, sents):
+    def rank(self, sents, limit=None):
         """
-        Ranks the provided sentences based on length.
+        Ranks the provided sentences based on length (longest first, ties in
+        their original order). Only the consumed part of the ranking is
+        sorted.
 
         Parameters
         ----------
         sents : list[String]
             the sentences to be ranked
+        limit : int
+            if specified, at most this many indices are generated
 
         Returns
         -------
         Generator[int]
             generates the indices of the selected sentences, in order
         """
-        tokenized = [self.tokenizer_fn(sent) for sent in sents]
-        sorted_sents = sorted(list(enumerate(tokenized)), key=lambda x: -len(x[1]))
-        return [i for (i, _) in sorted_sents]
+        lengths = np.fromiter((len(self.tokenizer_fn(sent)) for sent in sents), dtype=np.int64, count=len(sents))
+        return ranked_indices(-lengths, limit)
 
 
 class UniformRandomRanker(Ranker):
@@ -36,7 +42,7 @@ class UniformRandomRanker(Ranker):
     shuffles them randomly, and returns them in that order.
     """
 
-    def rank(self, sents):
+    def rank(self, sents, limit=None):
         """
         Randomly ranks the provided sentences.
 
@@ -44,6 +50,8 @@ class UniformRandomRanker(Ranker):
         ----------
         sents : list[String]
             the sentences to be ranked using SimCSE
+        limit : int
+            if specified, at most this many indices are generated
 
         Returns
         -------
@@ -52,7 +60,7 @@ class UniformRandomRanker(Ranker):
         """
         line_nums = list(range(len(sents)))
         shuffle(line_nums)
-        for line_num in line_nums:
+        for line_num in line_nums[:limit]:
             yield line_num
 
 
@@ -60,80 +68,49 @@ class WeightedRandomRanker(Ranker):
     """
     Defines an object which takes a specified list of sentences,
     selects them at random using a weighted distribution by length,
-    and returns them in that order.
+    and returns them in that order. The (mBART token) lengths can be
+    precomputed and passed in; otherwise they are taken from the cached
+    tokenization of the sentences. Without an explicit rng, each ranking is
+    seeded from NumPy's global random state, so np.random.seed makes it
+    reproducible.
     """
+
+    def __init__(self, lengths=None, rng=None):
+        self.lengths = lengths
+        self.rng = rng
+
+    def token_lengths(self, sents):
+        """
+        Returns the number of mBART tokens in each of the provided sentences.
+        """
+        if self.lengths is not None:
+            return np.asarray(self.lengths)
+        return tokenize_lines(sents, store="pieces").lengths()
+
     def get_weights(self, sents):
-        model_checkpoint = "facebook/mbart-large-50-many-to-many-mmt"
-        tokenizer = AutoTokenizer.from_pretrained(model_checkpoint)
-        tokenized_sents = []
-        for sent in sents:
-            tokenized_sents.append(tokenizer.tokenize(sent.strip()))
-
-        total_tokens = 0
-        for line in tokenized_sents:
-            total_tokens += len(line)
+        lengths = self.token_lengths(sents).tolist()
+        total_tokens = sum(lengths)
         weights = []
-        for line in tokenized_sents:
-            weights.append(len(line) / total_tokens)
+        for length in lengths:
+            weights.append(length / total_tokens)
         return weights
 
-    def rank(self, sents):
+    def rank(self, sents, limit=None):
         """
-        Ranks the sentences in a weighted random order
+        Ranks the sentences in a weighted random order. The order is
+        generated lazily, so only the consumed part of it is computed.
 
         Parameters
         ----------
         sents : list[String]
             the sentences to be ranked
+        limit : int
+            if specified, at most this many indices are generated
 
         Returns
         -------
         Generator[int]
             generates the indices of the selected sentences, in weighted random order
         """
-        model_checkpoint = "facebook/mbart-large-50-many-to-many-mmt"
-        tokenizer = AutoTokenizer.from_pretrained(model_checkpoint)
-        tokenized_sents = []
-        for sent in sents:
-            tokenized_sents.append(tokenizer.tokenize(sent.strip()))
-
-        total_tokens = 0
-        for line in tokenized_sents:
-            total_tokens += len(line)
-        weights = []
-        for line in tokenized_sents:
-            weights.append(len(line) / total_tokens)
-        budget = int(budget_pct * len(tokenized_sents))
-        num_selected = 0
-        remaining = budget - num_selected
-        selected = []
-        for i in range(len(tokenized_sents)):
-            selected.append(0)
-        while remaining > 0:
-            num_selected = 0
-            new_selected = multinomial(remaining, weights).tolist()
-            # integrate values selected in this round into cumulative selected values
-            for i in range(len(tokenized_sents)):
-                selected[i] += new_selected[i]
-                num_selected += selected[i]
-            # set weights for selected sentences to zero and correct for sentences that were selected more than once
-            for i in range(len(tokenized_sents)):
-                if selected[i] > 0:
-                    weights[i] = 0
-                if selected[i] > 1:
-                    old_freq = selected[i]
-                    selected[i] = 1
-                    num_selected -= old_freq - selected[i]
-            # fix weights so they still add up to 1
-            new_total_weight = 0
-            for w in weights:
-                new_total_weight += w
-            weight_adjustor = 1 / new_total_weight
-            for i in range(len(weights)):
-                weights[i] *= weight_adjustor
-            remaining = budget - num_selected
-        # get lines from selected
-        selected_lines = []
-        for i in range(len(selected)):
-            if selected[i] == 1:
-                yield i
\ No newline at end of file
+        rng = self.rng if self.rng is not None else np.random.randint(1 << 31)
+        return islice(weighted_permutation(self.token_lengths(sents), rng), limit)
@@ -0,0 +1,115 @@
+import numpy as np
+import pyarrow.compute as pc
+
+
+def example_lengths(dataset, columns=("input_ids", "labels")):
+    """
+    Returns the number of tokens in each of the specified (list) columns of
+    every example of a tokenized dataset.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        the tokenized dataset
+    columns : tuple[String]
+        the columns to measure
+
+    Returns
+    -------
+    np.ndarray
+        the lengths, with shape (len(dataset), len(columns))
+    """
+    table = dataset.with_format("arrow")[:]
+    return np.stack([pc.list_value_length(table.column(column)).to_numpy(zero_copy_only=False)
+                     for column in columns], axis=1)
+
+
+def padding_fraction(lengths, batches):
+    """
+    Calculates the fraction of the padded batches that consists of padding.
+    Every column of lengths (e.g. inputs and labels) is padded separately to
+    the longest example of the batch.
+
+    Parameters
+    ----------
+    lengths : np.ndarray
+        the length of every example, with shape (N,) or (N, num_columns)
+    batches : list[list[int]]
+        the indices of the examples in each batch
+
+    Returns
+    -------
+    float
+        the fraction of padding tokens
+    """
+    lengths = np.asarray(lengths).reshape(len(lengths), -1)
+    padded = 0
+    for batch in batches:
+        padded += len(batch) * int(lengths[batch].max(axis=0).sum())
+    if padded == 0:
+        return 0.0
+    return 1 - int(lengths.sum()) / padded
+
+
+class TokenBudgetBatchSampler:
+    """
+    Groups examples of similar length into batches whose padded size
+    (number of examples x longest example) stays within a token budget,
+    rather than using a fixed number of examples per batch.
+
+    When shuffling, the examples are randomly permuted, split into pools of
+    pool_size examples, and sorted by length within each pool before being
+    batched; the order of the batches is then shuffled as well. Without
+    shuffling (e.g. for evaluation), all examples are sorted by length.
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=True, seed=0, pool_size=10000):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.pool_size = pool_size
+        self.epoch = 0
+        self.batches = self.make_batches()
+
+    def make_batches(self):
+        """
+        Builds the batches of the current epoch.
+
+        Returns
+        -------
+        list[list[int]]
+            the indices of the examples in each batch
+        """
+        rng = np.random.default_rng([self.seed, self.epoch])
+        if self.shuffle:
+            order = rng.permutation(len(self.lengths))
+            pools = [order[start:start + self.pool_size] for start in range(0, len(order), self.pool_size)]
+        else:
+            pools = [np.arange(len(self.lengths))]
+        batches = []
+        for pool in pools:
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            batch = []
+            longest = 0
+            for i, length in zip(pool.tolist(), self.lengths[pool].tolist()):
+                if len(batch) > 0 and (len(batch) + 1) * max(longest, length) > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                    longest = 0
+                batch.append(i)
+                longest = max(longest, length)
+            if len(batch) > 0:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches
+        self.epoch += 1
+        self.batches = self.make_batches()
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches)
@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+import numpy as np
+
+from tokenmatrix import TokenMatrix
+
+# The corpus sizes (in sentences) that are benchmarked by default.
+SIZES = [10000, 100000, 1000000]
+
+# The largest corpus that each of the slower benchmarks is run on, unless --no_limits is given.
+MAX_SIZES = {
+    "delfy-python": 100000,
+    "simcse-ranker": 100000,
+    "coco_data": 1000000,
+}
+
+
+class SyntheticCorpus:
+    """
+    A synthetic English-like corpus. Sentence lengths follow a log-normal
+    distribution and token frequencies a Zipfian one, roughly matching the
+    English training split of the coco4mt data. The corpus is available both
+    as a TokenMatrix and (built on first use) as whitespace-separated text,
+    in which token i is the word "w{i}".
+    """
+
+    def __init__(self, num_sentences, vocab_size=50000, median_length=14, sigma=0.5,
+                 zipf_exponent=1.1, seed=0, chunk_size=1 << 24):
+        rng = np.random.default_rng(seed)
+        lengths = np.clip(np.round(rng.lognormal(np.log(median_length), sigma, num_sentences)), 1, 200)
+        offsets = np.zeros(num_sentences + 1, dtype=np.int64)
+        np.cumsum(lengths.astype(np.int64), out=offsets[1:])
+        cdf = np.cumsum(np.arange(1, vocab_size + 1, dtype=np.float64) ** -zipf_exponent)
+        cdf /= cdf[-1]
+        ids = np.empty(offsets[-1], dtype=np.int32)
+        for start in range(0, len(ids), chunk_size):
+            end = min(start + chunk_size, len(ids))
+            ids[start:end] = np.minimum(np.searchsorted(cdf, rng.random(end - start)), vocab_size - 1)
+        self.tokens = TokenMatrix(ids, offsets, vocab_size)
+        self._lines = None
+
+    def __len__(self):
+        return len(self.tokens)
+
+    @property
+    def lines(self):
+        """
+        The sentences of the corpus, as whitespace-separated text.
+        """
+        if self._lines is None:
+            words = [f"w{i}" for i in range(self.tokens.vocab_size)]
+            ids = self.tokens.ids.tolist()
+            offsets = self.tokens.offsets.tolist()
+            self._lines = [" ".join([words[tok] for tok in ids[offsets[i]:offsets[i + 1]]])
+                           for i in range(len(self))]
+        return self._lines
+
+
+class StubEncoder:
+    """
+    A small local stand-in for a SimCSE model, with the same encode method:
+    every word is mapped (by its CRC32 hash) to a fixed random vector, and a
+    sentence is embedded as the sum of the vectors of its words.
+    """
+
+    def __init__(self, dim=64, table_size=1 << 16, seed=0):
+        self.table = np.random.default_rng(seed).normal(size=(table_size, dim)).astype(np.float32)
+
+    def encode(self, sentences, batch_size=64, normalize_to_unit=True, return_numpy=True):
+        embeddings = np.zeros((len(sentences), self.table.shape[1]), dtype=np.float32)
+        for i, sent in enumerate(sentences):
+            rows = [zlib.crc32(word.encode('utf-8')) % len(self.table) for word in sent.split()]
+            if len(rows) > 0:
+                embeddings[i] = self.table[rows].sum(axis=0)
+        if normalize_to_unit:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings /= np.where(norms > 0, norms, 1)
+        return embeddings
+
+
+def write_coco_files(corpus, data_dir, seed=0):
+    """
+    Writes a synthetic copy of the Coco4MT data, in the layout expected by
+    paralleldata.build_coco_store: every split of every language holds the
+    sentences of the corpus, with about 2% of the lines of each language
+    left empty.
+
+    Parameters
+    ----------
+    corpus : SyntheticCorpus
+        the corpus to write
+    data_dir : String
+        the directory to create coco4mt-shared-task in
+    seed : int
+        the seed of the empty lines
+    """
+    from paralleldata import coco_datasets, coco_splits
+    rng = np.random.default_rng(seed)
+    for lang, dataset in coco_datasets.items():
+        lang_dir = f"{data_dir}/coco4mt-shared-task/{dataset}/{lang}"
+        os.makedirs(lang_dir, exist_ok=True)
+        empty = rng.random(len(corpus)) < 0.02
+        for filename in coco_splits.values():
+            with open(f"{lang_dir}/{filename}.txt", 'w') as writer:
+                for line, is_empty in zip(corpus.lines, empty.tolist()):
+                    writer.write("\n" if is_empty else f"{lang} {line}\n")
+
+
+def bench_delfy(backend):
+    def setup(corpus):
+        from delfy import run_delfy
+        return lambda: run_delfy(corpus.tokens, 0.1, "token", 5, backend=backend)
+    return setup
+
+
+def bench_weighted_sample(corpus):
+    from sample_weighted import weighted_sample
+    return lambda: weighted_sample(corpus.tokens, 0.1, rng=0)
+
+
+def bench_ranker(name):
+    def setup(corpus):
+        from baselines import LengthRanker, UniformRandomRanker, WeightedRandomRanker
+        lines = corpus.lines
+        if name == "length":
+            ranker = LengthRanker()
+        elif name == "uniform":
+            ranker = UniformRandomRanker()
+        else:
+            ranker = WeightedRandomRanker(lengths=corpus.tokens.lengths(), rng=0)
+        return lambda: list(ranker.rank(lines))
+    return setup
+
+
+def bench_simcse_ranker(corpus):
+    from simcse_rankers import SimCSERanker
+    lines = corpus.lines
+    encoder = StubEncoder()
+
+    def run():
+        # includes encoding the corpus with the stub (the embedding cache is disabled)
+        ranker = SimCSERanker(lines, "random", cache_dir=None, model=encoder)
+        return list(ranker.rank(lines))
+    return run
+
+
+def bench_fill(budget_unit):
+    def setup(corpus):
+        from baselines import LengthRanker
+        from fill_budget import candidate_lengths, fill_budget
+        lines = corpus.lines
+        lengths = candidate_lengths(lines) if budget_unit == "token" else None
+        return lambda: fill_budget(LengthRanker(), lines, 0.2, budget_unit, lengths=lengths)
+    return setup
+
+
+def bench_coco_data(corpus):
+    import paralleldata
+    data_dir = tempfile.mkdtemp()
+    write_coco_files(corpus, data_dir)
+    store_dir = os.path.join(data_dir, "store")
+    paralleldata.build_coco_store(data_dir, store_dir)
+    lines = np.random.default_rng(0).choice(len(corpus), len(corpus) // 5, replace=False).tolist()
+
+    def run():
+        saved = paralleldata.COCO_STORE_DIR
+        paralleldata.COCO_STORE_DIR = store_dir
+        try:
+            return paralleldata.coco_data("en", "de", lines=lines)
+        finally:
+            paralleldata.COCO_STORE_DIR = saved
+
+    run.cleanup = lambda: shutil.rmtree(data_dir)
+    return run
+
+
+# Maps the name of each benchmark to a function that prepares it on a corpus
+# (untimed) and returns the function to time.
+BENCHMARKS = {
+    "delfy-numpy": bench_delfy("numpy"),
+    "delfy-python": bench_delfy("python"),
+    "weighted_sample": bench_weighted_sample,
+    "length-ranker": bench_ranker("length"),
+    "uniform-ranker": bench_ranker("uniform"),
+    "weighted-ranker": bench_ranker("weighted"),
+    "simcse-ranker": bench_simcse_ranker,
+    "fill_sentence_budget": bench_fill("sentence"),
+    "fill_token_budget": bench_fill("token"),
+    "coco_data": bench_coco_data,
+}
+
+
+def measure(run, repeat=3, memory=True):
+    """
+    Times a function, and optionally measures the peak memory it allocates.
+
+    Parameters
+    ----------
+    run : function
+        the function to measure (called without arguments)
+    repeat : int
+        the number of timed calls
+    memory : bool
+        whether to make an extra (untimed) call under tracemalloc to measure
+        the peak memory allocated by Python and NumPy
+
+    Returns
+    -------
+    dict
+        the best and all timings (in seconds) and the peak memory (in MiB)
+    """
+    timings = []
+    for _ in range(repeat):
+        random.seed(0)
+        np.random.seed(0)
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    result = {"seconds": min(timings), "all_seconds": timings}
+    if memory:
+        random.seed(0)
+        np.random.seed(0)
+        tracemalloc.start()
+        try:
+            run()
+            result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / (1 << 20)
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(names, sizes, repeat=3, memory=True, limits=True, seed=0):
+    """
+    Runs the specified benchmarks on synthetic corpora of the specified sizes.
+
+    Parameters
+    ----------
+    names : list[String]
+        the benchmarks to run (keys of BENCHMARKS)
+    sizes : list[int]
+        the numbers of sentences of the corpora
+    repeat : int
+        the number of timed runs of each benchmark
+    memory : bool
+        whether to measure the peak memory of each benchmark
+    limits : bool
+        whether to skip benchmarks on corpora larger than their MAX_SIZES
+    seed : int
+        the seed of the synthetic corpora
+
+    Returns
+    -------
+    list[dict]
+        one record per benchmark and size
+    """
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError(f"Unrecognized benchmark: {name}")
+    results = []
+    for size in sizes:
+        corpus = SyntheticCorpus(size, seed=seed)
+        for name in names:
+            record = {"benchmark": name, "num_sentences": size, "num_tokens": int(len(corpus.tokens.ids))}
+            if limits and size > MAX_SIZES.get(name, size):
+                record["skipped"] = f"larger than {MAX_SIZES[name]} sentences"
+            else:
+                run = BENCHMARKS[name](corpus)
+                try:
+                    record.update(measure(run, repeat, memory))
+                finally:
+                    if hasattr(run, "cleanup"):
+                        run.cleanup()
+            print(json.dumps(record), file=sys.stderr)
+            results.append(record)
+    return results
+
+
+def environment():
+    """
+    Describes the machine and library versions that the benchmarks ran on.
+    """
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', "--benchmarks", type=str, nargs="+", default=list(BENCHMARKS))
+    parser.add_argument('-s', "--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument('-r', "--repeat", type=int, default=3)
+    parser.add_argument('-o', "--output", type=str, default="benchmarks.json")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no_memory", action="store_true")
+    parser.add_argument("--no_limits", action="store_true")
+    args = parser.parse_args()
+    results = run_benchmarks(args.benchmarks, args.sizes, args.repeat, not args.no_memory,
+                             not args.no_limits, args.seed)
+    with open(args.output, 'w') as writer:
+        json.dump({"environment": environment(), "results": results}, writer, indent=2)
@@ -0,0 +1,79 @@
+import hashlib
+import os
+
+# Root directory for all on-disk caches (token stores, embeddings, ...).
+CACHE_DIR = os.environ.get("COCO4MT_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".cache", "coco4mt"))
+
+
+def file_hash(filename):
+    """
+    Returns the SHA-256 hash of the contents of the specified file.
+
+    Parameters
+    ----------
+    filename : String
+        the file to hash
+
+    Returns
+    -------
+    String
+        the hexadecimal digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as reader:
+        for chunk in iter(lambda: reader.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def lines_hash(lines):
+    """
+    Returns the SHA-256 hash of a sequence of lines.
+
+    Parameters
+    ----------
+    lines : Iterable[String]
+        the lines to hash
+
+    Returns
+    -------
+    String
+        the hexadecimal digest of the lines
+    """
+    digest = hashlib.sha256()
+    for line in lines:
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def cache_key(*parts):
+    """
+    Combines the provided parts (e.g. a content hash and the settings that
+    were used to process the content) into a single key that can be used as
+    a file name.
+
+    Returns
+    -------
+    String
+        the hexadecimal digest of the combined parts
+    """
+    return hashlib.sha256(":".join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def array_hash(array):
+    """
+    Returns the SHA-256 hash of the contents of a NumPy array.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        the array to hash
+
+    Returns
+    -------
+    String
+        the hexadecimal digest of the array
+    """
+    return hashlib.sha256(array.tobytes()).hexdigest()
@@ -1,9 +1,13 @@
 
 
+from corpusreader import CorpusReader
+
+
 def load_coco_english(coco_eng_path, split):
     """
-    Returns the specified split of the coco4mt English data as a list, with
-    each sentence as an element.
+    Returns the specified split of the coco4mt English data as a read-only
+    sequence of sentences, backed by the memory-mapped file (see
+    corpusreader.CorpusReader) rather than a list.
 
     Parameters
     ----------
@@ -14,12 +18,7 @@ def load_coco_english(coco_eng_path, split):
 
     Returns
     -------
-    list[String]
+    CorpusReader
         the sentences from the coco4mt English data
     """
-    sents = list()
-    with open(f"{coco_eng_path}/{split}.txt") as reader:
-        for line in reader:
-            line = line.strip()
-            sents.append(line)
-    return sents
\ No newline at end of file
+    return CorpusReader(f"{coco_eng_path}/{split}.txt")
@@ -0,0 +1,171 @@
+import mmap
+import os
+import tempfile
+from collections.abc import Sequence
+import numpy as np
+
+from cache import CACHE_DIR, cache_key
+
+
+def line_offsets(filename, chunk_size=1 << 24):
+    """
+    Finds the byte offset of the start of every line of a file, by scanning
+    it for line ends in chunks. As in text-mode open(), a line ends with
+    "\\n", "\\r\\n" or a lone "\\r".
+
+    Parameters
+    ----------
+    filename : String
+        the file to index
+    chunk_size : int
+        the number of bytes scanned at once
+
+    Returns
+    -------
+    np.ndarray
+        an int64 array with the start of each line, followed by the size of
+        the file (so line i spans offsets[i] to offsets[i + 1])
+    """
+    starts = [np.zeros(1, dtype=np.int64)]
+    size = 0
+    # whether the previous chunk ended with a "\r", which ends a line unless the next one starts with "\n"
+    pending_cr = False
+    with open(filename, 'rb') as reader:
+        for chunk in iter(lambda: reader.read(chunk_size), b''):
+            data = np.frombuffer(chunk, dtype=np.uint8)
+            if pending_cr and data[0] != ord('\n'):
+                starts.append(np.array([size], dtype=np.int64))
+            is_lf = data == ord('\n')
+            # a "\r" directly followed by "\n" is ended by the "\n"
+            is_cr = data == ord('\r')
+            is_cr[:-1] &= ~is_lf[1:]
+            pending_cr = bool(is_cr[-1])
+            is_cr[-1] = False
+            ends = np.flatnonzero(is_lf | is_cr)
+            starts.append(ends.astype(np.int64) + (size + 1))
+            size += len(chunk)
+    if pending_cr:
+        starts.append(np.array([size], dtype=np.int64))
+    offsets = np.concatenate(starts)
+    if offsets[-1] != size:
+        # the last line has no line end
+        offsets = np.append(offsets, size)
+    return offsets
+
+
+def cached_line_offsets(filename, cache_dir=CACHE_DIR):
+    """
+    Returns the line offsets of a file (see line_offsets), memory-mapped from
+    the cache. The offsets are keyed by the path, size and modification time
+    of the file, so they are only rebuilt when the file changes.
+
+    Parameters
+    ----------
+    filename : String
+        the file to index
+    cache_dir : String
+        the root directory of the cache (if None, the offsets are not cached)
+
+    Returns
+    -------
+    np.ndarray
+        the line offsets
+    """
+    if cache_dir is None:
+        return line_offsets(filename)
+    stat = os.stat(filename)
+    offsets_dir = os.path.join(cache_dir, "line_offsets")
+    key = cache_key(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, "universal-newlines")
+    path = os.path.join(offsets_dir, f"{key}.npy")
+    if not os.path.exists(path):
+        os.makedirs(offsets_dir, exist_ok=True)
+        # write to a temporary file first, so that concurrent runs never map a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=offsets_dir, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as writer:
+            np.save(writer, line_offsets(filename))
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+
+class CorpusReader(Sequence):
+    """
+    A read-only sequence of the (stripped) lines of a text file, which can be
+    used in place of the list of lines returned by e.g. enumerate_lines
+    without reading the whole file into memory. The file is memory-mapped,
+    and a cached index of the byte offsets of its lines gives constant-time
+    access to any line; iteration streams through the file.
+
+    Indexing with an int returns a line; indexing with a slice or an array
+    (or list) of indices returns a list of lines. The file is decoded as
+    UTF-8 and split into lines as text-mode open() does (on "\\n", "\\r\\n"
+    and "\\r"), so line numbers agree with tools that read the file with open().
+    """
+
+    def __init__(self, filename, cache_dir=CACHE_DIR):
+        self.filename = filename
+        self.offsets = cached_line_offsets(filename, cache_dir)
+        self._open()
+
+    def _open(self):
+        if self.offsets[-1] == 0:
+            self.buffer = b''  # empty files cannot be memory-mapped
+        else:
+            with open(self.filename, 'rb') as reader:
+                self.buffer = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getstate__(self):
+        # the memory map is reopened (not copied) by unpickled readers
+        state = self.__dict__.copy()
+        del state["buffer"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.take(np.arange(len(self))[key])
+        if isinstance(key, (int, np.integer)):
+            i = int(key)
+            if i < 0:
+                i += len(self)
+            if not 0 <= i < len(self):
+                raise IndexError(f"Line {key} is out of range for a corpus of {len(self)} lines")
+            return self.buffer[self.offsets[i]:self.offsets[i + 1]].decode('utf-8').strip()
+        return self.take(key)
+
+    def take(self, indices):
+        """
+        Returns the lines with the specified indices.
+
+        Parameters
+        ----------
+        indices : Iterable[int]
+            the indices of the lines (negative indices count from the end)
+
+        Returns
+        -------
+        list[String]
+            the lines, in the order of the indices
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        if len(indices) > 0 and (indices.min() < -len(self) or indices.max() >= len(self)):
+            raise IndexError(f"Line indices are out of range for a corpus of {len(self)} lines")
+        indices = np.where(indices < 0, indices + len(self), indices)
+        starts = self.offsets[indices].tolist()
+        ends = self.offsets[indices + 1].tolist()
+        return [self.buffer[start:end].decode('utf-8').strip() for start, end in zip(starts, ends)]
+
+    def __iter__(self):
+        # converts the offsets to Python ints a chunk at a time
+        for chunk_start in range(0, len(self), 65536):
+            offsets = self.offsets[chunk_start:chunk_start + 65537].tolist()
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                yield self.buffer[start:end].decode('utf-8').strip()
+
+    def __repr__(self):
+        return f"CorpusReader({self.filename!r}, {len(self)} lines)"
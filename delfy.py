@@ -1,18 +1,153 @@
+import json
+import os
+import tempfile
+import time
 import numpy as np
 import sys
 import argparse
 
-from transformers import AutoTokenizer
+import profiling
 from paralleldata import lines_to_exclude
+from cache import array_hash, cache_key, lines_hash
+from tokenization import tokenize_file
+from tokenmatrix import TokenMatrix
+
+class DelfyState:
+    """
+    Keeps the token statistics of the delfy algorithm (the token counts of
+    the selected and unselected sentences) across rounds. The counts are
+    computed once for the whole corpus and then updated incrementally as
+    sentences move from the unselected set to the selected set, so the cost of
+    a round's bookkeeping scales with the number of sentences selected in that
+    round rather than with the size of the corpus.
+    """
+
+    def __init__(self, sentences, selected=()):
+        self.sentences = sentences
+        self.selected = set()
+        self.selected_tok_count = 0
+        self.unselected_tok_counts = dict()
+        self.selected_tok_counts = dict()
+        for sentence in sentences:
+            for tok in sentence:
+                token = str(tok)
+                self.unselected_tok_counts[token] = self.unselected_tok_counts.get(token, 0) + 1
+        self.select(selected)
+
+    def select(self, sent_indices):
+        """
+        Moves the provided sentences from the unselected set to the selected
+        set, updating the token counts of both.
+
+        Parameters
+        ----------
+        sent_indices : Iterable[int]
+            the indices of the newly selected sentences
+        """
+        for sent_index in sent_indices:
+            if sent_index in self.selected:
+                continue
+            self.selected.add(sent_index)
+            self.selected_tok_count += len(self.sentences[sent_index])
+            for tok in self.sentences[sent_index]:
+                token = str(tok)
+                self.selected_tok_counts[token] = self.selected_tok_counts.get(token, 0) + 1
+                remaining = self.unselected_tok_counts[token] - 1
+                if remaining == 0:
+                    del self.unselected_tok_counts[token]
+                else:
+                    self.unselected_tok_counts[token] = remaining
+
+    def swugwu(self, sent_indices):
+        """
+        Calculates the sum of G(w|U) over every word w in the unselected
+        corpus, which normalizes the logarithm frequencies. The terms are
+        added in the order in which the words first occur in the provided
+        sentences, as in the original implementation: a different rounding
+        of the sum can reorder sentences with tied scores.
+
+        Parameters
+        ----------
+        sent_indices : Iterable[int]
+            the unselected sentences, in the order in which they are scored
+
+        Returns
+        -------
+        float
+            the sum of G(w|U) over the unselected vocabulary
+        """
+        total = 0
+        seen = set()
+        for sent_index in sent_indices:
+            if len(seen) == len(self.unselected_tok_counts):
+                break
+            for tok in self.sentences[sent_index]:
+                token = str(tok)
+                if token not in seen:
+                    seen.add(token)
+                    total += np.log(self.unselected_tok_counts[token] + 1)
+        return total
+
+    def arrays(self):
+        """
+        Returns the selected set and the token statistics as arrays (with the
+        token counts split into tokens and counts), for saving in a checkpoint.
+
+        Returns
+        -------
+        dict[String, np.ndarray]
+            the arrays describing the state
+        """
+        return {
+            "selected": np.array(sorted(self.selected), dtype=np.int64),
+            "selected_tok_count": np.array(self.selected_tok_count, dtype=np.int64),
+            "selected_tokens": np.array(list(self.selected_tok_counts), dtype=str),
+            "selected_counts": np.fromiter(self.selected_tok_counts.values(), dtype=np.int64,
+                                           count=len(self.selected_tok_counts)),
+            "unselected_tokens": np.array(list(self.unselected_tok_counts), dtype=str),
+            "unselected_counts": np.fromiter(self.unselected_tok_counts.values(), dtype=np.int64,
+                                             count=len(self.unselected_tok_counts)),
+        }
+
+    @classmethod
+    def from_arrays(cls, sentences, arrays):
+        """
+        Restores a state saved by arrays, without recounting the tokens of the
+        corpus.
+
+        Parameters
+        ----------
+        sentences : list[list[String]]
+            the sentences the state was computed for
+        arrays : dict[String, np.ndarray]
+            the arrays describing the state
+
+        Returns
+        -------
+        DelfyState
+            the restored state
+        """
+        state = cls.__new__(cls)
+        state.sentences = sentences
+        state.selected = set(arrays["selected"].tolist())
+        state.selected_tok_count = int(arrays["selected_tok_count"])
+        state.selected_tok_counts = dict(zip(arrays["selected_tokens"].tolist(), arrays["selected_counts"].tolist()))
+        state.unselected_tok_counts = dict(zip(arrays["unselected_tokens"].tolist(),
+                                               arrays["unselected_counts"].tolist()))
+        return state
+
 
 class DecayLogFrequency:
 
-    def __init__(self, sentences, selected, budget, budget_unit):
+    def __init__(self, sentences, selected, budget, budget_unit, state=None):
         self.sentences = sentences
         self.unselected = set([i for i in range(len(sentences)) if i not in selected])
         self.selected = selected
-        self.unselected_tok_counts = self.token_count(self.unselected)
-        self.selected_tok_counts = self.token_count(self.selected)
+        if state is None:
+            state = DelfyState(sentences, selected)
+        # the token counts are shared with (and kept up to date by) the state
+        self.unselected_tok_counts = state.unselected_tok_counts
+        self.selected_tok_counts = state.selected_tok_counts
         self.uhat = []
         self.uhat_tok_counts = dict()
         self.l1 = 1.0
@@ -20,9 +155,7 @@ class DecayLogFrequency:
         self.budget = budget
         self.budget_unit = budget_unit
         # precompute swugwu (for efficiency)
-        self.swugwu = 0
-        for w in self.unselected_tok_counts:
-            self.swugwu += self.gwu(w)
+        self.swugwu = state.swugwu(self.unselected)
 
     def run(self):
         """
@@ -37,16 +170,19 @@ class DecayLogFrequency:
         """
         # lines 2-5 of algorithm
         # compute lf(s) for every untranslated sentence s and sort
-        lf_slist = list(self.unselected)
-        lf_slist.sort(key=lambda sent_index: self.lf(sent_index), reverse=True)
+        with profiling.phase("delfy.lf"):
+            lf_slist = list(self.unselected)
+            lf_slist.sort(key=lambda sent_index: self.lf(sent_index), reverse=True)
+        profiling.count("delfy.sentences_scored", len(lf_slist))
         # line 5 cont.
-        delfy_scores = {}
-        for sent_index in lf_slist:
-            delfy_scores[sent_index] = self.delfy(sent_index)
-            self.uhat.append(sent_index)
-            deltas = self.token_count([sent_index])
-            for tok in deltas:
-                self.uhat_tok_counts[tok] = 1 + self.uhat_tok_counts.get(tok, 0)
+        with profiling.phase("delfy.scoring"):
+            delfy_scores = {}
+            for sent_index in lf_slist:
+                delfy_scores[sent_index] = self.delfy(sent_index)
+                self.uhat.append(sent_index)
+                deltas = self.token_count([sent_index])
+                for tok in deltas:
+                    self.uhat_tok_counts[tok] = 1 + self.uhat_tok_counts.get(tok, 0)
         # line 9 of algorithm
         lf_slist.sort(key=lambda i: delfy_scores[i], reverse=True)
         # line 9 cont. (take the top budget% of sentences by delfy)
@@ -195,9 +331,259 @@ class DecayLogFrequency:
         return result
 
 
+class VectorizedDelfyState:
+    """
+    The NumPy counterpart of DelfyState: keeps the token counts of the
+    selected and unselected sentences of a TokenMatrix as arrays indexed by
+    token id, and updates them incrementally across rounds.
+    """
+
+    def __init__(self, matrix, selected=()):
+        self.matrix = matrix
+        self.lengths = matrix.lengths()
+        self.selected = set()
+        self.selected_mask = np.zeros(len(matrix), dtype=bool)
+        self.selected_tok_count = 0
+        self.unselected_tok_counts = np.bincount(matrix.ids, minlength=matrix.vocab_size).astype(np.int64)
+        self.selected_tok_counts = np.zeros(matrix.vocab_size, dtype=np.int64)
+        self.select(selected)
+
+    def select(self, sent_indices):
+        """
+        Moves the provided sentences from the unselected set to the selected
+        set, updating the token counts of both.
+
+        Parameters
+        ----------
+        sent_indices : Iterable[int]
+            the indices of the newly selected sentences
+        """
+        rows = np.fromiter(sent_indices, dtype=np.int64)
+        rows = np.unique(rows[~self.selected_mask[rows]])
+        if len(rows) == 0:
+            return
+        self.selected.update(rows.tolist())
+        self.selected_mask[rows] = True
+        self.selected_tok_count += int(self.lengths[rows].sum())
+        toks, _ = self.matrix.gather(rows)
+        deltas = np.bincount(toks, minlength=self.matrix.vocab_size)
+        self.selected_tok_counts += deltas
+        self.unselected_tok_counts -= deltas
+
+    def swugwu(self, sent_indices, batch_size=65536):
+        """
+        Calculates the sum of G(w|U) over every word w in the unselected
+        corpus, with the terms added in the same order as DelfyState.swugwu.
+
+        Parameters
+        ----------
+        sent_indices : np.ndarray
+            the unselected sentences, in the order in which they are scored
+        batch_size : int
+            the number of sentences whose tokens are gathered at once
+
+        Returns
+        -------
+        float
+            the sum of G(w|U) over the unselected vocabulary
+        """
+        seen = np.zeros(self.matrix.vocab_size, dtype=bool)
+        word_order = [np.zeros(0, dtype=np.int64)]
+        num_words = np.count_nonzero(self.unselected_tok_counts)
+        num_seen = 0
+        for start in range(0, len(sent_indices), batch_size):
+            if num_seen == num_words:
+                break
+            toks, _ = self.matrix.gather(sent_indices[start:start + batch_size])
+            toks = toks[~seen[toks]]  # (after the first batches, most words have been seen)
+            words, first = np.unique(toks, return_index=True)
+            word_order.append(words[np.argsort(first)])
+            seen[words] = True
+            num_seen += len(words)
+        terms = np.log(self.unselected_tok_counts[np.concatenate(word_order)] + 1)
+        # cumsum adds the terms sequentially (sum would add them pairwise)
+        return np.cumsum(terms)[-1] if len(terms) > 0 else 0
+
+    def arrays(self):
+        """
+        Returns the selected set and the token statistics as arrays, for
+        saving in a checkpoint.
+
+        Returns
+        -------
+        dict[String, np.ndarray]
+            the arrays describing the state
+        """
+        return {
+            "selected": np.flatnonzero(self.selected_mask).astype(np.int64),
+            "selected_tok_count": np.array(self.selected_tok_count, dtype=np.int64),
+            "selected_counts": self.selected_tok_counts,
+            "unselected_counts": self.unselected_tok_counts,
+        }
+
+    @classmethod
+    def from_arrays(cls, matrix, arrays):
+        """
+        Restores a state saved by arrays, without recounting the tokens of the
+        corpus.
+
+        Parameters
+        ----------
+        matrix : TokenMatrix
+            the sentences the state was computed for
+        arrays : dict[String, np.ndarray]
+            the arrays describing the state
+
+        Returns
+        -------
+        VectorizedDelfyState
+            the restored state
+        """
+        state = cls.__new__(cls)
+        state.matrix = matrix
+        state.lengths = matrix.lengths()
+        state.selected = set(arrays["selected"].tolist())
+        state.selected_mask = np.zeros(len(matrix), dtype=bool)
+        state.selected_mask[arrays["selected"]] = True
+        state.selected_tok_count = int(arrays["selected_tok_count"])
+        state.selected_tok_counts = np.array(arrays["selected_counts"], dtype=np.int64)
+        state.unselected_tok_counts = np.array(arrays["unselected_counts"], dtype=np.int64)
+        return state
+
+
+class VectorizedDecayLogFrequency:
+    """
+    Runs a single round of the delfy algorithm with array operations over a
+    TokenMatrix. Computes the same scores as DecayLogFrequency, with the
+    floating-point operations in the same order, and breaks ties in the same
+    way, so both select the same sentences.
+    """
+
+    def __init__(self, state, budget, budget_unit, batch_size=65536):
+        self.state = state
+        self.l1 = 1.0
+        self.l2 = 1.0
+        self.budget = budget
+        self.budget_unit = budget_unit
+        self.batch_size = batch_size
+        # the unselected sentences in the iteration order of a set, like DecayLogFrequency (ties in the
+        # scores keep this order)
+        self.unselected = np.fromiter(set(np.flatnonzero(~state.selected_mask).tolist()), dtype=np.int64,
+                                      count=len(state.selected_mask) - len(state.selected))
+        self.fwu = np.log(state.unselected_tok_counts + 1) / state.swugwu(self.unselected, batch_size)
+        self.selected_decay = np.exp(-self.l1 * state.selected_tok_counts)
+
+    def run(self):
+        """
+        Runs the delfy algorithm as defined in the paper, once. See
+        DecayLogFrequency.run.
+
+        Returns
+        -------
+        set[int]
+            the indices of the sentences selected during this round
+        """
+        with profiling.phase("delfy.lf"):
+            lf_order = self.unselected[np.argsort(-self.lf(self.unselected), kind="stable")]
+        profiling.count("delfy.sentences_scored", len(lf_order))
+        with profiling.phase("delfy.scoring"):
+            delfy_scores = self.delfy(lf_order)
+        ranked = lf_order[np.argsort(-delfy_scores, kind="stable")]
+        if self.budget_unit == "token":
+            new_selected = set()
+            selected_count = 0
+            for sent_index, length in zip(ranked.tolist(), self.state.lengths[ranked].tolist()):
+                if selected_count >= self.budget:
+                    break
+                if selected_count + length < self.budget:
+                    new_selected.add(sent_index)
+                    selected_count += length
+        elif self.budget_unit == "sentence":
+            new_selected = set(ranked[:max(self.budget, 0)].tolist())
+        else:
+            raise ValueError(f"Only budget units 'sentence' and 'token' are accepted: {self.budget_unit}")
+        return new_selected
+
+    def lf(self, sent_indices):
+        """
+        Calculates the average logarithm frequency of all tokens in each of
+        the provided sentences.
+
+        Parameters
+        ----------
+        sent_indices : np.ndarray
+            the indices of the sentences to find lf for
+
+        Returns
+        -------
+        np.ndarray
+            the average logarithm frequency of each sentence
+        """
+        token_weights = self.fwu * self.selected_decay
+        scores = np.zeros(len(sent_indices))
+        for start in range(0, len(sent_indices), self.batch_size):
+            batch = sent_indices[start:start + self.batch_size]
+            toks, positions = self.state.matrix.gather(batch)
+            scores[start:start + len(batch)] = np.bincount(positions, weights=token_weights[toks],
+                                                           minlength=len(batch))
+        return self._average(scores, sent_indices)
+
+    def delfy(self, lf_order):
+        """
+        Calculates the delfy index of every sentence, where each sentence is
+        decayed by the sentences that precede it in lf_order (the uhat set of
+        the paper). The sequential decay is computed in batches: within a
+        batch, the number of earlier sentences containing each token is found
+        by sorting the (token, position) pairs, and the counts are carried
+        over from one batch to the next. The weights of the tokens are put
+        back in the order of the sentences before they are summed.
+
+        Parameters
+        ----------
+        lf_order : np.ndarray
+            the indices of the unselected sentences, sorted by lf
+
+        Returns
+        -------
+        np.ndarray
+            the delfy index of each sentence, in the order of lf_order
+        """
+        uhat_tok_counts = np.zeros(self.state.matrix.vocab_size, dtype=np.int64)
+        scores = np.zeros(len(lf_order))
+        for start in range(0, len(lf_order), self.batch_size):
+            batch = lf_order[start:start + self.batch_size]
+            toks, positions = self.state.matrix.gather(batch)
+            if len(toks) == 0:
+                continue
+            order = np.lexsort((positions, toks))
+            sentence_positions = positions
+            toks, positions = toks[order], positions[order]
+            new_tok = np.empty(len(toks), dtype=bool)
+            new_tok[0] = True
+            new_tok[1:] = toks[1:] != toks[:-1]
+            new_pair = new_tok.copy()
+            new_pair[1:] |= positions[1:] != positions[:-1]
+            pair_index = np.cumsum(new_pair) - 1
+            first_pair_of_tok = np.maximum.accumulate(np.where(new_tok, pair_index, 0))
+            # number of earlier sentences (in lf order) that contain the token
+            csius = uhat_tok_counts[toks] + pair_index - first_pair_of_tok
+            weights = np.empty(len(toks))
+            weights[order] = self.fwu[toks] * (self.selected_decay[toks] * np.exp(-self.l2 * csius))
+            # bincount adds the weights in sentence order, like DecayLogFrequency.delfy
+            scores[start:start + len(batch)] = np.bincount(sentence_positions, weights=weights,
+                                                           minlength=len(batch))
+            uhat_tok_counts += np.bincount(toks[new_pair], minlength=len(uhat_tok_counts))
+        return self._average(scores, lf_order)
+
+    def _average(self, scores, sent_indices):
+        lengths = self.state.lengths[sent_indices]
+        return np.divide(scores, lengths, out=np.zeros(len(scores)), where=lengths > 0)
+
+
 def tokenize_all_lines(filename):
     """
     Returns a list of all the lines in the provided file, tokenized.
+    The tokenization is cached on disk (see tokenization.tokenize_file).
 
     Parameters
     ----------
@@ -209,25 +595,100 @@ def tokenize_all_lines(filename):
     list[list[String]]
         the tokenized lines
     """
-    model_checkpoint = "facebook/mbart-large-50-many-to-many-mmt"
-    tokenizer = AutoTokenizer.from_pretrained(model_checkpoint)
-    lines = []
-    with open(filename) as reader:
-        for line in reader:
-            line = line.strip()
-            line = tokenizer(line)
-            lines.append(line['input_ids'])
-    return lines
-
-
-def run_delfy(tokenized_sents, budget_percentage=0.2, budget_unit="sentence", num_rounds=20):
+    return tokenize_file(filename).tolist()
+
+
+def save_checkpoint(filename, round_num, state, settings):
+    """
+    Saves the progress of a delfy run (the number of completed rounds, the
+    selected set and the token statistics) to a .npz file. The file is
+    replaced atomically, so a run that is killed while saving leaves the
+    previous checkpoint intact.
+
+    Parameters
+    ----------
+    filename : String
+        the checkpoint file
+    round_num : int
+        the number of completed rounds
+    state : DelfyState or VectorizedDelfyState
+        the state after the completed rounds
+    settings : dict
+        the settings of the run, which a resumed run must match
+    """
+    checkpoint_dir = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=checkpoint_dir, suffix=".tmp")
+    with os.fdopen(fd, 'wb') as writer:
+        np.savez(writer, round=np.array(round_num, dtype=np.int64), settings=np.array(json.dumps(settings)),
+                 **state.arrays())
+    os.replace(tmp_path, filename)
+
+
+def load_checkpoint(filename, settings):
+    """
+    Loads a checkpoint saved by save_checkpoint.
+
+    Parameters
+    ----------
+    filename : String
+        the checkpoint file
+    settings : dict
+        the settings of the run being resumed
+
+    Returns
+    -------
+    (int, dict[String, np.ndarray])
+        the number of completed rounds, and the arrays describing the state
+        after them (see DelfyState.arrays)
+    """
+    with np.load(filename) as checkpoint:
+        saved_settings = json.loads(str(checkpoint["settings"]))
+        if saved_settings != settings:
+            raise ValueError(f"Checkpoint {filename} was saved by a run with different settings: {saved_settings}")
+        arrays = {key: checkpoint[key] for key in checkpoint.files if key not in ["round", "settings"]}
+        return int(checkpoint["round"]), arrays
+
+
+def corpus_hash(tokenized_sents):
+    """
+    Returns a hash of the tokens of every sentence, which identifies the
+    corpus a checkpoint was saved for.
+
+    Parameters
+    ----------
+    tokenized_sents : list[list[String]] or TokenMatrix
+        a list of all sentences, each organized as a list of tokens
+
+    Returns
+    -------
+    String
+        the hexadecimal digest of the corpus
+    """
+    if isinstance(tokenized_sents, TokenMatrix):
+        return cache_key(array_hash(tokenized_sents.ids), array_hash(tokenized_sents.offsets))
+    return lines_hash(json.dumps(list(sent)) for sent in tokenized_sents)
+
+
+def positive_int(value):
+    """Parses a command line argument that must be an integer of at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+    return number
+
+
+def run_delfy(tokenized_sents, budget_percentage=0.2, budget_unit="sentence", num_rounds=20,
+              backend="python", metrics=None, checkpoint=None, checkpoint_every=1):
     """
     Runs the delfy algorithm as defined in the paper for the provided number of
     rounds, with the provided budget. Returns the final selection set.
+    The token statistics are computed once and carried between rounds by a
+    DelfyState (or a VectorizedDelfyState for the "numpy" backend).
 
     Parameters
     ----------
-    tokenized_sents : list[list[String]]
+    tokenized_sents : list[list[String]] or TokenMatrix
         a list of all sentences, each organized as a list of tokens
     budget_percentage : float
         the percentage of the total provided data (in either sentences or tokens) to select
@@ -235,39 +696,88 @@ def run_delfy(tokenized_sents, budget_percentage=0.2, budget_unit="sentence", nu
         the measure for budgeting, either "sentence" or "token"
     num_rounds : int
         the number of rounds to execute the delfy algorithm
+    backend : String
+        "python" for the reference implementation, or "numpy" for the vectorized one
+    metrics : profiling.NullMetrics
+        if specified, receives the phase timings and a progress report for
+        every round (defaults to the current metrics, see profiling.use)
+    checkpoint : String
+        if specified, the progress of the run is saved to this file (see
+        save_checkpoint), and if the file already exists, the run resumes
+        from the last saved round (giving the same selection as a run that
+        was never interrupted)
+    checkpoint_every : int
+        the number of rounds between checkpoints (the last round is always
+        saved); must be at least 1
 
     Returns
     -------
     set[int]
         the indices of all selected sentences
     """
+    if metrics is not None:
+        previous = profiling.use(metrics)
+        try:
+            return run_delfy(tokenized_sents, budget_percentage, budget_unit, num_rounds, backend,
+                             checkpoint=checkpoint, checkpoint_every=checkpoint_every)
+        finally:
+            profiling.use(previous)
+    if backend not in ["python", "numpy"]:
+        raise ValueError(f"Only backends 'python' and 'numpy' are accepted: {backend}")
+    if checkpoint_every < 1:
+        raise ValueError(f"checkpoint_every must be at least 1: {checkpoint_every}")
+    resume = checkpoint is not None and os.path.exists(checkpoint)
+    with profiling.phase("delfy.setup"):
+        # hashed before any conversion, so that a resumed run sees the same input
+        corpus = corpus_hash(tokenized_sents) if checkpoint is not None else None
+        if backend == "python":
+            if isinstance(tokenized_sents, TokenMatrix):
+                tokenized_sents = [sent.tolist() for sent in tokenized_sents]
+            total_tok_count = sum(len(sent) for sent in tokenized_sents)
+        else:
+            if not isinstance(tokenized_sents, TokenMatrix):
+                tokenized_sents = TokenMatrix.from_lists(tokenized_sents)
+            total_tok_count = len(tokenized_sents.ids)
+        settings = {"budget_percentage": budget_percentage, "budget_unit": budget_unit, "num_rounds": num_rounds,
+                    "backend": backend, "num_sentences": len(tokenized_sents), "num_tokens": total_tok_count,
+                    "corpus": corpus}
+        completed_rounds = 0
+        if resume:
+            completed_rounds, arrays = load_checkpoint(checkpoint, settings)
+            state_class = DelfyState if backend == "python" else VectorizedDelfyState
+            state = state_class.from_arrays(tokenized_sents, arrays)
+            profiling.count("delfy.rounds_resumed", completed_rounds)
+        elif backend == "python":
+            state = DelfyState(tokenized_sents)
+        else:
+            state = VectorizedDelfyState(tokenized_sents)
     if budget_unit == "token":
-        total_tok_count = 0
-        for sent in tokenized_sents:
-            total_tok_count += len(sent)
-
         total_budget = int(budget_percentage * total_tok_count)
-        selected = set()
-        for i in range(1, num_rounds + 1):
-            budget_this_round = i * total_budget // num_rounds - (i - 1) * total_budget // num_rounds
-            # last round is "cleanup," gets unused tokens from previous rounds
-            if i == num_rounds:
-                toks_selected = 0
-                for sent in selected:
-                    toks_selected += len(tokenized_sents[sent])
-                budget_this_round = total_budget - toks_selected
-            next_selected = DecayLogFrequency(tokenized_sents, selected, budget_this_round, budget_unit).run()
-            selected |= next_selected
     elif budget_unit == "sentence":
         total_budget = int(budget_percentage * len(tokenized_sents))
-        selected = set()
-        for i in range(1, num_rounds + 1):
-            budget_this_round = i * total_budget // num_rounds - (i - 1) * total_budget // num_rounds
-            next_selected = DecayLogFrequency(tokenized_sents, selected, budget_this_round, budget_unit).run()
-            selected |= next_selected
     else:
         raise ValueError(f"Only budget units 'sentence' and 'token' are accepted: {budget_unit}")
-    return selected
+    for i in range(completed_rounds + 1, num_rounds + 1):
+        start = time.perf_counter()
+        budget_this_round = i * total_budget // num_rounds - (i - 1) * total_budget // num_rounds
+        # last round is "cleanup," gets unused tokens from previous rounds
+        if budget_unit == "token" and i == num_rounds:
+            budget_this_round = total_budget - state.selected_tok_count
+        with profiling.phase("delfy.round"):
+            if backend == "numpy":
+                next_selected = VectorizedDecayLogFrequency(state, budget_this_round, budget_unit).run()
+            else:
+                next_selected = DecayLogFrequency(tokenized_sents, state.selected, budget_this_round,
+                                                  budget_unit, state).run()
+            state.select(next_selected)
+        if checkpoint is not None and (i % checkpoint_every == 0 or i == num_rounds):
+            with profiling.phase("delfy.checkpoint"):
+                save_checkpoint(checkpoint, i, state, settings)
+        profiling.current().round(algorithm="delfy", round=i, num_rounds=num_rounds, budget=budget_this_round,
+                                  selected=len(next_selected), total_selected=len(state.selected),
+                                  selected_tokens=state.selected_tok_count,
+                                  seconds=time.perf_counter() - start)
+    return state.selected
 
 
 if __name__ == "__main__":
@@ -277,13 +787,21 @@ if __name__ == "__main__":
     parser.add_argument('-b', "--budget", type=float)
     parser.add_argument('-u', "--budget-unit")
     parser.add_argument('-r', '--rounds', type=int)
+    parser.add_argument('--backend', choices=["python", "numpy"], default="python")
+    parser.add_argument('--profile', type=str, help="writes a JSON report of phase timings, counters "
+                                                     "and per-round progress to this file")
+    parser.add_argument('--checkpoint', type=str, help="saves the progress of the run to this .npz file, "
+                                                        "and resumes from it if it exists")
+    parser.add_argument('--checkpoint-every', type=positive_int, default=1, help="the number of rounds between checkpoints")
     args = parser.parse_args()
 
-    sentences = tokenize_all_lines(args.lines)
-    to_exclude = lines_to_exclude()
-    for index in to_exclude:
-        sentences[index] = [250004, 2]
-    selected_lines = run_delfy(sentences, args.budget, args.budget-unit, args.rounds)
+    metrics = profiling.Metrics(progress=True) if args.profile else None
+    profiling.use(metrics)
+    sentences = tokenize_file(args.lines).replace_rows(lines_to_exclude(), [250004, 2])
+    selected_lines = run_delfy(sentences, args.budget, args.budget_unit, args.rounds, args.backend,
+                               checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every)
     with open(args.outfile, 'w') as writer:
         for line in selected_lines:
             writer.write(f'{line}\n')
+    if metrics is not None:
+        metrics.write(args.profile)
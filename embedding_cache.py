@@ -0,0 +1,119 @@
+import glob
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+import profiling
+from cache import CACHE_DIR, cache_key, lines_hash
+
+
+def line_hashes(lines):
+    """
+    Returns a 64-bit hash of every line, used to recognize lines whose
+    embeddings have already been computed.
+
+    Parameters
+    ----------
+    lines : list[String]
+        the lines to hash
+
+    Returns
+    -------
+    np.ndarray
+        the hash of each line, as a uint64 array
+    """
+    return np.fromiter((int.from_bytes(hashlib.blake2b(line.encode('utf-8'), digest_size=8).digest(), 'little')
+                        for line in lines), dtype=np.uint64, count=len(lines))
+
+
+def cached_embeddings(model, model_name, lines, cache_dir=CACHE_DIR, batch_size=64):
+    """
+    Returns the unit-normalized sentence embeddings of the provided lines as a
+    read-only memory-mapped float32 array (one row per line). The embeddings
+    are stored on disk, keyed by the model name and the hash of the corpus,
+    so that later runs (and other processes) can map the same file instead of
+    re-encoding the corpus. When a corpus is not in the cache yet, the rows of
+    lines that were already embedded for another corpus are copied over, and
+    only the new or changed lines are encoded. An empty corpus is not cached.
+
+    Parameters
+    ----------
+    model : SimCSE
+        the model used to encode lines that are not in the cache
+    model_name : String
+        the name of the model (part of the cache key)
+    lines : list[String]
+        the lines to embed
+    cache_dir : String
+        the root directory of the cache
+    batch_size : int
+        the batch size used for encoding
+
+    Returns
+    -------
+    np.ndarray
+        the embeddings, with shape (len(lines), embedding dimension)
+    """
+    if len(lines) == 0:
+        # there is nothing to cache, but the dimension still comes from the model
+        dim = np.asarray(model.encode(["."], batch_size=batch_size, normalize_to_unit=True,
+                                      return_numpy=True)).reshape(1, -1).shape[1]
+        return np.zeros((0, dim), dtype=np.float32)
+    model_dir = os.path.join(cache_dir, "embeddings", cache_key(model_name))
+    path = os.path.join(model_dir, f"{lines_hash(lines)}.npy")
+    if not os.path.exists(path):
+        os.makedirs(model_dir, exist_ok=True)
+        _build_embeddings(model, lines, model_dir, path, batch_size)
+    return np.load(path, mmap_mode='r')
+
+
+def _build_embeddings(model, lines, model_dir, path, batch_size):
+    hashes = line_hashes(lines)
+    found = np.zeros(len(lines), dtype=bool)
+    sources = []
+    # reuse rows from the previously cached corpora, most recent first
+    previous = sorted(glob.glob(os.path.join(model_dir, "*.hashes.npy")), key=os.path.getmtime, reverse=True)
+    for hashes_path in previous:
+        if found.all():
+            break
+        old_path = hashes_path[:-len(".hashes.npy")] + ".npy"
+        if not os.path.exists(old_path):
+            continue  # left over from a build that did not finish
+        old_hashes = np.load(hashes_path)
+        order = np.argsort(old_hashes)
+        missing = np.flatnonzero(~found)
+        positions = np.minimum(np.searchsorted(old_hashes[order], hashes[missing]), max(len(order) - 1, 0))
+        matched = (len(order) > 0) & (old_hashes[order][positions] == hashes[missing])
+        if matched.any():
+            sources.append((old_path, missing[matched], order[positions[matched]]))
+            found[missing[matched]] = True
+    missing = np.flatnonzero(~found)
+    profiling.count("embeddings.reused", len(lines) - len(missing))
+    profiling.count("embeddings.encoded", len(missing))
+    new_vectors = None
+    if len(missing) > 0:
+        with profiling.phase("embeddings.encode"):
+            new_vectors = np.asarray(model.encode([lines[i] for i in missing], batch_size=batch_size,
+                                                  normalize_to_unit=True, return_numpy=True), dtype=np.float32)
+        new_vectors = new_vectors.reshape(len(missing), -1)
+        dim = new_vectors.shape[1]
+    else:
+        # every line was found, so there is at least one source (the corpus is not empty)
+        dim = np.load(sources[0][0], mmap_mode='r').shape[1]
+    # write to a temporary file first, so that concurrent runs never map a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=model_dir, suffix=".tmp")
+    os.close(fd)
+    embeddings = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(lines), dim))
+    for old_path, rows, old_rows in sources:
+        embeddings[rows] = np.load(old_path, mmap_mode='r')[old_rows]
+    if new_vectors is not None:
+        embeddings[missing] = new_vectors
+    embeddings.flush()
+    del embeddings
+    fd, tmp_hashes_path = tempfile.mkstemp(dir=model_dir, suffix=".tmp")
+    with os.fdopen(fd, 'wb') as writer:
+        np.save(writer, hashes)
+    # the hashes are published last, so every hashes file has its embeddings
+    os.replace(tmp_path, path)
+    os.replace(tmp_hashes_path, path[:-len(".npy")] + ".hashes.npy")
@@ -0,0 +1,227 @@
+import argparse
+import glob
+import json
+import os
+import tempfile
+import numpy as np
+import evaluate
+from transformers import MBartForConditionalGeneration, MBart50TokenizerFast
+
+from batching import TokenBudgetBatchSampler
+from cache import CACHE_DIR, cache_key, file_hash, lines_hash
+from langcodes import code3, code5
+from paralleldata import coco_data
+os.environ["TOKENIZERS_PARALLELISM"] = "false" # suppresses a transformers warning
+
+# The files of a saved checkpoint that determine its translations.
+WEIGHT_FILES = ["*.safetensors", "pytorch_model*.bin", "generation_config.json"]
+
+
+def checkpoint_fingerprint(checkpoint):
+    """
+    Returns a string that identifies the weights of a checkpoint. For a local
+    checkpoint directory, this is the hash of its configuration together with
+    the size and modification time of its weight files, so that retraining
+    into the same directory yields a new fingerprint. Otherwise (e.g. for a
+    checkpoint on the Hugging Face hub) it is the name of the checkpoint.
+
+    Parameters
+    ----------
+    checkpoint : String
+        the checkpoint directory or name
+
+    Returns
+    -------
+    String
+        the fingerprint of the checkpoint
+    """
+    config_file = os.path.join(checkpoint, "config.json")
+    if not os.path.isfile(config_file):
+        return checkpoint
+    parts = [file_hash(config_file)]
+    for pattern in WEIGHT_FILES:
+        for filename in sorted(glob.glob(os.path.join(checkpoint, pattern))):
+            stat = os.stat(filename)
+            parts.append(f"{os.path.basename(filename)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return cache_key(*parts)
+
+
+def generate_translations(model, tokenizer, sources, tgt, max_length=128, num_beams=1, max_tokens=4096):
+    """
+    Translates the source sentences, generating in batches of sentences of
+    similar length (with at most max_tokens padded input tokens per batch),
+    longest batches first so that running out of memory happens early.
+
+    Parameters
+    ----------
+    model : MBartForConditionalGeneration
+        the model
+    tokenizer : MBart50TokenizerFast
+        the tokenizer, with src_lang already set
+    sources : list[String]
+        the sentences to translate
+    tgt : String
+        the target language. Expects the standard two-letter code.
+    max_length : int
+        the maximum number of tokens in the inputs and translations
+    num_beams : int
+        the beam size used for generation
+    max_tokens : int
+        the maximum number of padded input tokens in a batch
+
+    Returns
+    -------
+    list[String]
+        the translation of every source sentence, in the original order
+    """
+    import torch
+    encodings = tokenizer(sources, max_length=max_length, truncation=True)
+    lengths = np.array([len(ids) for ids in encodings["input_ids"]])
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens, shuffle=False)
+    forced_bos_token_id = tokenizer.convert_tokens_to_ids(code5[tgt])
+    device = next(model.parameters()).device
+    translations = [None] * len(sources)
+    model.eval()
+    with torch.no_grad():
+        for batch in reversed(sampler.batches):
+            features = tokenizer.pad({"input_ids": [encodings["input_ids"][i] for i in batch],
+                                      "attention_mask": [encodings["attention_mask"][i] for i in batch]},
+                                     return_tensors="pt").to(device)
+            outputs = model.generate(**features, max_length=max_length, num_beams=num_beams,
+                                     forced_bos_token_id=forced_bos_token_id)
+            for i, translation in zip(batch, tokenizer.batch_decode(outputs, skip_special_tokens=True)):
+                translations[i] = translation.strip()
+    return translations
+
+
+def checkpoint_translations(checkpoint, sources, src, tgt, max_length=128, num_beams=1, max_tokens=4096):
+    """
+    Loads a checkpoint (on the GPU, if there is one) and translates the
+    source sentences with it (see generate_translations).
+
+    Parameters
+    ----------
+    checkpoint : String
+        the checkpoint directory or name
+    sources : list[String]
+        the sentences to translate
+    src : String
+        the source language. Expects the standard two-letter code.
+    tgt : String
+        the target language. Expects the standard two-letter code.
+    max_length : int
+        the maximum number of tokens in the inputs and translations
+    num_beams : int
+        the beam size used for generation
+    max_tokens : int
+        the maximum number of padded input tokens in a batch
+
+    Returns
+    -------
+    list[String]
+        the translation of every source sentence
+    """
+    import torch
+    tokenizer = MBart50TokenizerFast.from_pretrained(checkpoint)
+    tokenizer.src_lang = code5[src]
+    model = MBartForConditionalGeneration.from_pretrained(checkpoint)
+    if torch.cuda.is_available():
+        model = model.to("cuda")
+    return generate_translations(model, tokenizer, sources, tgt, max_length, num_beams, max_tokens)
+
+
+def cached_hypotheses(checkpoint, src, tgt, split="validation", max_length=128, num_beams=1,
+                      max_tokens=4096, cache_dir=CACHE_DIR, generate=checkpoint_translations):
+    """
+    Returns the translations of a split of the coco4mt data by a checkpoint.
+    The translations are cached on disk, keyed by the checkpoint fingerprint,
+    the language pair, the source sentences of the split and the generation
+    settings, so re-scoring a checkpoint (or scoring it with other metrics)
+    does not generate again.
+
+    Parameters
+    ----------
+    checkpoint : String
+        the checkpoint directory or name
+    src : String
+        the source language. Expects the standard two-letter code.
+    tgt : String
+        the target language. Expects the standard two-letter code.
+    split : String
+        the split of the coco4mt data to translate ("train", "validation", or "test")
+    max_length : int
+        the maximum number of tokens in the inputs and translations
+    num_beams : int
+        the beam size used for generation
+    max_tokens : int
+        the maximum number of padded input tokens in a batch
+    cache_dir : String
+        the root directory of the cache
+    generate : function
+        translates the sources when they are not cached, with the same
+        arguments as checkpoint_translations
+
+    Returns
+    -------
+    (list[String], list[String])
+        the translations and the reference translations of the split
+    """
+    examples = coco_data(src, tgt)[split]["translation"]
+    sources = [example[code3[src]] for example in examples]
+    references = [example[code3[tgt]] for example in examples]
+    key = cache_key(checkpoint_fingerprint(checkpoint), src, tgt, split, lines_hash(sources),
+                    max_length, num_beams)
+    path = os.path.join(cache_dir, "hypotheses", f"{key}.json")
+    if not os.path.exists(path):
+        hypotheses = generate(checkpoint, sources, src, tgt, max_length, num_beams, max_tokens)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so that concurrent runs never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as writer:
+            json.dump(hypotheses, writer, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    with open(path) as reader:
+        hypotheses = json.load(reader)
+    return hypotheses, references
+
+
+def score_hypotheses(hypotheses, references, metrics=("sacrebleu",)):
+    """
+    Scores translations against reference translations.
+
+    Parameters
+    ----------
+    hypotheses : list[String]
+        the translations
+    references : list[String]
+        the reference translation of each sentence
+    metrics : Iterable[String]
+        the names of the metrics to compute (as accepted by evaluate.load)
+
+    Returns
+    -------
+    dict
+        maps each metric to its score
+    """
+    results = dict()
+    for name in metrics:
+        result = evaluate.load(name).compute(predictions=hypotheses,
+                                             references=[[reference] for reference in references])
+        results[name] = result["score"] if "score" in result else result[name]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', "--checkpoint", type=str, required=True)
+    parser.add_argument('-s', "--src", type=str, required=True)
+    parser.add_argument('-t', "--tgt", type=str, required=True)
+    parser.add_argument("--split", type=str, default="validation")
+    parser.add_argument("--metrics", type=str, nargs="+", default=["sacrebleu"])
+    parser.add_argument("--max_length", type=int, default=128)
+    parser.add_argument("--num_beams", type=int, default=1)
+    parser.add_argument("--max_tokens", type=int, default=4096)
+    args = parser.parse_args()
+    hypotheses, references = cached_hypotheses(args.checkpoint, args.src, args.tgt, args.split,
+                                               args.max_length, args.num_beams, args.max_tokens)
+    print(json.dumps(score_hypotheses(hypotheses, references, args.metrics)))
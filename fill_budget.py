@@ -1,7 +1,9 @@
 from cocodata import load_coco_english
 import argparse
-from simcse_rankers import SimCSERanker
-from baselines import UniformRandomRanker, LengthRanker, WeightedRandomRanker
+import functools
+from itertools import islice
+import numpy as np
+import profiling
 
 
 def fill_sentence_budget(ranker, candidates, max_sents):
@@ -22,12 +24,117 @@ def fill_sentence_budget(ranker, candidates, max_sents):
     list[int]
         the indices of the selected sentences
     """
-    line_nums = list(ranker.rank(candidates))
-    selected = line_nums[:max_sents]
+    line_nums = ranker.rank(candidates, limit=max_sents)
+    selected = list(islice(line_nums, max_sents))
     return selected
 
 
-def fill_token_budget(ranker, candidates, max_tokens):
+def candidate_lengths(candidates, length_unit="whitespace"):
+    """
+    Returns the number of tokens in every candidate sentence.
+
+    Parameters
+    ----------
+    candidates : list[str]
+        the sentences to measure
+    length_unit : String
+        "whitespace" for the number of whitespace-separated tokens, or "mbart"
+        for the number of mBART sentence pieces (from the cached tokenization)
+
+    Returns
+    -------
+    np.ndarray
+        the sentence lengths, as an int64 array
+    """
+    if length_unit == "whitespace":
+        return np.fromiter((len(line.split()) for line in candidates), dtype=np.int64, count=len(candidates))
+    elif length_unit == "mbart":
+        from tokenization import tokenize_lines
+        return tokenize_lines(candidates, store="pieces").lengths()
+    else:
+        raise Exception(f"Unrecognized length unit: {length_unit}")
+
+
+def _ranked_chunks(line_nums, chunk_size=1024):
+    """
+    Yields a ranking as arrays of line numbers. Lazy rankings (generators)
+    are consumed in chunks of doubling size, so that only about twice the
+    part of the ranking that is actually needed gets generated.
+    """
+    if isinstance(line_nums, (list, np.ndarray)):
+        if len(line_nums) > 0:
+            yield np.asarray(line_nums, dtype=np.int64)
+        return
+    line_nums = iter(line_nums)
+    while True:
+        chunk = np.fromiter(islice(line_nums, chunk_size), dtype=np.int64)
+        if len(chunk) == 0:
+            return
+        yield chunk
+        chunk_size *= 2
+
+
+def fill_lengths(line_nums, lengths, max_tokens, fill="greedy"):
+    """
+    Fills a token budget with ranked sentences of known lengths. A sentence
+    fits if the selected sentences (including it) have fewer than max_tokens
+    tokens in total.
+
+    In "greedy" mode, the longest prefix of the ranking that fits is
+    selected (found with prefix sums and a binary search). In "best_fit"
+    mode, the scan continues past sentences that do not fit, selecting every
+    later sentence that still fits, so that less of the budget goes unused.
+
+    Parameters
+    ----------
+    line_nums : Iterable[int]
+        the ranked indices of the sentences
+    lengths : np.ndarray
+        the number of tokens in every sentence
+    max_tokens : int
+        max number of tokens that the budget allows
+    fill : String
+        the filling mode, either "greedy" or "best_fit"
+
+    Returns
+    -------
+    list[int]
+        the indices of the selected sentences, in ranked order
+    """
+    if fill not in ("greedy", "best_fit"):
+        raise Exception(f"Unrecognized fill mode: {fill}")
+    lengths = np.asarray(lengths, dtype=np.int64)
+    min_length = int(lengths.min()) if len(lengths) > 0 else 0
+    remaining = max_tokens
+    selected = []
+    for chunk in _ranked_chunks(line_nums):
+        chunk_lengths = lengths[chunk]
+        if fill == "greedy":
+            used = np.cumsum(chunk_lengths)
+            count = int(np.searchsorted(used, remaining, side="left"))
+            selected.append(chunk[:count])
+            if count < len(chunk):
+                break
+            remaining -= int(used[-1])
+        else:
+            while len(chunk) > 0 and remaining > min_length:
+                fits = chunk_lengths < remaining
+                chunk, chunk_lengths = chunk[fits], chunk_lengths[fits]
+                used = np.cumsum(chunk_lengths)
+                count = int(np.searchsorted(used, remaining, side="left"))
+                selected.append(chunk[:count])
+                if count > 0:
+                    remaining -= int(used[count - 1])
+                # the sentence after the selected prefix no longer fits
+                chunk, chunk_lengths = chunk[count + 1:], chunk_lengths[count + 1:]
+            if remaining <= min_length:
+                break
+    if len(selected) == 0:
+        return []
+    return np.concatenate(selected).tolist()
+
+
+def fill_token_budget(ranker, candidates, max_tokens, lengths=None, fill="greedy"):
     """
     Using the specified ranker, fills the specified token budget.
 
@@ -39,26 +146,120 @@ def fill_token_budget(ranker, candidates, max_tokens):
         the sentences to be ranked
     max_tokens : int
         max number of tokens that the budget allows
+    lengths : np.ndarray
+        the number of tokens in every candidate (defaults to the number of
+        whitespace-separated tokens)
+    fill : String
+        the filling mode, either "greedy" or "best_fit" (see fill_lengths)
 
     Returns
     -------
     list[int]
         the indices of the selected sentences
     """
-    length = 0
-    selected = []
-    line_nums = ranker.rank(candidates)
-    for line_num in line_nums:
-        len_sent = len(candidates[line_num].split())
-        if length + len_sent < max_tokens:
-            selected.append(line_num)
-            length += len_sent
-        else:
-            break
-    return selected
+    if lengths is None:
+        lengths = candidate_lengths(candidates)
+    return fill_lengths(ranker.rank(candidates), lengths, max_tokens, fill)
+
+
+def fill_budget(ranker, candidates, budget_pct, budget_unit, fill="greedy", length_unit="whitespace",
+                lengths=None):
+    """
+    Using the specified ranker, selects the specified percentage of the
+    candidate sentences (or of their tokens).
 
+    Parameters
+    ----------
+    ranker : Ranker
+        the Ranker object to be used to determine which sentences should be selected
+    candidates : list[str]
+        the sentences to be ranked
+    budget_pct : float
+        the percentage of the sentences (or tokens) to select, from 0 to 1
+    budget_unit : String
+        the measure for budgeting, either "sentence" or "token"
+    fill : String
+        the filling mode for token budgets, either "greedy" or "best_fit"
+    length_unit : String
+        how tokens are counted, either "whitespace" or "mbart"
+    lengths : np.ndarray
+        the precomputed number of tokens in every candidate (if specified,
+        length_unit is ignored)
 
-def lookup_ranker(ranker_name, budget_unit):
+    Returns
+    -------
+    list[int]
+        the indices of the selected sentences
+    """
+    if budget_unit == "sentence":
+        sent_budget = int(budget_pct * len(candidates))
+        with profiling.phase("fill_budget.fill"):
+            return fill_sentence_budget(ranker, candidates, sent_budget)
+    elif budget_unit == "token":
+        if lengths is None:
+            with profiling.phase("fill_budget.lengths"):
+                lengths = candidate_lengths(candidates, length_unit)
+        word_budget = int(budget_pct * int(np.sum(lengths)))
+        with profiling.phase("fill_budget.fill"):
+            return fill_token_budget(ranker, candidates, word_budget, lengths, fill)
+    else:
+        raise Exception(f"Unrecognized budget unit: {budget_unit}")
+
+
+def _simcse_ranker(budget_unit, corpus, approximate=False, nlist=None, nprobe=8):
+    from simcse_rankers import SimCSERanker
+    if corpus is None:
+        raise Exception("The simcse ranker needs the corpus that it ranks")
+    tiebreaker = "length" if budget_unit == "sentence" else "random"
+    return SimCSERanker(corpus, tiebreaker, approximate=approximate, nlist=nlist, nprobe=nprobe)
+
+
+def _simcse_ivf_ranker(budget_unit, corpus, nlist=None, nprobe=8):
+    return _simcse_ranker(budget_unit, corpus, approximate=True, nlist=nlist, nprobe=nprobe)
+
+
+def _uniform_ranker(budget_unit, corpus):
+    from baselines import UniformRandomRanker
+    return UniformRandomRanker()
+
+
+def _length_ranker(budget_unit, corpus):
+    from baselines import LengthRanker
+    return LengthRanker()
+
+
+def _weighted_ranker(budget_unit, corpus):
+    from baselines import WeightedRandomRanker
+    return WeightedRandomRanker()
+
+
+# Maps the name of each ranker to a function (budget_unit, corpus) -> Ranker
+# that constructs it. Each function imports the module of its ranker, so the
+# heavy backends (e.g. SimCSE) are only imported when they are requested.
+RANKERS = {
+    "simcse": _simcse_ranker,
+    "simcse-ivf": _simcse_ivf_ranker,
+    "uniform": _uniform_ranker,
+    "length": _length_ranker,
+    "weighted": _weighted_ranker,
+}
+
+
+def register_ranker(ranker_name, factory):
+    """
+    Makes a new ranker available to lookup_ranker (and the command line).
+
+    Parameters
+    ----------
+    ranker_name : String
+        the name used to identify the ranker
+    factory : function
+        constructs the ranker, given the budget unit and the corpus
+    """
+    RANKERS[ranker_name] = factory
+
+
+def lookup_ranker(ranker_name, budget_unit, corpus=None):
     """
     Returns the ranker associated with the given name, if it exists. Otherwise,
     raises an exception. 
@@ -69,27 +270,22 @@ def lookup_ranker(ranker_name, budget_unit):
     Parameters
     ----------
     ranker_name : String
-        the name used to identify the appropriate ranker. Can be "simcse" or "uniform" or "length" or "weighted"
+        the name used to identify the appropriate ranker. Can be "simcse", "simcse-ivf" (SimCSE with
+        approximate nearest-neighbor search), "uniform", "length" or "weighted" (or any ranker added with
+        register_ranker)
     budget_unit : String
         the measure for budgeting, either "sentence" or "token"
+    corpus : list[String]
+        the sentences that will be ranked (required by the simcse ranker, which embeds them up front)
 
     Returns
     -------
     Ranker
         the identified Ranker
     """
-    if ranker_name == "simcse":
-        tiebreaker = "length" if budget_unit == "sentence" else "random"
-        ranker = SimCSERanker(train, tiebreaker)
-    elif ranker_name == "uniform":
-        ranker = UniformRandomRanker()
-    elif ranker_name == "length":
-        ranker = LengthRanker()
-    elif ranker_name == "weighted":
-        ranker = WeightedRandomRanker()
-    else:
+    if ranker_name not in RANKERS:
         raise Exception(f"Unrecognized ranker: {ranker_name}")
-    return ranker
+    return RANKERS[ranker_name](budget_unit, corpus)
 
 
 if __name__ == "__main__":
@@ -98,20 +294,25 @@ if __name__ == "__main__":
     parser.add_argument('-u', "--budget_unit", type=str, required=True)
     parser.add_argument('-r', "--ranker", type=str, required=True)
     parser.add_argument('-c', "--coco_eng_path", type=str, required=True)
+    parser.add_argument("--fill", choices=["greedy", "best_fit"], default="greedy")
+    parser.add_argument("--length_unit", choices=["whitespace", "mbart"], default="whitespace")
+    parser.add_argument("--profile", type=str, help="writes a JSON report of phase timings and counters "
+                                                     "to this file")
+    parser.add_argument("--nlist", type=int, help="the number of inverted lists of the simcse-ivf index "
+                                                  "(defaults to 4 times the square root of the corpus size)")
+    parser.add_argument("--nprobe", type=int, default=8, help="the number of lists that simcse-ivf searches "
+                                                              "for each sentence")
     args = parser.parse_args()
-    train = load_coco_english(args.coco_eng_path, "train")
-    ranker = lookup_ranker(args.ranker, args.budget_unit)
-    if args.budget_unit == "sentence":
-        sent_budget = int(args.budget_pct * len(train))
-        lines = fill_sentence_budget(ranker, train, sent_budget)
-    elif args.budget_unit == "token":
-        tokenized_train = [line.split() for line in train]
-        total_num_tokens = 0
-        for tok in tokenized_train:
-            total_num_tokens += len(tok)
-        word_budget = int(args.budget_pct * total_num_tokens)
-        lines = fill_token_budget(ranker, train, word_budget)
-    else:
-        raise Exception(f"Unrecognized budget unit: {args.budget_unit}")
+    # the index settings only apply to simcse-ivf
+    register_ranker("simcse-ivf", functools.partial(_simcse_ivf_ranker, nlist=args.nlist, nprobe=args.nprobe))
+    metrics = profiling.Metrics() if args.profile else None
+    profiling.use(metrics)
+    with profiling.phase("fill_budget.load"):
+        train = load_coco_english(args.coco_eng_path, "train")
+    with profiling.phase("fill_budget.ranker"):
+        ranker = lookup_ranker(args.ranker, args.budget_unit, train)
+    lines = fill_budget(ranker, train, args.budget_pct, args.budget_unit, args.fill, args.length_unit)
     for line_num in sorted(lines):
-        print(line_num)
\ No newline at end of file
+        print(line_num)
+    if metrics is not None:
+        metrics.write(args.profile)
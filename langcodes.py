@@ -0,0 +1,21 @@
+# The code3 dictionary translates from two-letter language codes to three-letter language codes for simplicity of use.
+code3 = {
+    "en": "eng",
+    "de": "deu",
+    "id": "ind",
+    "ko": "kor",
+    "fr": "fra",
+    "my": "mya",
+    "gu": "guj"
+}
+
+# The code5 dictionary translates from two-letter language codes to the language codes of the mBART-50 tokenizer.
+code5 = {
+    "en": "en_XX",
+    "de": "de_DE",
+    "id": "id_ID",
+    "ko": "ko_KR",
+    "fr": "fr_XX",
+    "my": "my_MM",
+    "gu": "gu_IN"
+}
@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def nearest_neighbors(queries, keys=None, k=2, block_size=4096, num_threads=1):
+    """
+    Finds the k nearest neighbors (by dot product, i.e. cosine similarity for
+    unit-normalized embeddings) of every query among the keys, using blocked
+    matrix multiplies. Only a block_size x block_size block of similarities
+    (per thread) is held in memory at any time, together with the running
+    top-k of every query.
+
+    Parameters
+    ----------
+    queries : np.ndarray
+        the query embeddings, with shape (num_queries, dim)
+    keys : np.ndarray
+        the key embeddings, with shape (num_keys, dim). Defaults to the queries.
+    k : int
+        the number of neighbors to find for each query
+    block_size : int
+        the number of queries (and keys) multiplied at once
+    num_threads : int
+        the number of query blocks processed in parallel
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        the indices (into keys) and similarities of the k nearest neighbors of
+        each query, both with shape (num_queries, k), most similar first
+    """
+    if keys is None:
+        keys = queries
+    k = min(k, len(keys))
+    indices = np.zeros((len(queries), k), dtype=np.int64)
+    scores = np.zeros((len(queries), k), dtype=np.float32)
+
+    def search_block(start):
+        block = np.asarray(queries[start:start + block_size], dtype=np.float32)
+        best_scores = np.full((len(block), k), -np.inf, dtype=np.float32)
+        best_indices = np.zeros((len(block), k), dtype=np.int64)
+        for key_start in range(0, len(keys), block_size):
+            key_block = np.asarray(keys[key_start:key_start + block_size], dtype=np.float32)
+            similarities = block @ key_block.T
+            candidate_scores = np.concatenate([best_scores, similarities], axis=1)
+            candidate_indices = np.concatenate(
+                [best_indices, np.broadcast_to(np.arange(key_start, key_start + len(key_block)), similarities.shape)],
+                axis=1)
+            top = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(candidate_scores, top, axis=1)
+            best_indices = np.take_along_axis(candidate_indices, top, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        indices[start:start + len(block)] = np.take_along_axis(best_indices, order, axis=1)
+        scores[start:start + len(block)] = np.take_along_axis(best_scores, order, axis=1)
+
+    starts = range(0, len(queries), block_size)
+    if num_threads > 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            list(executor.map(search_block, starts))
+    else:
+        for start in starts:
+            search_block(start)
+    return indices, scores
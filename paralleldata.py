@@ -1,58 +1,239 @@
+import os
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 from datasets import Dataset, DatasetDict
-from pandas import DataFrame
+from cache import CACHE_DIR, cache_key
+from corpusreader import CorpusReader
+from langcodes import code3
 
 DATA_DIR = "/home/data"
 
-# The code3 dictionary translates from two-letter language codes to three-letter language codes for simplicity of use.
-code3 = {
-        "en": "eng",
-        "de": "deu",
-        "id": "ind",
-        "ko": "kor",
-        "fr": "fra",
-        "my": "mya",
-        "gu": "guj"
+# The consolidated (Arrow) copy of the Coco4MT data, built by build_coco_store.
+COCO_STORE_DIR = os.path.join(CACHE_DIR, "coco4mt-store")
+
+# The Coco4MT dataset (high- or low-resource) that each language belongs to.
+coco_datasets = {
+        "eng": "hr_dataset",
+        "deu": "hr_dataset",
+        "ind": "hr_dataset",
+        "kor": "hr_dataset",
+        "fra": "lr_dataset",
+        "mya": "lr_dataset",
+        "guj": "lr_dataset"
+    }
+
+# The name of the Coco4MT file for each split.
+coco_splits = {
+        "train": "train",
+        "validation": "dev",
+        "test": "test"
     }
 
 
-def enumerate_lines(filename):
+def enumerate_lines(filename, cache_dir=CACHE_DIR):
     """
-    Returns a list containing the sentences in the specified file, stripped.
+    Returns the sentences in the specified file, stripped, as a read-only
+    sequence backed by the memory-mapped file (see corpusreader.CorpusReader).
 
     Parameters
     ----------
     filename : String
         the file to take and enumerate lines from
+    cache_dir : String
+        the root directory of the cache of line offsets (None to not cache them)
 
     Returns
     -------
-    list[String]
-        the selected sentences
+    CorpusReader
+        the sentences
     """
-    lines = []
-    with open(filename) as reader:
-        for line in reader:
-            line = line.strip()
-            lines.append(line)
-    return lines
+    return CorpusReader(filename, cache_dir)
 
 
 def lines_to_exclude():
     """
     Reads the exclude.txt file to find the indices of all the sentences defined
-    as excluded (do not have translations in all languages), and returns a set
-    containing those indices.
+    as excluded (do not have translations in all languages), and returns an
+    array of those indices.
 
     Returns
     -------
-    set[int]
-        the indices of the selected sentences to be excluded
+    np.ndarray
+        the sorted (unique) indices of the selected sentences to be excluded
     """
-    result = set()
-    with open('exclude.txt') as reader:
-        for line in reader:
-            result.add(int(line))
-    return result
+    return np.unique(np.loadtxt('exclude.txt', dtype=np.int64, ndmin=1))
+
+
+def coco_sources_key(split, data_dir=None):
+    """
+    Identifies the Coco4MT text files of a split by their paths, sizes and
+    modification times, so that a store built from them can tell when they
+    have changed.
+
+    Parameters
+    ----------
+    split : String
+        the split ("train", "validation", or "test")
+    data_dir : String
+        the directory containing coco4mt-shared-task (defaults to DATA_DIR)
+
+    Returns
+    -------
+    String
+        the key of the files, or None if any of them does not exist
+    """
+    data_dir = DATA_DIR if data_dir is None else data_dir
+    parts = []
+    for lang, dataset in coco_datasets.items():
+        filename = os.path.abspath(f"{data_dir}/coco4mt-shared-task/{dataset}/{lang}/{coco_splits[split]}.txt")
+        if not os.path.exists(filename):
+            return None
+        stat = os.stat(filename)
+        parts += [filename, stat.st_size, stat.st_mtime_ns]
+    return cache_key(*parts)
+
+
+def build_coco_store(data_dir=None, store_dir=None):
+    """
+    Consolidates the Coco4MT data (all seven languages of the hr and lr
+    datasets) into one aligned Arrow file per split, with one string column
+    per language (e.g. "eng") and a boolean column marking its empty lines
+    (e.g. "eng_empty"). The metadata of each file records the key of the
+    text files it was built from (see coco_sources_key). This only needs to
+    be done once; afterwards, coco_data memory-maps the store and reads only
+    the requested columns.
+
+    Parameters
+    ----------
+    data_dir : String
+        the directory containing coco4mt-shared-task (defaults to DATA_DIR)
+    store_dir : String
+        the directory to write the store to (defaults to COCO_STORE_DIR)
+    """
+    data_dir = DATA_DIR if data_dir is None else data_dir
+    store_dir = COCO_STORE_DIR if store_dir is None else store_dir
+    os.makedirs(store_dir, exist_ok=True)
+    for split, filename in coco_splits.items():
+        columns = dict()
+        for lang, dataset in coco_datasets.items():
+            # (each file is read once, so its line offsets are not cached)
+            lines = enumerate_lines(f"{data_dir}/coco4mt-shared-task/{dataset}/{lang}/{filename}.txt", None)
+            # streams the lines into Arrow, without a list of all of them
+            columns[lang] = pa.array(iter(lines), type=pa.string(), size=len(lines))
+            columns[f"{lang}_empty"] = pc.equal(pc.utf8_length(columns[lang]), 0)
+        table = pa.table(columns).replace_schema_metadata({"sources": str(coco_sources_key(split, data_dir))})
+        # write to a temporary file first, so that readers never map a partial store
+        fd, tmp_path = tempfile.mkstemp(dir=store_dir, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, os.path.join(store_dir, f"{split}.arrow"))
+
+
+def load_coco_split(split, langs, store_dir=None):
+    """
+    Memory-maps the specified split of the consolidated Coco4MT store, and
+    returns only the columns of the requested languages (and their empty-line
+    masks). Builds the store first if it does not exist yet, and rebuilds it
+    if the Coco4MT text files have changed since (a store whose text files
+    are missing is used as it is).
+
+    Parameters
+    ----------
+    split : String
+        the split to load ("train", "validation", or "test")
+    langs : list[String]
+        the three-letter codes of the languages to load
+    store_dir : String
+        the directory of the store (defaults to COCO_STORE_DIR)
+
+    Returns
+    -------
+    pyarrow.Table
+        the columns of the requested languages
+    """
+    store_dir = COCO_STORE_DIR if store_dir is None else store_dir
+    path = os.path.join(store_dir, f"{split}.arrow")
+    if not os.path.exists(path):
+        build_coco_store(store_dir=store_dir)
+    reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+    sources = coco_sources_key(split)
+    if sources is not None and (reader.schema.metadata or {}).get(b"sources") != sources.encode('utf-8'):
+        build_coco_store(store_dir=store_dir)
+        reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+    table = reader.read_all()
+    return table.select([column for lang in langs for column in [lang, f"{lang}_empty"]])
+
+
+def line_mask(num_lines, lines=None):
+    """
+    Returns a boolean mask over the lines of a corpus that marks the
+    specified line numbers (or every line, if none are specified).
+
+    Parameters
+    ----------
+    num_lines : int
+        the number of lines in the corpus
+    lines : Iterable[int]
+        if specified, the (zero-indexed) line numbers to mark
+
+    Returns
+    -------
+    np.ndarray
+        the boolean mask
+    """
+    if lines is None:
+        return np.ones(num_lines, dtype=bool)
+    if isinstance(lines, np.ndarray):
+        indices = lines.astype(np.int64, copy=False)
+    else:
+        indices = np.fromiter(lines, dtype=np.int64)
+    mask = np.zeros(num_lines, dtype=bool)
+    mask[indices[(indices >= 0) & (indices < num_lines)]] = True
+    return mask
+
+
+def translation_dataset(src, src_corpus, tgt, tgt_corpus, mask):
+    """
+    Builds a translation Dataset directly from two aligned columns of
+    sentences, keeping only the lines marked by the mask.
+
+    Parameters
+    ----------
+    src : String
+        the name of the source language field
+    src_corpus : pyarrow.Array or pyarrow.ChunkedArray
+        the source sentences
+    tgt : String
+        the name of the target language field
+    tgt_corpus : pyarrow.Array or pyarrow.ChunkedArray
+        the target sentences
+    mask : np.ndarray
+        marks the lines to keep
+
+    Returns
+    -------
+    Dataset
+        the dataset, with an "id" column (the line numbers) and a
+        "translation" column
+    """
+    indices = pa.array(np.flatnonzero(mask), type=pa.int64())
+    translation = pa.StructArray.from_arrays([_take(src_corpus, indices), _take(tgt_corpus, indices)],
+                                             names=[src, tgt])
+    return Dataset(pa.table({'id': indices, 'translation': translation}))
+
+
+def _take(column, indices):
+    column = column.take(indices)
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    return column
+
+
+def _nonempty(column):
+    return pc.greater(pc.utf8_length(column), 0).to_numpy(zero_copy_only=False)
 
 
 def coco_data(src, tgt, lines=None):
@@ -77,62 +258,14 @@ def coco_data(src, tgt, lines=None):
     DatasetDict
         the Coco4MT data, organized
     """
-    train_corpora = {'eng': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/eng/train.txt"),
-                     'deu': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/deu/train.txt"),
-                     'ind': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/ind/train.txt"),
-                     'kor': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/kor/train.txt"),
-                     'fra': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/lr_dataset/fra/train.txt"),
-                     'mya': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/lr_dataset/mya/train.txt"),
-                     'guj': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/lr_dataset/guj/train.txt")}
-    valid_corpora = {'eng': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/eng/dev.txt"),
-                     'deu': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/deu/dev.txt"),
-                     'ind': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/ind/dev.txt"),
-                     'kor': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/kor/dev.txt"),
-                     'fra': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/lr_dataset/fra/dev.txt"),
-                     'mya': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/lr_dataset/mya/dev.txt"),
-                     'guj': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/lr_dataset/guj/dev.txt")}
-    test_corpora  = {'eng': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/eng/test.txt"),
-                     'deu': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/deu/test.txt"),
-                     'ind': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/ind/test.txt"),
-                     'kor': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/hr_dataset/kor/test.txt"),
-                     'fra': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/lr_dataset/fra/test.txt"),
-                     'mya': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/lr_dataset/mya/test.txt"),
-                     'guj': enumerate_lines(f"{DATA_DIR}/coco4mt-shared-task/lr_dataset/guj/test.txt")}
-
-    data = []
-    corpus = train_corpora
-    for i in range(len(corpus[code3[src]])):
-        if lines is None or i in lines:
-            if len(corpus[code3[src]][i]) > 0 and len(corpus[code3[tgt]][i]) > 0:
-                item = {'id': i,
-                        'translation': {code3[src]: corpus[code3[src]][i],
-                                        code3[tgt]: corpus[code3[tgt]][i]}}
-                data.append(item)
-    train_ds = Dataset.from_pandas(DataFrame(data=data))
-
-    data = []
-    corpus = valid_corpora
-    for i in range(len(corpus[code3[src]])):
-        if len(corpus[code3[src]][i]) > 0 and len(corpus[code3[tgt]][i]) > 0:
-            item = {'id': i,
-                    'translation': {code3[src]: corpus[code3[src]][i],
-                                    code3[tgt]: corpus[code3[tgt]][i]}}
-            data.append(item)
-    valid_ds = Dataset.from_pandas(DataFrame(data=data))
-
-    data = []
-    corpus = test_corpora
-    for i in range(len(corpus[code3[src]])):
-        if len(corpus[code3[src]][i]) > 0 and len(corpus[code3[tgt]][i]) > 0:
-            item = {'id': i,
-                    'translation': {code3[src]: corpus[code3[src]][i],
-                                    code3[tgt]: corpus[code3[tgt]][i]}}
-            data.append(item)
-    test_ds = Dataset.from_pandas(DataFrame(data=data))
     result = DatasetDict()
-    result['train'] = train_ds
-    result['validation'] = valid_ds
-    result['test'] = test_ds
+    for split in coco_splits:
+        table = load_coco_split(split, [code3[src], code3[tgt]])
+        mask = line_mask(table.num_rows, lines if split == "train" else None)
+        mask &= ~table.column(f"{code3[src]}_empty").to_numpy(zero_copy_only=False)
+        mask &= ~table.column(f"{code3[tgt]}_empty").to_numpy(zero_copy_only=False)
+        result[split] = translation_dataset(code3[src], table.column(code3[src]),
+                                            code3[tgt], table.column(code3[tgt]), mask)
     return result
 
 
@@ -158,44 +291,22 @@ def nllb_data(src, tgt, lines=None):
     DatasetDict
         the NLLB data, organized
     """
-
-    data = []
-    subcorpus = enumerate_lines(f'{DATA_DIR}/nllb/parallelized/{src}')
-    target_corpus = enumerate_lines(f'{DATA_DIR}/nllb/parallelized/{tgt}')
-    for i in range(len(subcorpus)):
-        if lines is None or i in lines:
-            if len(subcorpus[i]) > 0 and len(target_corpus[i]) > 0:
-                item = {'id': i,
-                        'translation': {src: subcorpus[i],
-                                        tgt: target_corpus[i]}}
-                data.append(item)
-    train_ds = Dataset.from_pandas(DataFrame(data=data))
-
-    data = []
-    subcorpus = enumerate_lines(f'{DATA_DIR}/flores200_dataset/dev/{src}.dev')
-    target_corpus = enumerate_lines(f'{DATA_DIR}/flores200_dataset/dev/{tgt}.dev')
-    for i in range(len(subcorpus)):
-        if len(subcorpus[i]) > 0 and len(target_corpus[i]) > 0:
-            item = {'id': i,
-                    'translation': {src: subcorpus[i],
-                                    tgt: target_corpus[i]}}
-            data.append(item)
-    valid_ds = Dataset.from_pandas(DataFrame(data=data))
-
-    data = []
-    subcorpus = enumerate_lines(f'{DATA_DIR}/flores200_dataset/devtest/{src}.devtest')
-    target_corpus = enumerate_lines(f'{DATA_DIR}/flores200_dataset/devtest/{tgt}.devtest')
-    for i in range(len(subcorpus)):
-        if len(subcorpus[i]) > 0 and len(target_corpus[i]) > 0:
-            item = {'id': i,
-                    'translation': {src: subcorpus[i],
-                                    tgt: target_corpus[i]}}
-            data.append(item)
-    test_ds = Dataset.from_pandas(DataFrame(data=data))
+    files = {'train': (f'{DATA_DIR}/nllb/parallelized/{src}', f'{DATA_DIR}/nllb/parallelized/{tgt}'),
+             'validation': (f'{DATA_DIR}/flores200_dataset/dev/{src}.dev',
+                            f'{DATA_DIR}/flores200_dataset/dev/{tgt}.dev'),
+             'test': (f'{DATA_DIR}/flores200_dataset/devtest/{src}.devtest',
+                      f'{DATA_DIR}/flores200_dataset/devtest/{tgt}.devtest')}
     result = DatasetDict()
-    result['train'] = train_ds
-    result['validation'] = valid_ds
-    result['test'] = test_ds
+    for split, (src_file, tgt_file) in files.items():
+        src_lines = enumerate_lines(src_file)
+        tgt_lines = enumerate_lines(tgt_file)
+        subcorpus = pa.array(iter(src_lines), type=pa.string(), size=len(src_lines))
+        target_corpus = pa.array(iter(tgt_lines), type=pa.string(), size=len(tgt_lines))
+        mask = line_mask(len(subcorpus), lines if split == "train" else None)
+        mask &= _nonempty(subcorpus) & _nonempty(target_corpus)
+        result[split] = translation_dataset(src, subcorpus, tgt, target_corpus, mask)
     return result
 
 
+if __name__ == "__main__":
+    build_coco_store()
@@ -0,0 +1,162 @@
+import json
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_memory_mb():
+    """
+    Returns the peak resident memory of the process so far, in MiB (or None
+    if it cannot be measured on this platform).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+class NullMetrics:
+    """
+    The metrics interface, with every method doing nothing. This is the
+    default, so the instrumentation of the selection code costs a method
+    call per phase when profiling is off.
+    """
+
+    def phase(self, name):
+        """
+        Returns a context manager that times the enclosed code as an
+        occurrence of the named phase.
+        """
+        return nullcontext()
+
+    def count(self, name, n=1):
+        """
+        Adds n to the named counter.
+        """
+        pass
+
+    def round(self, **info):
+        """
+        Reports the progress of a round of an iterative algorithm (e.g. a
+        round of delfy); info describes the round.
+        """
+        pass
+
+
+class Metrics(NullMetrics):
+    """
+    Collects the total time and number of occurrences of every phase, the
+    counters, the per-round progress reports and the peak memory of the
+    process at the end of every phase. Phases may be nested; the time of a
+    phase includes the time of the phases inside it. Subclasses can override
+    round (or any other method) to act on the measurements as they are made.
+    """
+
+    def __init__(self, progress=False):
+        self.progress = progress
+        self.start = time.perf_counter()
+        self.phases = dict()
+        self.counters = dict()
+        self.rounds = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.phases.setdefault(name, {"calls": 0, "seconds": 0.0, "peak_memory_mb": None})
+            stats["calls"] += 1
+            stats["seconds"] += time.perf_counter() - start
+            stats["peak_memory_mb"] = peak_memory_mb()
+
+    def count(self, name, n=1):
+        self.counters[name] = n + self.counters.get(name, 0)
+
+    def round(self, **info):
+        info["elapsed_seconds"] = time.perf_counter() - self.start
+        self.rounds.append(info)
+        if self.progress:
+            print(" ".join(f"{key}={value}" for key, value in info.items()), file=sys.stderr)
+
+    def report(self):
+        """
+        Returns the measurements as a (JSON-serializable) dictionary.
+
+        Returns
+        -------
+        dict
+            the wall-clock time since the metrics were created, the phases,
+            counters and rounds, and the peak memory of the process
+        """
+        return {
+            "wall_seconds": time.perf_counter() - self.start,
+            "peak_memory_mb": peak_memory_mb(),
+            "phases": self.phases,
+            "counters": self.counters,
+            "rounds": self.rounds,
+        }
+
+    def write(self, filename):
+        """
+        Writes the report to a JSON file.
+
+        Parameters
+        ----------
+        filename : String
+            the name of the file to write
+        """
+        with open(filename, 'w') as writer:
+            json.dump(self.report(), writer, indent=2)
+
+
+_metrics = NullMetrics()
+
+
+def current():
+    """
+    Returns the metrics that the instrumented code currently reports to.
+    """
+    return _metrics
+
+
+def use(metrics):
+    """
+    Makes the instrumented code report to the provided metrics (or stop
+    reporting, if metrics is None).
+
+    Parameters
+    ----------
+    metrics : NullMetrics
+        the metrics to report to
+
+    Returns
+    -------
+    NullMetrics
+        the metrics that were used before
+    """
+    global _metrics
+    previous = _metrics
+    _metrics = NullMetrics() if metrics is None else metrics
+    return previous
+
+
+def phase(name):
+    """
+    Times the enclosed code as an occurrence of the named phase of the
+    current metrics.
+    """
+    return _metrics.phase(name)
+
+
+def count(name, n=1):
+    """
+    Adds n to the named counter of the current metrics.
+    """
+    _metrics.count(name, n)
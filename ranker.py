@@ -1,20 +1,72 @@
 from abc import ABC
+import numpy as np
+
+
+def ranked_indices(keys, limit=None, chunk_size=1024):
+    """
+    Lazily generates the indices of the keys in ascending order of key, with
+    ties broken by index (i.e. the order of a stable argsort). Rather than
+    sorting all the keys up front, the smallest remaining keys are selected
+    in chunks of doubling size (with a partial sort), so the first indices
+    are available after a single O(N) pass and the rest of the keys are only
+    sorted if they are consumed.
+
+    Parameters
+    ----------
+    keys : np.ndarray
+        the key of every index
+    limit : int
+        if specified, only the first limit indices are generated
+    chunk_size : int
+        the number of indices in the first chunk
+
+    Returns
+    -------
+    Generator[int]
+        generates the indices, in ascending order of key
+    """
+    keys = np.asarray(keys)
+    remaining = np.arange(len(keys))
+    if limit is not None:
+        chunk_size = min(chunk_size, limit)
+        limit -= chunk_size
+    while len(remaining) > 0 and chunk_size > 0:
+        if chunk_size < len(remaining):
+            remaining_keys = keys[remaining]
+            kth = np.partition(remaining_keys, chunk_size - 1)[chunk_size - 1]
+            taken = remaining_keys < kth
+            # among keys equal to the largest taken key, the lowest indices come first
+            ties = np.flatnonzero(remaining_keys == kth)[:chunk_size - np.count_nonzero(taken)]
+            taken[ties] = True
+            chunk, remaining = remaining[taken], remaining[~taken]
+        else:
+            chunk, remaining = remaining, remaining[:0]
+        for i in chunk[np.argsort(keys[chunk], kind="stable")].tolist():
+            yield i
+        next_size = 2 * chunk_size
+        if limit is not None:
+            next_size = min(next_size, limit)
+            limit -= next_size
+        chunk_size = next_size
 
 
 class Ranker(ABC):
-    def rank(self, sents):
-        """Describe this.
-        
+    def rank(self, sents, limit=None):
+        """Ranks the provided sentences, best first. Rankers may generate
+        the ranking lazily, so callers that only need the best sentences
+        should pass a limit or stop consuming the ranking early.
+
         Parameters
         ----------
         sents : list[String]
             the sentences to be ranked
+        limit : int
+            if specified, at most this many (i.e. the best) indices are generated
 
         Returns
         -------
-        Generator[int]
+        Iterable[int]
             generates the indices of the selected sentences, in order
-        
-        """
-        pass    
 
+        """
+        pass
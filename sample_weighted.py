@@ -1,84 +1,197 @@
-from transformers import AutoTokenizer
-from numpy.random import multinomial
-import sys
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from ranker import ranked_indices
+from tokenization import tokenize_file
+from tokenmatrix import TokenMatrix
+
+
+def sentence_lengths(tokenized_sents):
+    """
+    Returns the number of tokens in every sentence.
+
+    Parameters
+    ----------
+    tokenized_sents : list[list[String]] or TokenMatrix
+        a list of all sentences, each organized as a list of tokens
+
+    Returns
+    -------
+    np.ndarray
+        the sentence lengths
+    """
+    if isinstance(tokenized_sents, TokenMatrix):
+        return tokenized_sents.lengths()
+    return np.fromiter((len(sent) for sent in tokenized_sents), dtype=np.int64, count=len(tokenized_sents))
+
+
+def weighted_samples(lengths, budget, num_trials=1, rng=None, max_keys=1 << 24):
+    """
+    Draws independent samples of sentences without replacement, weighted by
+    token length, using exponential keys: every sentence i gets the key
+    E_i / length_i with E_i ~ Exp(1), and the sample is the budget sentences
+    with the smallest keys. This is equivalent to repeatedly drawing a
+    sentence with probability proportional to its length among the sentences
+    not drawn yet, but takes a single vectorized pass (O(N) per trial).
+
+    Parameters
+    ----------
+    lengths : np.ndarray
+        the number of tokens in each sentence
+    budget : int
+        the number of sentences in each sample
+    num_trials : int
+        the number of independent samples to draw
+    rng : np.random.Generator or int
+        the random number generator (or the seed of one)
+    max_keys : int
+        the maximum number of keys generated at once (trials are drawn in
+        batches to bound memory)
+
+    Returns
+    -------
+    np.ndarray
+        the sorted indices of the selected sentences, with shape (num_trials, budget)
+    """
+    rng = np.random.default_rng(rng)
+    lengths = np.asarray(lengths, dtype=np.float64)
+    budget = min(budget, len(lengths))
+    samples = np.zeros((num_trials, budget), dtype=np.int64)
+    if budget == 0:
+        return samples
+    batch_trials = max(1, max_keys // max(len(lengths), 1))
+    for start in range(0, num_trials, batch_trials):
+        trials = min(batch_trials, num_trials - start)
+        with np.errstate(divide='ignore'):
+            keys = rng.exponential(size=(trials, len(lengths))) / lengths
+        if budget < len(lengths):
+            selected = np.argpartition(keys, budget - 1, axis=1)[:, :budget]
+        else:
+            selected = np.broadcast_to(np.arange(len(lengths)), keys.shape)
+        samples[start:start + trials] = np.sort(selected, axis=1)
+    return samples
+
+
+def weighted_permutation(lengths, rng=None, chunk_size=1024):
+    """
+    Lazily generates a weighted random ordering of all sentences: each next
+    sentence is drawn with probability proportional to its token length among
+    the sentences not generated yet. The exponential keys (see
+    weighted_samples) are drawn up front, and the sentences are then
+    generated in chunks of doubling size, so the first indices are available
+    after a single O(N) pass and later chunks are only sorted if they are
+    consumed. Empty sentences come last.
+
+    Parameters
+    ----------
+    lengths : np.ndarray
+        the number of tokens in each sentence
+    rng : np.random.Generator or int
+        the random number generator (or the seed of one)
+    chunk_size : int
+        the number of indices in the first chunk
+
+    Returns
+    -------
+    Generator[int]
+        generates the indices of all sentences, in weighted random order
+    """
+    rng = np.random.default_rng(rng)
+    lengths = np.asarray(lengths, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        keys = rng.exponential(size=len(lengths)) / lengths
+    yield from ranked_indices(keys, chunk_size=chunk_size)
 
 
 # size-weighted random distribution
-def weighted_sample(tokenized_sents, budget_pct):
+def weighted_sample(tokenized_sents, budget_pct, rng=None):
     """
-    Uses the numpy.random.multinomial function to take a sample of the given
-    sentences, weighted by token length, accounting for sentences chosen
-    multiple times, and iterating until the budget is exactly met. It uses a
-    sentence budget.
-    always used).
+    Takes a sample of the given sentences without replacement, weighted by
+    token length, until the sentence budget is exactly met (see
+    weighted_samples).
 
     Parameters
     ----------
-    tokenized_sents : list[list[String]]
+    tokenized_sents : list[list[String]] or TokenMatrix
         a list of all sentences, each organized as a list of tokens
     budget_pct : float
-        the percentage of the total provided data (in either sentences or tokens) to select
+        the percentage of the total provided data (in sentences) to select
+    rng : np.random.Generator or int
+        the random number generator (or the seed of one)
 
     Returns
     -------
     list[int]
         the indices of the selected lines
     """
-    total_tokens = 0
-    for line in tokenized_sents:
-        total_tokens += len(line)
-    weights = []
-    for line in tokenized_sents:
-        weights.append(len(line) / total_tokens)
     budget = int(budget_pct * len(tokenized_sents))
-    num_selected = 0
-    remaining = budget - num_selected
-    selected = []
-    for i in range(len(tokenized_sents)):
-        selected.append(0)
-    while remaining > 0:
-        num_selected = 0
-        new_selected = multinomial(remaining, weights).tolist()
-        # integrate values selected in this round into cumulative selected values
-        for i in range(len(tokenized_sents)):
-            selected[i] += new_selected[i]
-            num_selected += selected[i]
-        # set weights for selected sentences to zero and correct for sentences that were selected more than once
-        for i in range(len(tokenized_sents)):
-            if selected[i] > 0:
-                weights[i] = 0
-            if selected[i] > 1:
-                old_freq = selected[i]
-                selected[i] = 1
-                num_selected -= old_freq - selected[i]
-        # fix weights so they still add up to 1
-        new_total_weight = 0
-        for w in weights:
-            new_total_weight += w
-        weight_adjustor = 1 / new_total_weight
-        for i in range(len(weights)):
-            weights[i] *= weight_adjustor
-        remaining = budget - num_selected
-    # get lines from selected
-    selected_lines = []
-    for i in range(len(selected)):
-        if selected[i] == 1:
-            selected_lines.append(i)
-    return selected_lines
+    return weighted_samples(sentence_lengths(tokenized_sents), budget, 1, rng)[0].tolist()
+
+
+_lengths = None
+
+
+def _run_trial(trial, seed, budget, out_pattern):
+    samples = weighted_samples(_lengths, budget, 1, np.random.default_rng(seed))
+    filename = out_pattern.format(trial)
+    with open(filename, 'w') as writer:
+        for line in samples[0]:
+            writer.write(f"{line}\n")
+    return filename
+
+
+def run_trials(lengths, budget_pct, num_trials, seed=None, num_workers=1, out_pattern="wsample.{}.txt"):
+    """
+    Draws num_trials independent weighted samples and writes the selected
+    lines of trial i to out_pattern.format(i). Each trial has its own random
+    stream, spawned from the base seed, so the samples do not depend on the
+    number of workers. The trials are spread across worker processes, which
+    share the lengths array, and each file is written as soon as its trial
+    finishes.
+
+    Parameters
+    ----------
+    lengths : np.ndarray
+        the number of tokens in each sentence
+    budget_pct : float
+        the percentage of the sentences to select in each trial
+    num_trials : int
+        the number of trials to run
+    seed : int
+        the base seed (if None, fresh entropy is used)
+    num_workers : int
+        the number of worker processes
+    out_pattern : String
+        the pattern of the output file names
+
+    Returns
+    -------
+    list[String]
+        the names of the output files, in trial order
+    """
+    global _lengths
+    _lengths = lengths
+    budget = int(budget_pct * len(lengths))
+    seeds = np.random.SeedSequence(seed).spawn(num_trials)
+    if num_workers <= 1:
+        return [_run_trial(i, seeds[i], budget, out_pattern) for i in range(num_trials)]
+    # forked workers inherit the lengths array without copying or pickling it
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = {executor.submit(_run_trial, i, seeds[i], budget, out_pattern): i for i in range(num_trials)}
+        filenames = [None] * num_trials
+        for future in as_completed(futures):
+            filenames[futures[future]] = future.result()
+    return filenames
 
 
 if __name__ == "__main__":
-    sentence_file = sys.argv[1]
-    budget_pct = float(sys.argv[2])
-    num_trials = int(sys.argv[3])
-    model_checkpoint = "facebook/mbart-large-50-many-to-many-mmt"
-    tokenizer = AutoTokenizer.from_pretrained(model_checkpoint)
-    tokenized_sents = []
-    with open(sentence_file) as reader:
-        for line in reader:
-            tokenized_sents.append(tokenizer.tokenize(line.strip()))
-    for i in range(num_trials):
-        with open(f"wsample.{i}.txt", 'w') as writer:
-            selected_lines = weighted_sample(tokenized_sents, budget_pct)            
-            for line in selected_lines:
-                writer.write(f"{line}\n")
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sentence_file")
+    parser.add_argument("budget_pct", type=float)
+    parser.add_argument("num_trials", type=int)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    lengths = tokenize_file(args.sentence_file, store="pieces").lengths()
+    run_trials(lengths, args.budget_pct, args.num_trials, args.seed, args.workers)
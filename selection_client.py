@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import socket
+
+from cache import CACHE_DIR
+
+# The default address of the selection service (see selection_service.py).
+SOCKET_PATH = os.path.join(CACHE_DIR, "selection.sock")
+
+
+def request_selection(config, socket_path=SOCKET_PATH, host=None, port=None, timeout=None):
+    """
+    Asks a running selection service to select lines. The service listens
+    on a Unix socket, or on a TCP port if one is specified.
+
+    Parameters
+    ----------
+    config : dict
+        the selection settings: "method" ("fill_budget", "delfy" or
+        "weighted") and the settings that are relevant to it ("ranker",
+        "budget_pct", "budget_unit", "rounds", "seed"), as in sweep.py
+    socket_path : String
+        the Unix socket of the service
+    host : String
+        the host of the service, if it listens on TCP
+    port : int
+        the port of the service, if it listens on TCP
+    timeout : float
+        the number of seconds to wait for the selection (by default, waits indefinitely)
+
+    Returns
+    -------
+    list[int]
+        the sorted indices of the selected lines
+    """
+    if port is not None:
+        connection = socket.create_connection((host or "127.0.0.1", port), timeout=timeout)
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+    with connection:
+        connection.sendall((json.dumps(config) + "\n").encode('utf-8'))
+        with connection.makefile('r', encoding='utf-8') as reader:
+            response = json.loads(reader.readline())
+    if "error" in response:
+        raise Exception(f"Selection failed: {response['error']}")
+    return response["lines"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', "--method", type=str, required=True, choices=["fill_budget", "delfy", "weighted"])
+    parser.add_argument('-p', "--budget_pct", type=float, required=True)
+    parser.add_argument('-u', "--budget_unit", type=str, default="sentence")
+    parser.add_argument('-r', "--ranker", type=str)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument('-s', "--seed", type=int, default=0)
+    parser.add_argument('-o', "--outfile", type=str)
+    parser.add_argument("--socket", type=str, default=SOCKET_PATH)
+    parser.add_argument("--host", type=str)
+    parser.add_argument("--port", type=int)
+    args = parser.parse_args()
+    config = {"method": args.method, "ranker": args.ranker, "budget_pct": args.budget_pct,
+              "budget_unit": args.budget_unit, "rounds": args.rounds, "seed": args.seed}
+    lines = request_selection(config, args.socket, args.host, args.port)
+    if args.outfile is None:
+        for line_num in lines:
+            print(line_num)
+    else:
+        with open(args.outfile, 'w') as writer:
+            for line_num in lines:
+                writer.write(f"{line_num}\n")
@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from selection_client import SOCKET_PATH
+from sweep import METHOD_SETTINGS, SelectionContext, expand_grid, select_lines
+
+_context = None
+
+
+def parse_request(request):
+    """
+    Converts a selection request into a configuration (see sweep.expand_grid).
+
+    Parameters
+    ----------
+    request : dict
+        the method of the selection and its settings
+
+    Returns
+    -------
+    dict
+        the configuration
+    """
+    if request.get("method") not in METHOD_SETTINGS:
+        raise ValueError(f"Unrecognized selection method: {request.get('method')}")
+    config = expand_grid({key: [value] for key, value in request.items()})[0]
+    missing = [key for key, value in config.items() if value is None]
+    if len(missing) > 0:
+        raise ValueError(f"Missing settings for {config['method']}: {', '.join(missing)}")
+    return config
+
+
+def _select(config):
+    return select_lines(_context, config)
+
+
+class SelectionService:
+    """
+    A long-running local service that keeps a SelectionContext (the corpus,
+    its token stores and any constructed rankers, e.g. the SimCSE model and
+    embeddings) in memory, and answers selection requests with line indices.
+
+    Clients send one JSON request per line (see selection_client.py) and get
+    one JSON response per line, either {"lines": [...]} or {"error": "..."}.
+    Requests from different connections are handled concurrently: each one
+    runs in a worker process forked from the warm service (or, with a single
+    worker, in a background thread, one request at a time).
+    """
+
+    def __init__(self, context, num_workers=1):
+        global _context
+        _context = context
+        self.context = context
+        if num_workers > 1:
+            # forked workers inherit the loaded context without copying or pickling it
+            self.executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork"))
+        else:
+            # a single thread, since the selections seed the global random number generators
+            self.executor = ThreadPoolExecutor(1)
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    config = parse_request(json.loads(line))
+                    response = {"lines": await loop.run_in_executor(self.executor, _select, config)}
+                except Exception as e:
+                    response = {"error": f"{type(e).__name__}: {e}"}
+                writer.write((json.dumps(response) + "\n").encode('utf-8'))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=SOCKET_PATH, host=None, port=None, ready=None):
+        """
+        Serves requests until cancelled.
+
+        Parameters
+        ----------
+        socket_path : String
+            the Unix socket to listen on
+        host : String
+            the host to listen on, if listening on TCP
+        port : int
+            the TCP port to listen on (if specified, socket_path is ignored)
+        ready : asyncio.Event or threading.Event
+            if specified, set once the service accepts connections
+        """
+        if port is not None:
+            server = await asyncio.start_server(self.handle, host or "127.0.0.1", port)
+        else:
+            os.makedirs(os.path.dirname(socket_path) or ".", exist_ok=True)
+            if os.path.exists(socket_path):
+                os.remove(socket_path)  # left over from a service that did not shut down cleanly
+            server = await asyncio.start_unix_server(self.handle, socket_path)
+        try:
+            async with server:
+                if ready is not None:
+                    ready.set()
+                await server.serve_forever()
+        finally:
+            if port is None and os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.executor.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', "--coco_eng_path", type=str, required=True)
+    parser.add_argument('-m', "--methods", type=str, nargs="+", default=list(METHOD_SETTINGS),
+                        help="the selection methods to load resources for")
+    parser.add_argument('-r', "--rankers", type=str, nargs="*", default=[],
+                        help="rankers to construct at startup (e.g. simcse), for both budget units")
+    parser.add_argument('-w', "--workers", type=int, default=1)
+    parser.add_argument("--backend", choices=["python", "numpy"], default="numpy")
+    parser.add_argument("--socket", type=str, default=SOCKET_PATH)
+    parser.add_argument("--host", type=str)
+    parser.add_argument("--port", type=int)
+    args = parser.parse_args()
+    context = SelectionContext.load(args.coco_eng_path, set(args.methods), args.backend)
+    for ranker_name in args.rankers:
+        for budget_unit in ["sentence", "token"]:
+            context.ranker(ranker_name, budget_unit)
+    context.line_lengths()
+    service = SelectionService(context, args.workers)
+    print(f"Serving selections on {args.socket if args.port is None else f'port {args.port}'}", flush=True)
+    try:
+        asyncio.run(service.serve(args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -1,6 +1,10 @@
-from simcse import SimCSE
 from random import shuffle
-from ranker import Ranker
+import numpy as np
+import profiling
+from cache import CACHE_DIR, cache_key, lines_hash
+from embedding_cache import cached_embeddings
+from neighbors import nearest_neighbors
+from ranker import Ranker, ranked_indices
 
 class SimCSERanker(Ranker):
     """
@@ -10,51 +14,165 @@ class SimCSERanker(Ranker):
     other sentences, and sorts by a certain criterion. If a sentence budget is
     used, it sorts by length. If a token budget is used, it shuffles (uniform
     random distribution). It returns this as a list in the generated order.
+
+    The sentences are embedded by a SimCSE model, unless another encoder
+    (any object with SimCSE's encode method) is provided as the model. The
+    embedding cache is keyed by model_name, so another encoder can only be
+    used with cache_dir=None (its embeddings are not cached).
+    The nearest neighbors are found by exact search, or, if approximate is
+    set, with an IVF index over the embeddings (see ann_index.py), which is
+    built once per corpus and cached; nlist and nprobe trade its speed for
+    recall.
     """
 
     def __init__(self, all_lines, tiebreaker,
-                 model_name="princeton-nlp/sup-simcse-bert-base-uncased"):
-        self.model = SimCSE(model_name)
-        self.model.build_index(all_lines)
+                 model_name="princeton-nlp/sup-simcse-bert-base-uncased", cache_dir=CACHE_DIR,
+                 block_size=4096, num_threads=1, model=None, approximate=False, nlist=None, nprobe=8):
+        if model is not None and cache_dir is not None:
+            raise ValueError(f"The embeddings of a provided model are not cached under {model_name}: "
+                             f"use cache_dir=None")
+        if model is None:
+            from simcse import SimCSE
+            model = SimCSE(model_name)
+        self.model = model
+        with profiling.phase("simcse.embeddings"):
+            if cache_dir is None:
+                self.embeddings = np.asarray(self.model.encode(all_lines, normalize_to_unit=True, return_numpy=True),
+                                             dtype=np.float32)
+            else:
+                # reuse the memory-mapped embeddings of the corpus instead of re-encoding it
+                self.embeddings = cached_embeddings(self.model, model_name, all_lines, cache_dir)
+        self.index = None
+        if approximate:
+            from ann_index import IVFIndex, cached_ivf_index
+            with profiling.phase("simcse.index"):
+                if cache_dir is None:
+                    self.index = IVFIndex.build(self.embeddings, nlist)
+                else:
+                    self.index = cached_ivf_index(self.embeddings, cache_key(model_name, lines_hash(all_lines)),
+                                                  nlist, cache_dir)
         self.all_lines = all_lines
         self.tiebreaker = tiebreaker
+        self.block_size = block_size
+        self.num_threads = num_threads
+        self.nprobe = nprobe
+        self._line_indices = None
 
-    def rank(self, sents):
+    @property
+    def line_indices(self):
         """
-        Ranks the provided sentences based on the metric attributed to self.
+        Maps each line to all of its line numbers (duplicate lines have
+        several). Built on first use, since ranking all_lines itself does not
+        need it (and all_lines may be a CorpusReader over a large file).
+        """
+        if self._line_indices is None:
+            self._line_indices = dict()
+            for i, line in enumerate(self.all_lines):
+                self._line_indices.setdefault(line, []).append(i)
+        return self._line_indices
+
+    def line_numbers(self, sents):
+        """
+        Finds the line number (in all_lines) of each of the provided
+        sentences. The k-th occurrence of a duplicated sentence is mapped to
+        the k-th line containing it.
 
         Parameters
         ----------
         sents : list[String]
-            the sentences to be ranked using SimCSE
+            the sentences to look up
 
         Returns
         -------
         list[int]
-            the indices of the selected sentences, in order
-        """
-        nonempty_sents = [sent for sent in sents if len(sent) > 0]
-        neighbor_sents = self.model.search(nonempty_sents, threshold=0.0)
-        closests = []
-        for neighbors in neighbor_sents:
-            if len(neighbors) > 1:
-                closests.append(neighbors[1][0])
-        centrality = dict()
+            the line number of each sentence
+        """
+        if sents is self.all_lines:
+            return list(range(len(sents)))
+        occurrences = dict()
+        line_nums = []
         for sent in sents:
-            centrality[sent] = 0
-        for sent in closests:
-            centrality[sent] = 1 + centrality[sent]
-            if centrality[sent] > 2: # treats everything with centrality >= 2 as equal
-                centrality[sent] = 2
-        centrality = list(centrality.items())
+            indices = self.line_indices[sent]
+            k = occurrences.get(sent, 0)
+            line_nums.append(indices[min(k, len(indices) - 1)])
+            occurrences[sent] = k + 1
+        return line_nums
+
+    def closest_lines(self, rows, threshold=0.0):
+        """
+        Finds the nearest neighbor (other than the line itself) of each of
+        the specified lines.
+
+        Parameters
+        ----------
+        rows : np.ndarray
+            the line numbers of the query lines
+        threshold : float
+            neighbors with a similarity below this threshold are ignored
+
+        Returns
+        -------
+        list[int]
+            the line number of each nearest neighbor (lines without a
+            neighbor above the threshold are skipped)
+        """
+        if len(rows) == len(self.embeddings) and np.array_equal(rows, np.arange(len(rows))):
+            queries = self.embeddings  # avoids copying the memory-mapped embeddings
+        else:
+            queries = self.embeddings[rows]
+        profiling.count("simcse.neighbor_queries", len(rows))
+        with profiling.phase("simcse.neighbors"):
+            if self.index is not None:
+                indices, scores = self.index.search(self.embeddings, queries, k=2, nprobe=self.nprobe)
+            else:
+                indices, scores = nearest_neighbors(queries, self.embeddings, k=2,
+                                                    block_size=self.block_size, num_threads=self.num_threads)
+        if indices.shape[1] < 2:
+            return []
+        # the query line is normally its own nearest neighbor
+        is_self = indices[:, 0] == rows
+        closest = np.where(is_self, indices[:, 1], indices[:, 0])
+        closest_scores = np.where(is_self, scores[:, 1], scores[:, 0])
+        # (approximate search may find no neighbor, with index -1)
+        return closest[(closest_scores >= threshold) & (closest >= 0)].tolist()
+
+    def rank(self, sents, limit=None):
+        """
+        Ranks the provided sentences based on the metric attributed to self.
+
+        Parameters
+        ----------
+        sents : list[String]
+            the sentences to be ranked using SimCSE
+        limit : int
+            if specified, at most this many indices are generated
+
+        Returns
+        -------
+        Generator[int]
+            generates the indices of the selected sentences, in order
+        """
+        with profiling.phase("simcse.line_numbers"):
+            line_nums = self.line_numbers(sents)
+        query_rows = np.array([line_num for line_num, sent in zip(line_nums, sents) if len(sent) > 0],
+                              dtype=np.int64)
+        closest_counts = dict()
+        for closest in self.closest_lines(query_rows):
+            sent = self.all_lines[closest]
+            closest_counts[sent] = 1 + closest_counts.get(sent, 0)
+        # treats everything with centrality >= 2 as equal
+        centrality = np.array([min(closest_counts.get(sent, 0), 2) for sent in sents], dtype=np.int64)
         if self.tiebreaker == "random":
-            shuffle(centrality)
+            positions = list(range(len(sents)))
+            shuffle(positions)
+            tiebreak = np.empty(len(sents), dtype=np.int64)
+            tiebreak[positions] = np.arange(len(sents))
         elif self.tiebreaker == "length":
-            centrality.sort(key=lambda x: -len(x[0].split()))
+            tiebreak = -np.fromiter((len(sent.split()) for sent in sents), dtype=np.int64, count=len(sents))
         else:
             raise Exception(f"Unrecognized tiebreaker: {self.tiebreaker}")
-        ranked_sents = [x[0] for x in sorted(centrality, key=lambda x: -x[1])]
-        line_nums = []
-        for sent in ranked_sents:
-            line_nums.append(self.all_lines.index(sent))
-        return line_nums
+        # sorts by decreasing centrality, then by the tiebreaker (then by position)
+        tiebreak -= tiebreak.min(initial=0)
+        keys = (2 - centrality) * (tiebreak.max(initial=0) + 1) + tiebreak
+        for i in ranked_indices(keys, limit):
+            yield line_nums[i]
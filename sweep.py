@@ -0,0 +1,267 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from cocodata import load_coco_english
+from paralleldata import lines_to_exclude
+
+# The settings that are relevant to each selection method (all others are ignored).
+METHOD_SETTINGS = {
+    "fill_budget": ["ranker", "budget_unit", "budget_pct", "seed"],
+    "delfy": ["budget_unit", "budget_pct", "rounds", "seed"],
+    "weighted": ["budget_pct", "seed"],
+}
+
+
+class SelectionContext:
+    """
+    The resources shared by all the selection runs of a sweep: the English
+    training sentences, (memory-mapped) tokenizations of them, and the
+    rankers and line lengths that the runs need. The context is loaded (and,
+    with prepare, its rankers are constructed) once in the parent process and
+    inherited read-only by the forked worker processes, so e.g. the SimCSE
+    model is loaded and the corpus is encoded only once; the token stores and
+    the SimCSE embeddings are memory-mapped files, so the workers share their
+    pages.
+    """
+
+    def __init__(self, lines, token_ids=None, token_pieces=None, backend="numpy"):
+        self.lines = lines
+        self.token_ids = token_ids
+        self.token_pieces = token_pieces
+        self.backend = backend
+        self.rankers = dict()
+        self.lengths = dict()
+
+    @classmethod
+    def load(cls, coco_eng_path, methods, backend="numpy"):
+        """
+        Loads the training split of the coco4mt English data, and the
+        tokenizations needed by the specified selection methods.
+
+        Parameters
+        ----------
+        coco_eng_path : String
+            the path to the eng folder of the coco4mt data in the local directory
+        methods : set[String]
+            the selection methods that will be run
+        backend : String
+            the delfy backend, either "python" or "numpy"
+
+        Returns
+        -------
+        SelectionContext
+            the loaded context
+        """
+        from tokenization import tokenize_file
+        filename = f"{coco_eng_path}/train.txt"
+        token_ids = None
+        token_pieces = None
+        if "delfy" in methods:
+            token_ids = tokenize_file(filename).replace_rows(lines_to_exclude(), [250004, 2])
+        if "weighted" in methods:
+            token_pieces = tokenize_file(filename, store="pieces")
+        return cls(load_coco_english(coco_eng_path, "train"), token_ids, token_pieces, backend)
+
+    def ranker(self, ranker_name, budget_unit):
+        """
+        Returns the ranker with the given name, constructing it the first time
+        it is requested (so that e.g. the SimCSE model is loaded at most once
+        per process).
+        """
+        key = (ranker_name, budget_unit)
+        if key not in self.rankers:
+            if ranker_name == "weighted" and self.token_pieces is not None:
+                from baselines import WeightedRandomRanker
+                self.rankers[key] = WeightedRandomRanker(lengths=self.token_pieces.lengths())
+            else:
+                from fill_budget import lookup_ranker
+                self.rankers[key] = lookup_ranker(ranker_name, budget_unit, self.lines)
+        return self.rankers[key]
+
+    def prepare(self, configs):
+        """
+        Constructs the rankers and computes the line lengths that the
+        provided configurations need, so that worker processes forked
+        afterwards inherit them rather than each building its own.
+
+        Parameters
+        ----------
+        configs : list[dict]
+            the configurations that will be run (see expand_grid)
+        """
+        for config in configs:
+            if config["method"] == "fill_budget":
+                self.ranker(config["ranker"], config["budget_unit"])
+                if config["budget_unit"] == "token":
+                    self.line_lengths()
+
+    def line_lengths(self, length_unit="whitespace"):
+        """
+        Returns the number of tokens in every line, computing it the first
+        time it is requested.
+        """
+        if length_unit not in self.lengths:
+            from fill_budget import candidate_lengths
+            self.lengths[length_unit] = candidate_lengths(self.lines, length_unit)
+        return self.lengths[length_unit]
+
+
+def expand_grid(grid):
+    """
+    Expands a grid of settings (a dictionary from each setting to a list of
+    values) into the list of distinct configurations. Settings that are not
+    relevant to a method are dropped from its configurations.
+
+    Parameters
+    ----------
+    grid : dict
+        maps "method", "ranker", "budget_pct", "budget_unit", "rounds" and
+        "seed" to lists of values
+
+    Returns
+    -------
+    list[dict]
+        the configurations, in a deterministic order
+    """
+    keys = ["method"] + sorted(key for key in grid if key != "method")
+    configs = []
+    for values in itertools.product(*[grid[key] for key in keys]):
+        setting = dict(zip(keys, values))
+        method = setting["method"]
+        if method not in METHOD_SETTINGS:
+            raise ValueError(f"Unrecognized selection method: {method}")
+        config = {"method": method}
+        for key in METHOD_SETTINGS[method]:
+            config[key] = setting.get(key, 0 if key == "seed" else None)
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def config_filename(config):
+    """
+    Returns the deterministic name of the line file of a configuration, e.g.
+    "delfy-token-p0.2-r20-s0.txt".
+    """
+    fields = [config["method"]]
+    for key in METHOD_SETTINGS[config["method"]]:
+        value = config[key]
+        if key == "budget_pct":
+            fields.append(f"p{value}")
+        elif key == "rounds":
+            fields.append(f"r{value}")
+        elif key == "seed":
+            fields.append(f"s{value}")
+        else:
+            fields.append(str(value))
+    return "-".join(fields) + ".txt"
+
+
+def select_lines(context, config):
+    """
+    Runs the selection method of a configuration.
+
+    Parameters
+    ----------
+    context : SelectionContext
+        the shared corpus and tokenizations
+    config : dict
+        the configuration (see expand_grid)
+
+    Returns
+    -------
+    list[int]
+        the sorted indices of the selected lines
+    """
+    random.seed(config["seed"])
+    np.random.seed(config["seed"])
+    if config["method"] == "fill_budget":
+        from fill_budget import fill_budget
+        ranker = context.ranker(config["ranker"], config["budget_unit"])
+        lengths = context.line_lengths() if config["budget_unit"] == "token" else None
+        lines = fill_budget(ranker, context.lines, config["budget_pct"], config["budget_unit"], lengths=lengths)
+    elif config["method"] == "delfy":
+        from delfy import run_delfy
+        lines = run_delfy(context.token_ids, config["budget_pct"], config["budget_unit"],
+                          config["rounds"], context.backend)
+    else:
+        from sample_weighted import weighted_sample
+        lines = weighted_sample(context.token_pieces, config["budget_pct"], config["seed"])
+    return sorted(lines)
+
+
+_context = None
+
+
+def _run_config(config, out_dir):
+    path = os.path.join(out_dir, config_filename(config))
+    lines = select_lines(_context, config)
+    with open(path, 'w') as writer:
+        for line in lines:
+            writer.write(f"{line}\n")
+    return path
+
+
+def run_sweep(context, configs, out_dir, num_workers=1):
+    """
+    Runs every configuration across a pool of worker processes and writes the
+    selected lines of each one to out_dir/config_filename(config).
+
+    Parameters
+    ----------
+    context : SelectionContext
+        the shared corpus and tokenizations
+    configs : list[dict]
+        the configurations to run
+    out_dir : String
+        the directory for the line files
+    num_workers : int
+        the number of worker processes
+
+    Returns
+    -------
+    list[String]
+        the line files, in the order of configs
+    """
+    global _context
+    _context = context
+    os.makedirs(out_dir, exist_ok=True)
+    context.prepare(configs)
+    if num_workers <= 1:
+        paths = []
+        for config in configs:
+            paths.append(_run_config(config, out_dir))
+            print(paths[-1])
+        return paths
+    # forked workers inherit the context without copying or pickling it
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = {executor.submit(_run_config, config, out_dir): i for i, config in enumerate(configs)}
+        paths = [None] * len(configs)
+        for future in as_completed(futures):
+            paths[futures[future]] = future.result()
+            print(paths[futures[future]])
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', "--coco_eng_path", type=str, required=True)
+    parser.add_argument('-g', "--grid", type=str, required=True,
+                        help='JSON file mapping each setting to a list of values, e.g. '
+                             '{"method": ["delfy"], "budget_pct": [0.1, 0.2], "budget_unit": ["token"], '
+                             '"rounds": [20], "seed": [0]}')
+    parser.add_argument('-o', "--out_dir", type=str, default=".")
+    parser.add_argument('-w', "--workers", type=int, default=1)
+    parser.add_argument("--backend", choices=["python", "numpy"], default="numpy")
+    args = parser.parse_args()
+    with open(args.grid) as reader:
+        grid = json.load(reader)
+    configs = expand_grid(grid)
+    context = SelectionContext.load(args.coco_eng_path, set(grid["method"]), args.backend)
+    run_sweep(context, configs, args.out_dir, args.workers)
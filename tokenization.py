@@ -0,0 +1,171 @@
+import json
+import os
+import shutil
+import tempfile
+from itertools import chain, islice
+import numpy as np
+
+import profiling
+from cache import CACHE_DIR, cache_key, file_hash, lines_hash
+from tokenmatrix import TokenMatrix
+
+MODEL_CHECKPOINT = "facebook/mbart-large-50-many-to-many-mmt"
+
+_tokenizers = dict()
+
+
+def load_tokenizer(model_checkpoint=MODEL_CHECKPOINT):
+    """
+    Returns the (fast) tokenizer for the specified checkpoint. Each tokenizer
+    is only loaded once per process.
+
+    Parameters
+    ----------
+    model_checkpoint : String
+        the name of the checkpoint whose tokenizer should be loaded
+
+    Returns
+    -------
+    PreTrainedTokenizerFast
+        the tokenizer
+    """
+    if model_checkpoint not in _tokenizers:
+        from transformers import AutoTokenizer
+        _tokenizers[model_checkpoint] = AutoTokenizer.from_pretrained(model_checkpoint, use_fast=True)
+    return _tokenizers[model_checkpoint]
+
+
+def tokenize_file(filename, model_checkpoint=MODEL_CHECKPOINT, store="ids",
+                  cache_dir=CACHE_DIR, batch_size=10000):
+    """
+    Returns the tokenized lines of the provided file as a TokenMatrix. The
+    token ids are cached on disk (keyed by the file contents, the checkpoint
+    and the store type), so repeated calls on the same file skip tokenization
+    and memory-map the cached ids instead.
+
+    Parameters
+    ----------
+    filename : String
+        the name of the file containing the lines to tokenize
+    model_checkpoint : String
+        the checkpoint whose tokenizer should be used
+    store : String
+        "ids" for the input ids (including the special tokens), or "pieces"
+        for the sentence pieces only (as returned by tokenizer.tokenize)
+    cache_dir : String
+        the root directory of the cache
+    batch_size : int
+        the number of lines to tokenize in each call to the tokenizer
+
+    Returns
+    -------
+    TokenMatrix
+        the tokenized lines
+    """
+    key = cache_key(file_hash(filename), model_checkpoint, store)
+
+    def read_lines():
+        with open(filename) as reader:
+            for line in reader:
+                yield line.strip()
+
+    return _cached_token_matrix(key, read_lines, model_checkpoint, store, cache_dir, batch_size)
+
+
+def tokenize_lines(lines, model_checkpoint=MODEL_CHECKPOINT, store="ids",
+                   cache_dir=CACHE_DIR, batch_size=10000):
+    """
+    Returns the provided lines, tokenized, as a TokenMatrix. Works like
+    tokenize_file, but the cache is keyed by the lines themselves.
+
+    Parameters
+    ----------
+    lines : list[String]
+        the lines to tokenize
+    model_checkpoint : String
+        the checkpoint whose tokenizer should be used
+    store : String
+        "ids" for the input ids (including the special tokens), or "pieces"
+        for the sentence pieces only (as returned by tokenizer.tokenize)
+    cache_dir : String
+        the root directory of the cache
+    batch_size : int
+        the number of lines to tokenize in each call to the tokenizer
+
+    Returns
+    -------
+    TokenMatrix
+        the tokenized lines
+    """
+    key = cache_key(lines_hash(lines), model_checkpoint, store)
+    return _cached_token_matrix(key, lambda: (line.strip() for line in lines),
+                                model_checkpoint, store, cache_dir, batch_size)
+
+
+def _cached_token_matrix(key, read_lines, model_checkpoint, store, cache_dir, batch_size):
+    if store not in ["ids", "pieces"]:
+        raise ValueError(f"Only stores 'ids' and 'pieces' are accepted: {store}")
+    store_dir = os.path.join(cache_dir, "tokens", key)
+    if not os.path.exists(store_dir):
+        profiling.count("tokenization.cache_misses")
+        with profiling.phase("tokenization"):
+            matrix = _tokenize_batched(read_lines(), model_checkpoint, store, batch_size)
+            _save_token_matrix(matrix, store_dir, {"checkpoint": model_checkpoint, "store": store})
+        profiling.count("tokenization.lines", len(matrix))
+    else:
+        profiling.count("tokenization.cache_hits")
+    return load_token_matrix(store_dir)
+
+
+def _tokenize_batched(lines, model_checkpoint, store, batch_size):
+    tokenizer = load_tokenizer(model_checkpoint)
+    id_chunks = []
+    offsets = [np.zeros(1, dtype=np.int64)]
+    total = 0
+    while True:
+        batch = list(islice(lines, batch_size))
+        if len(batch) == 0:
+            break
+        encoded = tokenizer(batch, add_special_tokens=(store == "ids"))['input_ids']
+        lengths = np.fromiter((len(ids) for ids in encoded), dtype=np.int64, count=len(encoded))
+        id_chunks.append(np.fromiter(chain.from_iterable(encoded), dtype=np.int32, count=int(lengths.sum())))
+        offsets.append(total + np.cumsum(lengths))
+        total += int(lengths.sum())
+    ids = np.concatenate(id_chunks) if len(id_chunks) > 0 else np.zeros(0, dtype=np.int32)
+    return TokenMatrix(ids, np.concatenate(offsets), len(tokenizer))
+
+
+def _save_token_matrix(matrix, store_dir, metadata):
+    os.makedirs(os.path.dirname(store_dir), exist_ok=True)
+    # write to a temporary directory first, so that concurrent runs never see a partial store
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(store_dir))
+    np.save(os.path.join(tmp_dir, "ids.npy"), matrix.ids)
+    np.save(os.path.join(tmp_dir, "offsets.npy"), matrix.offsets)
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as writer:
+        json.dump(dict(metadata, vocab_size=matrix.vocab_size), writer)
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        # another process stored the same corpus first
+        shutil.rmtree(tmp_dir)
+
+
+def load_token_matrix(store_dir):
+    """
+    Memory-maps a token store written by tokenize_file or tokenize_lines.
+
+    Parameters
+    ----------
+    store_dir : String
+        the directory of the token store
+
+    Returns
+    -------
+    TokenMatrix
+        the tokenized lines
+    """
+    with open(os.path.join(store_dir, "meta.json")) as reader:
+        metadata = json.load(reader)
+    ids = np.load(os.path.join(store_dir, "ids.npy"), mmap_mode='r')
+    offsets = np.load(os.path.join(store_dir, "offsets.npy"), mmap_mode='r')
+    return TokenMatrix(ids, offsets, metadata["vocab_size"])
@@ -0,0 +1,131 @@
+import numpy as np
+
+
+class TokenMatrix:
+    """
+    A tokenized corpus stored in compressed sparse row form: the token ids of
+    every sentence are concatenated into a single int32 array, and sentence i
+    occupies ids[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, ids, offsets, vocab_size=None):
+        self.ids = ids
+        self.offsets = offsets
+        if vocab_size is None:
+            vocab_size = int(ids.max()) + 1 if len(ids) > 0 else 0
+        self.vocab_size = vocab_size
+
+    @classmethod
+    def from_lists(cls, tokenized_sents):
+        """
+        Builds a TokenMatrix from a list of tokenized sentences. Tokens are
+        identified by their string form (as in DecayLogFrequency) and mapped
+        to dense ids in order of first appearance.
+
+        Parameters
+        ----------
+        tokenized_sents : list[list[String]]
+            a list of all sentences, each organized as a list of tokens
+
+        Returns
+        -------
+        TokenMatrix
+            the tokenized sentences, in compressed sparse row form
+        """
+        vocab = dict()
+        ids = []
+        offsets = np.zeros(len(tokenized_sents) + 1, dtype=np.int64)
+        for i, sent in enumerate(tokenized_sents):
+            for tok in sent:
+                ids.append(vocab.setdefault(str(tok), len(vocab)))
+            offsets[i + 1] = len(ids)
+        return cls(np.array(ids, dtype=np.int32), offsets, len(vocab))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def tolist(self):
+        """
+        Returns the tokenized sentences as a list of lists of token ids.
+
+        Returns
+        -------
+        list[list[int]]
+            the tokenized sentences
+        """
+        return [sent.tolist() for sent in self]
+
+    def lengths(self):
+        """
+        Returns the number of tokens in every sentence.
+
+        Returns
+        -------
+        np.ndarray
+            the sentence lengths, as an int64 array
+        """
+        return np.diff(self.offsets)
+
+    def gather(self, rows):
+        """
+        Concatenates the token ids of the specified sentences.
+
+        Parameters
+        ----------
+        rows : np.ndarray
+            the indices of the sentences to gather, in the desired order
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+            the concatenated token ids, and for every token the position
+            (in rows) of the sentence it came from
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        total = int(lengths.sum())
+        positions = np.repeat(np.arange(len(rows)), lengths)
+        # index of each token within its own sentence
+        within = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return self.ids[starts[positions] + within], positions
+
+    def replace_rows(self, rows, tokens):
+        """
+        Returns a copy of this matrix in which each of the specified
+        sentences is replaced by the provided tokens.
+
+        Parameters
+        ----------
+        rows : Iterable[int]
+            the indices of the sentences to replace
+        tokens : list[int]
+            the token ids that replace each of the sentences
+
+        Returns
+        -------
+        TokenMatrix
+            the updated matrix
+        """
+        replaced = np.zeros(len(self), dtype=bool)
+        replaced[np.fromiter(rows, dtype=np.int64)] = True
+        old_lengths = self.lengths()
+        new_lengths = np.where(replaced, len(tokens), old_lengths)
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(new_lengths, out=offsets[1:])
+        ids = np.empty(offsets[-1], dtype=np.int32)
+        kept = np.flatnonzero(~replaced)
+        kept_ids, positions = self.gather(kept)
+        within = np.arange(len(kept_ids)) - np.repeat(np.cumsum(old_lengths[kept]) - old_lengths[kept],
+                                                      old_lengths[kept])
+        ids[offsets[kept][positions] + within] = kept_ids
+        replaced_rows = np.flatnonzero(replaced)
+        ids[(offsets[replaced_rows][:, None] + np.arange(len(tokens))).ravel()] = np.tile(tokens, len(replaced_rows))
+        return TokenMatrix(ids, offsets, max(self.vocab_size, max(tokens, default=-1) + 1))
@@ -1,93 +1,219 @@
 from paralleldata import coco_data
+from langcodes import code3, code5
 from transformers import DataCollatorForSeq2Seq
 from transformers import Seq2SeqTrainingArguments, Seq2SeqTrainer
 from transformers import MBartForConditionalGeneration, MBart50TokenizerFast
+from datasets import DatasetDict, load_from_disk
+from batching import TokenBudgetBatchSampler, example_lengths, padding_fraction
 import evaluate
 import numpy as np
+import shutil
 import sys
 import os
+import tempfile
+from cache import CACHE_DIR, array_hash, cache_key
 os.environ["TOKENIZERS_PARALLELISM"] = "false" # suppresses a transformers warning
 
-def train(src, tgt, line_file, evaluation_split="validation"):
+MODEL_CHECKPOINT = "facebook/mbart-large-50-many-to-many-mmt"
+
+# The langs_model dictionary names the trained model of each language pair.
+langs_model = {
+    "en": {"de": "eng-deu", "id": "eng-ind", "ko": "eng-kor", "fr": "eng-fra", "my": "eng-mya", "gu": "eng-guj"},
+    "de": {"en": "deu-eng", "id": "deu-ind", "ko": "deu-kor", "fr": "deu-fra", "my": "deu-mya", "gu": "deu-guj"},
+    "id": {"en": "ind-eng", "de": "ind-deu", "ko": "ind-kor", "fr": "ind-fra", "my": "ind-mya", "gu": "ind-guj"},
+    "ko": {"en": "kor-eng", "de": "kor-deu", "id": "kor-ind", "fr": "kor-fra", "my": "kor-mya", "gu": "kor-guj"},
+    "fr": {"en": "fra-eng", "de": "fra-deu", "id": "fra-ind", "ko": "fra-kor", "my": "fra-mya", "gu": "fra-guj"},
+    "my": {"en": "mya-eng", "de": "mya-deu", "id": "mya-ind", "ko": "mya-kor", "fr": "mya-fra", "gu": "mya-guj"},
+    "gu": {"en": "guj-eng", "de": "guj-deu", "id": "guj-ind", "ko": "guj-kor", "fr": "guj-fra", "my": "guj-mya"}
+}
+
+
+def read_line_file(line_file):
     """
-    Trains the mbart-large-50-many-to-many-mmt checkpoint given a source
-    language, target language, file to take sentences from, and evalutation
-    split from the coco4mt data. Expects ISO 639-1 language codes
-    (e.g.: "en") for src and tgt.
+    Reads the indices of the selected sentences from a lines file.
 
     Parameters
     ----------
-    src : String
-        the source language. Expects the standard two-letter code.
-    tgt : String
-        the target language. Expects the standard two-letter code.
     line_file : String
-        the name of the file containing the indices of the sentences from the coco4mt data for training
-    evaluation_split : String
-        the split of the coco4mt data to be used ("train", "validation", or "test")
+        the name of the file containing the indices (one per line)
+
+    Returns
+    -------
+    set[int]
+        the indices of the selected sentences
     """
     lines = set()
     with open(line_file) as reader:
         for line in reader:
             line = int(line.strip())
             lines.add(line)
+    return lines
+
+
+def tokenized_splits(src, tgt, tokenizer, lines=None, model_checkpoint=MODEL_CHECKPOINT,
+                     max_length=128, cache_dir=CACHE_DIR):
+    """
+    Returns the tokenized splits of the coco4mt data for a language pair.
+    The full tokenized splits are cached on disk (keyed by the language pair,
+    the tokenizer checkpoint and max_length), and the training subset for a
+    set of lines is selected from the fully tokenized train split (the rows
+    of each line set are cached as well, keyed by its hash), so nothing is
+    re-tokenized when training on a new line file.
+
+    Parameters
+    ----------
+    src : String
+        the source language. Expects the standard two-letter code.
+    tgt : String
+        the target language. Expects the standard two-letter code.
+    tokenizer : MBart50TokenizerFast
+        the tokenizer, with src_lang and tgt_lang already set
+    lines : Iterable[int]
+        if specified, the lines to include in the train split
+    model_checkpoint : String
+        the checkpoint of the tokenizer (part of the cache key)
+    max_length : int
+        the maximum number of tokens in the inputs and labels
+    cache_dir : String
+        the root directory of the cache
+
+    Returns
+    -------
+    DatasetDict
+        the tokenized train, validation and test splits
+    """
+    tokenized_dir = os.path.join(cache_dir, "tokenized", cache_key(src, tgt, model_checkpoint, max_length))
+    if not os.path.exists(tokenized_dir):
+
+        def preprocess_function(examples):
+            """
+            Enables the tokenizer.
+            """
+            inputs = [ex[code3[src]] for ex in examples["translation"]]
+            targets = [ex[code3[tgt]] for ex in examples["translation"]]
+            model_inputs = tokenizer(
+                inputs, text_target=targets, max_length=max_length, truncation=True
+            )
+            return model_inputs
+
+        split_datasets = coco_data(src, tgt)
+        tokenized = split_datasets.map(
+            preprocess_function,
+            batched=True,
+            remove_columns=["translation"],
+        )
+        os.makedirs(os.path.dirname(tokenized_dir), exist_ok=True)
+        # write to a temporary directory first, so that concurrent runs never load a partial cache
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(tokenized_dir))
+        tokenized.save_to_disk(tmp_dir)
+        try:
+            os.rename(tmp_dir, tokenized_dir)
+        except OSError:
+            # another process cached the same splits first
+            shutil.rmtree(tmp_dir)
+    tokenized = load_from_disk(tokenized_dir)
+    train_ds = tokenized["train"]
+    if lines is not None:
+        selected = np.unique(np.fromiter(lines, dtype=np.int64))
+        rows_file = os.path.join(tokenized_dir, "subsets", f"{array_hash(selected)}.npy")
+        if not os.path.exists(rows_file):
+            ids = train_ds.data.column("id").to_numpy()
+            os.makedirs(os.path.dirname(rows_file), exist_ok=True)
+            # write to a temporary file first, so that concurrent runs never load a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(rows_file), suffix=".tmp")
+            with os.fdopen(fd, 'wb') as writer:
+                np.save(writer, np.flatnonzero(np.isin(ids, selected)))
+            os.replace(tmp_path, rows_file)
+        train_ds = train_ds.select(np.load(rows_file))
+    result = DatasetDict()
+    result["train"] = train_ds.remove_columns("id")
+    result["validation"] = tokenized["validation"].remove_columns("id")
+    result["test"] = tokenized["test"].remove_columns("id")
+    return result
+
+
+class BucketedSeq2SeqTrainer(Seq2SeqTrainer):
+    """
+    A Seq2SeqTrainer that batches examples of similar length together, with
+    the size of each batch capped by a token budget (max_tokens) instead of a
+    fixed number of examples, for both training and (generation-based)
+    evaluation. Prints the padding fraction of the batches.
+    """
+
+    def __init__(self, *args, max_tokens=4096, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens = max_tokens
+
+    def get_train_dataloader(self):
+        return self.bucketed_dataloader(self.train_dataset, shuffle=True, description="training")
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+        return self.bucketed_dataloader(eval_dataset, shuffle=False, description="evaluation")
 
-    # The code3, code5, and langs_model dictionaries allow for standard language inputs.
-    code3 = {
-        "en": "eng",
-        "de": "deu",
-        "id": "ind",
-        "ko": "kor",
-        "fr": "fra",
-        "my": "mya",
-        "gu": "guj"
-    }
-    code5 = {
-        "en": "en_XX",
-        "de": "de_DE",
-        "id": "id_ID",
-        "ko": "ko_KR",
-        "fr": "fr_XX",
-        "my": "my_MM",
-        "gu": "gu_IN"
-    }
-    langs_model = {
-        "en": {"de": "eng-deu", "id": "eng-ind", "ko": "eng-kor", "fr": "eng-fra", "my": "eng-mya", "gu": "eng-guj"},
-        "de": {"en": "deu-eng", "id": "deu-ind", "ko": "deu-kor", "fr": "deu-fra", "my": "deu-mya", "gu": "deu-guj"},
-        "id": {"en": "ind-eng", "de": "ind-deu", "ko": "ind-kor", "fr": "ind-fra", "my": "ind-mya", "gu": "ind-guj"},
-        "ko": {"en": "kor-eng", "de": "kor-deu", "id": "kor-ind", "fr": "kor-fra", "my": "kor-mya", "gu": "kor-guj"},
-        "fr": {"en": "fra-eng", "de": "fra-deu", "id": "fra-ind", "ko": "fra-kor", "my": "fra-mya", "gu": "fra-guj"},
-        "my": {"en": "mya-eng", "de": "mya-deu", "id": "mya-ind", "ko": "mya-kor", "fr": "mya-fra", "gu": "mya-guj"},
-        "gu": {"en": "guj-eng", "de": "guj-deu", "id": "guj-ind", "ko": "guj-kor", "fr": "guj-fra", "my": "guj-mya"}
-    }
-    split_datasets = coco_data(src, tgt, lines)
-    model_checkpoint = "facebook/mbart-large-50-many-to-many-mmt"
-    tokenizer = MBart50TokenizerFast.from_pretrained(model_checkpoint, return_tensors="pt")
-    tokenizer.src_lang = code5[src]
-    tokenizer.tgt_lang = code5[tgt]
-    max_length = 128
-
-    def preprocess_function(examples):
+    def bucketed_dataloader(self, dataset, shuffle, description):
         """
-        Enables the tokenizer.
+        Returns a DataLoader over the dataset that uses a TokenBudgetBatchSampler.
         """
-        inputs = [ex[code3[src]] for ex in examples["translation"]]
-        targets = [ex[code3[tgt]] for ex in examples["translation"]]
-        model_inputs = tokenizer(
-            inputs, text_target=targets, max_length=max_length, truncation=True
-        )
-        return model_inputs
-
-    tokenized_datasets = split_datasets.map(
-        preprocess_function,
-        batched=True,
-        remove_columns=split_datasets["train"].column_names,
-    )
-    model = MBartForConditionalGeneration.from_pretrained(model_checkpoint)
-    data_collator = DataCollatorForSeq2Seq(tokenizer, model=model)
-    metric = evaluate.load("sacrebleu")
-
-    def compute_metrics(eval_preds):
+        from torch.utils.data import DataLoader
+        dataset = self._remove_unused_columns(dataset, description=description)
+        lengths = example_lengths(dataset)
+        sampler = TokenBudgetBatchSampler(lengths.max(axis=1), self.max_tokens, shuffle=shuffle,
+                                          seed=self.args.seed)
+        print(f"Padding fraction ({description}): {padding_fraction(lengths, sampler.batches):.3f} "
+              f"in {len(sampler)} batches")
+        dataloader = DataLoader(dataset, batch_sampler=sampler, collate_fn=self.data_collator,
+                                num_workers=self.args.dataloader_num_workers,
+                                pin_memory=self.args.dataloader_pin_memory)
+        return self.accelerator.prepare(dataloader)
+
+
+class TrainingSession:
+    """
+    The resources shared by a sequence of training runs: the tokenizer, the
+    sacrebleu metric, and a single copy of the model, together with its
+    pristine (pretrained) weights, which are restored before every run. This
+    allows many (src, tgt, line_file) jobs to be trained one after another in
+    a single process without reloading the checkpoint for each of them. An
+    already loaded model and tokenizer can be provided instead of loading
+    them from model_checkpoint.
+    """
+
+    def __init__(self, model_checkpoint=MODEL_CHECKPOINT, max_length=128, model=None, tokenizer=None):
+        self.model_checkpoint = model_checkpoint
+        self.max_length = max_length
+        if tokenizer is None:
+            tokenizer = MBart50TokenizerFast.from_pretrained(model_checkpoint, return_tensors="pt")
+        self.tokenizer = tokenizer
+        if model is None:
+            model = MBartForConditionalGeneration.from_pretrained(model_checkpoint)
+        self.model = model
+        # tied weights (e.g. the shared embeddings and lm_head) are copied once
+        copies = dict()
+        self.base_weights = dict()
+        for name, tensor in self.model.state_dict().items():
+            key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+            if key not in copies:
+                copies[key] = tensor.detach().to("cpu", copy=True)
+            self.base_weights[name] = copies[key]
+        self._metric = None
+
+    @property
+    def metric(self):
+        """
+        The sacrebleu metric, loaded the first time it is used.
+        """
+        if self._metric is None:
+            self._metric = evaluate.load("sacrebleu")
+        return self._metric
+
+    def reset_model(self):
+        """
+        Restores the pretrained weights of the model.
+        """
+        self.model.load_state_dict(self.base_weights)
+
+    def compute_metrics(self, eval_preds):
         """
         Sets up and evaluates with BLEU given a list of predictions.
 
@@ -101,6 +227,7 @@ def train(src, tgt, line_file, evaluation_split="validation"):
         dict
             shows the BLEU score
         """
+        tokenizer = self.tokenizer
         preds, labels = eval_preds
         # In case the model returns more than the prediction logits
         if isinstance(preds, tuple):
@@ -112,44 +239,153 @@ def train(src, tgt, line_file, evaluation_split="validation"):
         # Some simple post-processing
         decoded_preds = [pred.strip() for pred in decoded_preds]
         decoded_labels = [[label.strip()] for label in decoded_labels]
-        result = metric.compute(predictions=decoded_preds, references=decoded_labels)
+        result = self.metric.compute(predictions=decoded_preds, references=decoded_labels)
         return {"bleu": result["score"]}
 
-    prefix_fields = line_file.split(".")
-    prefix = '.'.join(prefix_fields[:-1])
-    model_dir = f'{langs_model[src][tgt]}-{prefix}'
-    args = Seq2SeqTrainingArguments(
-        model_dir,
-        evaluation_strategy="no",
-        save_strategy="epoch",
-        learning_rate=2e-5,
-        per_device_train_batch_size=32,
-        per_device_eval_batch_size=32,
-        weight_decay=0.01,
-        save_total_limit=3,
-        num_train_epochs=3,
-        predict_with_generate=True,
-        fp16=True,
-        push_to_hub=True,
-    )
-    trainer = Seq2SeqTrainer(
-        model,
-        args,
-        train_dataset=tokenized_datasets["train"],
-        eval_dataset=tokenized_datasets[evaluation_split],
-        data_collator=data_collator,
-        tokenizer=tokenizer,
-        compute_metrics=compute_metrics,
-    )
-    trainer.train(resume_from_checkpoint=(evaluation_split=="test"))
-    print(f"After training ({model_dir}):")
-    results = trainer.evaluate(max_length=max_length)
-    print(results)
-    with open(f"bleu.{evaluation_split}.{model_dir}", "w") as writer:
-        writer.write(f"{results['eval_bleu']}\n")
-    if evaluation_split == "validation":
-        trainer.push_to_hub(tags="translation", commit_message="Training complete")
+    def train(self, src, tgt, line_file, evaluation_split="validation"):
+        """
+        Trains the pretrained checkpoint on the specified lines of the coco4mt
+        data for a language pair, evaluates it, and writes the BLEU score to
+        bleu.{evaluation_split}.{model_dir}.
+
+        Parameters
+        ----------
+        src : String
+            the source language. Expects the standard two-letter code.
+        tgt : String
+            the target language. Expects the standard two-letter code.
+        line_file : String
+            the name of the file containing the indices of the sentences from the coco4mt data for training
+        evaluation_split : String
+            the split of the coco4mt data to be used ("train", "validation", or "test")
+
+        Returns
+        -------
+        dict
+            the evaluation results
+        """
+        lines = read_line_file(line_file)
+        tokenizer = self.tokenizer
+        tokenizer.src_lang = code5[src]
+        tokenizer.tgt_lang = code5[tgt]
+        max_length = self.max_length
+        tokenized_datasets = tokenized_splits(src, tgt, tokenizer, lines, self.model_checkpoint, max_length)
+        self.reset_model()
+        data_collator = DataCollatorForSeq2Seq(tokenizer, model=self.model)
+        prefix_fields = line_file.split(".")
+        prefix = '.'.join(prefix_fields[:-1])
+        model_dir = f'{langs_model[src][tgt]}-{prefix}'
+        args = Seq2SeqTrainingArguments(
+            model_dir,
+            evaluation_strategy="no",
+            save_strategy="epoch",
+            learning_rate=2e-5,
+            per_device_train_batch_size=32,
+            per_device_eval_batch_size=32,
+            weight_decay=0.01,
+            save_total_limit=3,
+            num_train_epochs=3,
+            predict_with_generate=True,
+            fp16=True,
+            push_to_hub=True,
+        )
+        trainer = BucketedSeq2SeqTrainer(
+            self.model,
+            args,
+            train_dataset=tokenized_datasets["train"],
+            eval_dataset=tokenized_datasets[evaluation_split],
+            data_collator=data_collator,
+            tokenizer=tokenizer,
+            compute_metrics=self.compute_metrics,
+            max_tokens=32 * max_length,
+        )
+        trainer.train(resume_from_checkpoint=(evaluation_split=="test"))
+        print(f"After training ({model_dir}):")
+        results = trainer.evaluate(max_length=max_length)
+        print(results)
+        with open(f"bleu.{evaluation_split}.{model_dir}", "w") as writer:
+            writer.write(f"{results['eval_bleu']}\n")
+        if evaluation_split == "validation":
+            trainer.push_to_hub(tags="translation", commit_message="Training complete")
+        return results
+
+
+def train(src, tgt, line_file, evaluation_split="validation"):
+    """
+    Trains the mbart-large-50-many-to-many-mmt checkpoint given a source
+    language, target language, file to take sentences from, and evalutation
+    split from the coco4mt data. Expects ISO 639-1 language codes
+    (e.g.: "en") for src and tgt.
+
+    Parameters
+    ----------
+    src : String
+        the source language. Expects the standard two-letter code.
+    tgt : String
+        the target language. Expects the standard two-letter code.
+    line_file : String
+        the name of the file containing the indices of the sentences from the coco4mt data for training
+    evaluation_split : String
+        the split of the coco4mt data to be used ("train", "validation", or "test")
+    """
+    TrainingSession().train(src, tgt, line_file, evaluation_split)
+
+
+def read_manifest(manifest_file):
+    """
+    Reads a manifest of training jobs. Each non-empty line of the manifest
+    describes one job as whitespace-separated fields:
+
+        [source language] [target language] [lines file] [evaluation split (optional)]
+
+    Lines starting with "#" are ignored.
+
+    Parameters
+    ----------
+    manifest_file : String
+        the name of the manifest file
+
+    Returns
+    -------
+    list[tuple]
+        the (src, tgt, line_file, evaluation_split) of every job, in order
+    """
+    jobs = []
+    with open(manifest_file) as reader:
+        for line_number, line in enumerate(reader, start=1):
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith("#"):
+                continue
+            if len(fields) not in (3, 4):
+                raise ValueError(f"Line {line_number} of {manifest_file} should have 3 or 4 fields: {line.strip()}")
+            src, tgt = fields[0], fields[1]
+            if src not in langs_model or tgt not in langs_model[src]:
+                raise ValueError(f"Unsupported language pair on line {line_number} of {manifest_file}: {src}-{tgt}")
+            evaluation_split = fields[3] if len(fields) == 4 else "validation"
+            jobs.append((src, tgt, fields[2], evaluation_split))
+    return jobs
+
+
+def train_manifest(manifest_file):
+    """
+    Runs every job of a manifest (see read_manifest) one after another in a
+    single TrainingSession, so the checkpoint, tokenizer and metric are only
+    loaded once.
+
+    Parameters
+    ----------
+    manifest_file : String
+        the name of the manifest file
+    """
+    jobs = read_manifest(manifest_file)
+    session = TrainingSession()
+    for i, (src, tgt, line_file, evaluation_split) in enumerate(jobs):
+        print(f"Job {i + 1}/{len(jobs)}: {src}-{tgt} {line_file} ({evaluation_split})")
+        session.train(src, tgt, line_file, evaluation_split)
 
 
 if __name__ == "__main__":
-    train(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
\ No newline at end of file
+    if len(sys.argv) == 3 and sys.argv[1] == "--manifest":
+        train_manifest(sys.argv[2])
+    else:
+        train(*sys.argv[1:5])
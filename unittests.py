@@ -1,7 +1,106 @@
 import unittest
-from delfy import run_delfy
-from fill_budget import fill_sentence_budget, fill_token_budget, lookup_ranker
+import asyncio
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import numpy as np
+from delfy import run_delfy, DelfyState, DecayLogFrequency, VectorizedDelfyState, VectorizedDecayLogFrequency
+from fill_budget import fill_lengths, fill_sentence_budget, fill_token_budget, lookup_ranker
+from baselines import LengthRanker, WeightedRandomRanker
+import paralleldata
 from simcse_rankers import SimCSERanker
+from ranker import ranked_indices
+from tokenization import tokenize_lines
+from tokenmatrix import TokenMatrix
+from embedding_cache import cached_embeddings, line_hashes
+from neighbors import nearest_neighbors
+from ann_index import IVFIndex, recall_report
+from cache import cache_key
+from corpusreader import CorpusReader, line_offsets
+from batching import TokenBudgetBatchSampler, padding_fraction
+from benchmarks import StubEncoder, SyntheticCorpus, run_benchmarks
+import profiling
+from sample_weighted import run_trials, weighted_sample, weighted_samples
+from sweep import SelectionContext, config_filename, expand_grid, run_sweep
+from selection_client import request_selection
+from selection_service import SelectionService, parse_request
+from training import TrainingSession, read_manifest, tokenized_splits
+from evaluation import cached_hypotheses, checkpoint_fingerprint
+
+
+class OriginalDecayLogFrequency:
+    """A frozen copy of the original (per-round) delfy algorithm, used as a reference."""
+
+    def __init__(self, sentences, selected, budget, budget_unit):
+        self.sentences = sentences
+        self.unselected = set([i for i in range(len(sentences)) if i not in selected])
+        self.selected = selected
+        self.unselected_tok_counts = self.token_count(self.unselected)
+        self.selected_tok_counts = self.token_count(self.selected)
+        self.uhat_tok_counts = dict()
+        self.budget = budget
+        self.budget_unit = budget_unit
+        self.swugwu = 0
+        for w in self.unselected_tok_counts:
+            self.swugwu += np.log(self.unselected_tok_counts[w] + 1)
+
+    def run(self):
+        lf_slist = list(self.unselected)
+        lf_slist.sort(key=lambda sent_index: self.score(sent_index, False), reverse=True)
+        delfy_scores = {}
+        for sent_index in lf_slist:
+            delfy_scores[sent_index] = self.score(sent_index, True)
+            for tok in self.token_count([sent_index]):
+                self.uhat_tok_counts[tok] = 1 + self.uhat_tok_counts.get(tok, 0)
+        lf_slist.sort(key=lambda i: delfy_scores[i], reverse=True)
+        new_selected = set()
+        selected_count = 0
+        for sent_index in lf_slist:
+            if selected_count >= self.budget:
+                break
+            length = len(self.sentences[sent_index]) if self.budget_unit == "token" else 1
+            if self.budget_unit == "sentence" or selected_count + length < self.budget:
+                new_selected.add(sent_index)
+                selected_count += length
+        return new_selected
+
+    def score(self, sentence_index, decay_uhat):
+        sentence = self.sentences[sentence_index]
+        if len(sentence) == 0:
+            return 0
+        score = 0
+        for tok in sentence:
+            fwu = np.log(self.unselected_tok_counts[str(tok)] + 1) / self.swugwu
+            decay = np.exp(-1.0 * self.selected_tok_counts.get(str(tok), 0))
+            if decay_uhat:
+                score += fwu * (decay * np.exp(-1.0 * self.uhat_tok_counts.get(str(tok), 0)))
+            else:
+                score += fwu * decay
+        return score / len(sentence)
+
+    def token_count(self, sentence_indices):
+        result = dict()
+        for sent_index in sentence_indices:
+            for tok in self.sentences[sent_index]:
+                result[str(tok)] = result.get(str(tok), 0) + 1
+        return result
+
+
+def original_run_delfy(sents, budget_percentage, budget_unit, num_rounds):
+    """The original run_delfy, which recounts the tokens of the corpus every round."""
+    total = sum(len(s) for s in sents) if budget_unit == "token" else len(sents)
+    total_budget = int(budget_percentage * total)
+    selected = set()
+    for i in range(1, num_rounds + 1):
+        budget = i * total_budget // num_rounds - (i - 1) * total_budget // num_rounds
+        if budget_unit == "token" and i == num_rounds:
+            budget = total_budget - sum(len(sents[s]) for s in selected)
+        selected |= OriginalDecayLogFrequency(sents, selected, budget, budget_unit).run()
+    return selected
 
 
 class TestDelfy(unittest.TestCase):
@@ -78,7 +177,104 @@ class TestDelfy(unittest.TestCase):
         sent_ids = run_delfy(sents, budget_percentage=0.4, budget_unit="sentence", num_rounds=2)
         self.assertEqual({0, 2}, sent_ids)
 
-        
+    def test_state_select(self):
+        sents = [['a', 'b', 'c', 'b', 'a', 'a'],
+                 ['b', 'd', 'c', 'a'],
+                 ['a', 'a', 'd'],
+                 ['a', 'e', 'a', 'a', 'b']]
+        state = DelfyState(sents)
+        state.select({0, 2})
+        recount = DecayLogFrequency(sents, {0, 2}, 1, "sentence")
+        self.assertEqual(recount.token_count([1, 3]), state.unselected_tok_counts)
+        self.assertEqual(recount.token_count([0, 2]), state.selected_tok_counts)
+        self.assertEqual(9, state.selected_tok_count)
+
+    def test_numpy_backend(self):
+        sents = [['a', 'a', 'a', 'b', 'b'],
+                 ['b', 'c', 'a', 'a', 'b', 'a'],
+                 ['a', 'a', 'd', 'b'],
+                 ['c', 'c', 'd', 'a', 'b', 'd'],
+                 ['a', 'a', 'e', 'a']]
+        for budget_unit in ["sentence", "token"]:
+            expected = run_delfy(sents, budget_percentage=0.4, budget_unit=budget_unit, num_rounds=2)
+            sent_ids = run_delfy(sents, budget_percentage=0.4, budget_unit=budget_unit, num_rounds=2,
+                                 backend="numpy")
+            self.assertEqual(expected, sent_ids)
+
+    def test_matches_original(self):
+        # many of the sentences are permutations of earlier ones, so their scores are tied
+        rng = random.Random(0)
+        for _ in range(40):
+            vocab = [str(tok) for tok in range(rng.randint(3, 15))]
+            sents = []
+            for _ in range(rng.randint(5, 60)):
+                if len(sents) > 0 and rng.random() < 0.4:
+                    sent = rng.choice(sents)
+                    sents.append(rng.sample(sent, len(sent)))
+                else:
+                    sents.append([rng.choice(vocab) for _ in range(rng.randint(0, 8))])
+            budget_pct = rng.choice([0.1, 0.3, 0.5])
+            budget_unit = rng.choice(["sentence", "token"])
+            num_rounds = rng.randint(1, 5)
+            expected = original_run_delfy(sents, budget_pct, budget_unit, num_rounds)
+            for backend in ["python", "numpy"]:
+                self.assertEqual(expected, run_delfy(sents, budget_pct, budget_unit, num_rounds, backend))
+
+    def test_scores_match_bitwise(self):
+        # the vectorized scores add the same terms in the same order as the reference ones
+        rng = random.Random(1)
+        sents = [[rng.randrange(40) for _ in range(rng.randint(0, 12))] for _ in range(200)]
+        selected = set(rng.sample(range(200), 30))
+        state = DelfyState(sents)
+        state.select(selected)
+        reference = DecayLogFrequency(sents, state.selected, 20, "sentence", state)
+        vectorized_state = VectorizedDelfyState(TokenMatrix.from_lists(sents))
+        vectorized_state.select(selected)
+        vectorized = VectorizedDecayLogFrequency(vectorized_state, 20, "sentence", batch_size=37)
+        lf_order = vectorized.unselected[np.argsort(-vectorized.lf(vectorized.unselected), kind="stable")]
+        expected_lf, expected_delfy = [], []
+        for sent_index in lf_order.tolist():
+            expected_lf.append(reference.lf(sent_index))
+            expected_delfy.append(reference.delfy(sent_index))
+            for tok in reference.token_count([sent_index]):
+                reference.uhat_tok_counts[tok] = 1 + reference.uhat_tok_counts.get(tok, 0)
+        self.assertTrue(np.array_equal(expected_lf, vectorized.lf(lf_order)))
+        self.assertTrue(np.array_equal(expected_delfy, vectorized.delfy(lf_order)))
+
+    def test_checkpoint_resume(self):
+        class Interrupted(Exception):
+            pass
+
+        class InterruptAfterRound(profiling.Metrics):
+            def round(self, **info):
+                super().round(**info)
+                if info["round"] == 3:
+                    raise Interrupted()
+
+        sents = SyntheticCorpus(300, vocab_size=200, seed=3).tokens
+        checkpoint_dir = tempfile.mkdtemp()
+        try:
+            for backend in ["python", "numpy"]:
+                expected = run_delfy(sents, 0.3, "token", 5, backend)
+                checkpoint = os.path.join(checkpoint_dir, f"{backend}.npz")
+                with self.assertRaises(Interrupted):
+                    run_delfy(sents, 0.3, "token", 5, backend, metrics=InterruptAfterRound(),
+                              checkpoint=checkpoint, checkpoint_every=2)
+                metrics = profiling.Metrics()
+                self.assertEqual(expected, run_delfy(sents, 0.3, "token", 5, backend, metrics=metrics,
+                                                     checkpoint=checkpoint, checkpoint_every=2))
+                # resumes after round 2, the last one saved before the interruption
+                self.assertEqual(2, metrics.counters["delfy.rounds_resumed"])
+                self.assertEqual([3, 4, 5], [info["round"] for info in metrics.rounds])
+                self.assertRaises(ValueError, run_delfy, sents, 0.2, "token", 5, backend, checkpoint=checkpoint)
+                # a different corpus with the same number of sentences and tokens
+                swapped = TokenMatrix(sents.ids[::-1].copy(), sents.offsets, sents.vocab_size)
+                self.assertRaises(ValueError, run_delfy, swapped, 0.3, "token", 5, backend, checkpoint=checkpoint)
+                self.assertRaises(ValueError, run_delfy, sents, 0.3, "token", 5, backend,
+                                  checkpoint=os.path.join(checkpoint_dir, "never.npz"), checkpoint_every=0)
+        finally:
+            shutil.rmtree(checkpoint_dir)
+
 
 
 class TestFillBudget(unittest.TestCase):
@@ -101,11 +297,577 @@ class TestFillBudget(unittest.TestCase):
         sent_ids = fill_token_budget(ranker, self.mitt, 37)
         self.assertEqual([4, 0, 3], sent_ids)
 
+    def test_ranker_registry(self):
+        self.assertEqual([4, 0], fill_sentence_budget(lookup_ranker("length", "sentence", self.mitt), self.mitt, 2))
+        with self.assertRaises(Exception):
+            lookup_ranker("simcse", "sentence")
+        with self.assertRaises(Exception):
+            lookup_ranker("unknown", "sentence", self.mitt)
+        # the ranker modules are only imported when a ranker is requested
+        code = "import sys, fill_budget; print(sorted(m for m in ['baselines', 'simcse_rankers'] if m in sys.modules))"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual("[]", output.strip())
+
+    def test_fill_budget_best_fit(self):
+        ranker = lookup_ranker("length", "token")
+        sent_ids = fill_token_budget(ranker, self.mitt, 35)
+        self.assertEqual([4, 0], sent_ids)
+        sent_ids = fill_token_budget(ranker, self.mitt, 35, fill="best_fit")
+        self.assertEqual([4, 0, 2], sent_ids)
+
+    def test_fill_lengths(self):
+        lengths = [3, 0, 5, 1, 4]
+        ranking = iter([2, 4, 0, 1, 3])
+        self.assertEqual([2], fill_lengths(ranking, lengths, 9))
+        self.assertEqual([2, 0, 1], fill_lengths([2, 4, 0, 1, 3], lengths, 9, fill="best_fit"))
+        self.assertEqual([], fill_lengths([2, 4, 0, 1, 3], lengths, 0))
+
     def test_fill_budget3(self):
         ranker = lookup_ranker("weighted", "token")
         weights = ranker.get_weights(self.mitt)
         self.assertEqual([0.17647058823529413, 0.10294117647058823, 0.11764705882352941, 0.22058823529411764, 0.38235294117647056], weights)
 
+    def test_fill_budget_weighted(self):
+        ranker = WeightedRandomRanker(lengths=[12, 7, 8, 15, 26], rng=0)
+        self.assertEqual(list(range(5)), sorted(ranker.rank(self.mitt)))
+        sent_ids = fill_sentence_budget(ranker, self.mitt, 2)
+        self.assertEqual(2, len(set(sent_ids)))
+        sent_ids = fill_token_budget(ranker, self.mitt, 20)
+        self.assertLess(sum(len(self.mitt[i].split()) for i in sent_ids), 20)
+
+
+class TestRanker(unittest.TestCase):
+
+    def test_ranked_indices(self):
+        keys = np.random.default_rng(0).integers(0, 5, 100)
+        expected = np.argsort(keys, kind="stable").tolist()
+        self.assertEqual(expected, list(ranked_indices(keys, chunk_size=3)))
+        self.assertEqual(expected[:10], list(ranked_indices(keys, limit=10, chunk_size=3)))
+        self.assertEqual([], list(ranked_indices(keys, limit=0)))
+
+    def test_length_ranker_limit(self):
+        sents = ['a b', 'a b c', 'a', 'a b c', '']
+        self.assertEqual([1, 3, 0, 2, 4], list(LengthRanker().rank(sents)))
+        self.assertEqual([1, 3], list(LengthRanker().rank(sents, limit=2)))
+
+
+class TestWeightedSample(unittest.TestCase):
+
+    def test_weighted_sample(self):
+        sents = [['a'] * length for length in [3, 0, 5, 1, 0, 2, 4, 4, 1, 2]]
+        sample = weighted_sample(sents, 0.5, rng=7)
+        self.assertEqual(5, len(sample))
+        self.assertEqual(sorted(set(sample)), sample)
+        self.assertNotIn(1, sample)
+        self.assertNotIn(4, sample)
+        self.assertEqual(sample, weighted_sample(sents, 0.5, rng=7))
+
+    def test_weighted_samples(self):
+        lengths = np.array([1, 2, 3, 4, 5, 6, 7, 8, 1, 1])
+        samples = weighted_samples(lengths, 3, num_trials=4000, rng=0, max_keys=1000)
+        self.assertEqual((4000, 3), samples.shape)
+        self.assertTrue(np.all(samples[:, 1:] > samples[:, :-1]))
+        inclusion = np.bincount(samples.ravel(), minlength=10) / 4000
+        # longer sentences are more likely to be included
+        self.assertTrue(np.all(np.diff(inclusion[:8]) > 0))
+
+    def test_run_trials(self):
+        out_dir = tempfile.mkdtemp()
+        lengths = np.arange(1, 101)
+        samples = []
+        for num_workers in [1, 3]:
+            pattern = os.path.join(out_dir, f"{num_workers}.wsample.{{}}.txt")
+            filenames = run_trials(lengths, 0.2, 5, seed=42, num_workers=num_workers, out_pattern=pattern)
+            trials = []
+            for filename in filenames:
+                with open(filename) as reader:
+                    trials.append([int(line) for line in reader])
+            samples.append(trials)
+        shutil.rmtree(out_dir)
+        self.assertEqual(samples[0], samples[1])
+        self.assertTrue(all(len(trial) == 20 for trial in samples[0]))
+        self.assertNotEqual(samples[0][0], samples[0][1])
+
+
+class TestBatching(unittest.TestCase):
+
+    def setUp(self):
+        self.lengths = np.random.default_rng(0).integers(1, 128, size=1000)
+
+    def test_token_budget(self):
+        sampler = TokenBudgetBatchSampler(self.lengths, 512, shuffle=True, seed=3, pool_size=200)
+        batches = list(sampler)
+        self.assertEqual(list(range(1000)), sorted(i for batch in batches for i in batch))
+        for batch in batches:
+            self.assertLessEqual(len(batch) * self.lengths[batch].max(), 512)
+        self.assertNotEqual(batches, list(sampler))
+        again = TokenBudgetBatchSampler(self.lengths, 512, shuffle=True, seed=3, pool_size=200)
+        self.assertEqual(batches, list(again))
+
+    def test_padding_fraction(self):
+        sampler = TokenBudgetBatchSampler(self.lengths, 512, shuffle=False)
+        fixed = [list(range(start, start + 8)) for start in range(0, 1000, 8)]
+        self.assertLess(padding_fraction(self.lengths, sampler.batches), padding_fraction(self.lengths, fixed))
+        self.assertEqual(0.0, padding_fraction([3, 3, 3], [[0, 1], [2]]))
+        self.assertAlmostEqual(0.2, padding_fraction([[1, 2], [3, 2]], [[0, 1]]))
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.mitt = ['My favorite meat is hot dog, by the way.',
+                     'That is my favorite meat.',
+                     'My second favorite meat is hamburger.',
+                     "And, everyone says, oh, don't you prefer steak?",
+                     "It's like, I know steaks are great, but I like hot dog best, and I like hamburger next best."]
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_expand_grid(self):
+        grid = {"method": ["delfy", "weighted"], "budget_pct": [0.1, 0.2], "rounds": [5],
+                "budget_unit": ["token"], "seed": [0]}
+        names = [config_filename(config) for config in expand_grid(grid)]
+        self.assertEqual(["delfy-token-p0.1-r5-s0.txt", "delfy-token-p0.2-r5-s0.txt",
+                          "weighted-p0.1-s0.txt", "weighted-p0.2-s0.txt"], names)
+
+    def test_run_sweep(self):
+        context = SelectionContext(self.mitt)
+        configs = expand_grid({"method": ["fill_budget"], "ranker": ["length"], "budget_pct": [0.4],
+                               "budget_unit": ["sentence", "token"]})
+        paths = run_sweep(context, configs, self.out_dir, num_workers=2)
+        with open(paths[0]) as reader:
+            self.assertEqual(["0", "4"], reader.read().split())
+        self.assertEqual("fill_budget-length-token-p0.4-s0.txt", os.path.basename(paths[1]))
+        # the rankers and lengths are built before forking, and shared by the workers
+        self.assertEqual({("length", "sentence"), ("length", "token")}, set(context.rankers))
+        self.assertIn("whitespace", context.lengths)
+
+
+class TestSelectionService(unittest.TestCase):
+
+    def setUp(self):
+        mitt = ['My favorite meat is hot dog, by the way.',
+                'That is my favorite meat.',
+                'My second favorite meat is hamburger.',
+                "And, everyone says, oh, don't you prefer steak?",
+                "It's like, I know steaks are great, but I like hot dog best, and I like hamburger next best."]
+        self.socket_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.socket_dir, "selection.sock")
+        self.service = SelectionService(SelectionContext(mitt))
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.task = self.loop.create_task(self.service.serve(self.socket_path, ready=ready))
+        self.thread = threading.Thread(target=self.run_service)
+        self.thread.start()
+        ready.wait(10)
+
+    def run_service(self):
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join()
+        self.loop.close()
+        shutil.rmtree(self.socket_dir)
+
+    def test_parse_request(self):
+        config = parse_request({"method": "weighted", "budget_pct": 0.2, "ranker": "length"})
+        self.assertEqual({"method": "weighted", "budget_pct": 0.2, "seed": 0}, config)
+        with self.assertRaises(ValueError):
+            parse_request({"method": "delfy", "budget_pct": 0.2})
+
+    def test_request_selection(self):
+        config = {"method": "fill_budget", "ranker": "length", "budget_pct": 0.4, "budget_unit": "sentence"}
+        self.assertEqual([0, 4], request_selection(config, self.socket_path))
+        with self.assertRaises(Exception):
+            request_selection(dict(config, ranker="unknown"), self.socket_path)
+        self.assertEqual([0, 4], request_selection(config, self.socket_path))
+
+
+class TestCorpusReader(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.cache_dir, "lines.txt")
+        with open(self.filename, 'w', encoding='utf-8') as writer:
+            writer.write(" first line \n\nthird \u00e9\r\nlast")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_corpus_reader(self):
+        lines = CorpusReader(self.filename, self.cache_dir)
+        self.assertEqual(["first line", "", "third \u00e9", "last"], list(lines))
+        self.assertEqual(4, len(lines))
+        self.assertEqual("last", lines[-1])
+        self.assertEqual(["last", "first line"], lines[np.array([3, 0])])
+        self.assertEqual(["", "last"], lines[1::2])
+        self.assertRaises(IndexError, lambda: lines[4])
+        # the offsets are cached, and the cached copy is reused
+        self.assertEqual(1, len(os.listdir(os.path.join(self.cache_dir, "line_offsets"))))
+        self.assertEqual(list(lines), list(CorpusReader(self.filename, self.cache_dir)))
+
+    def test_corpus_reader_trailing_newline(self):
+        for contents, expected in [("", []), ("\n", [""]), ("a\nb\n", ["a", "b"])]:
+            with open(self.filename, 'w') as writer:
+                writer.write(contents)
+            self.assertEqual(expected, list(CorpusReader(self.filename, None)))
+
+    def test_corpus_reader_universal_newlines(self):
+        # lines end as in text-mode open(), also when a "\r\n" is split between chunks
+        contents = "one two\rthree\nfour\r\n\r\rfive\r\n\nsix\r"
+        with open(self.filename, 'w', newline='') as writer:
+            writer.write(contents)
+        with open(self.filename) as reader:
+            expected = [line.strip() for line in reader]
+        self.assertEqual(["one two", "three", "four", "", "", "five", "", "six"], expected)
+        self.assertEqual(expected, list(CorpusReader(self.filename, None)))
+        for chunk_size in range(1, len(contents) + 1):
+            self.assertTrue(np.array_equal(line_offsets(self.filename), line_offsets(self.filename, chunk_size)))
+
+
+class TestCocoData(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        for lang, dataset in paralleldata.coco_datasets.items():
+            lang_dir = f"{self.data_dir}/coco4mt-shared-task/{dataset}/{lang}"
+            os.makedirs(lang_dir)
+            for filename in ["train", "dev", "test"]:
+                with open(f"{lang_dir}/{filename}.txt", 'w') as writer:
+                    for i in range(6):
+                        empty = (lang == "deu" and i == 1) or (lang == "eng" and i == 4)
+                        writer.write("\n" if empty else f" {lang} {filename} {i} \n")
+        self.saved = paralleldata.DATA_DIR, paralleldata.COCO_STORE_DIR
+        paralleldata.DATA_DIR = self.data_dir
+        paralleldata.COCO_STORE_DIR = os.path.join(self.data_dir, "store")
+
+    def tearDown(self):
+        paralleldata.DATA_DIR, paralleldata.COCO_STORE_DIR = self.saved
+        shutil.rmtree(self.data_dir)
+
+    def test_coco_data(self):
+        data = paralleldata.coco_data("en", "de", lines={0, 1, 2, 4})
+        self.assertEqual([0, 2], data["train"]["id"])
+        self.assertEqual({"eng": "eng train 2", "deu": "deu train 2"}, data["train"]["translation"][1])
+        self.assertEqual([0, 2, 3, 5], data["validation"]["id"])
+        self.assertEqual("deu test 5", data["test"]["translation"][-1]["deu"])
+
+    def test_coco_store(self):
+        paralleldata.coco_data("fr", "gu")
+        table = paralleldata.load_coco_split("train", ["kor"])
+        self.assertEqual(["kor", "kor_empty"], table.column_names)
+        self.assertEqual(6, table.num_rows)
+        # editing a text file rebuilds the store
+        dataset = paralleldata.coco_datasets["kor"]
+        with open(f"{self.data_dir}/coco4mt-shared-task/{dataset}/kor/train.txt", 'w') as writer:
+            writer.writelines(f"edited kor {i}\n" for i in range(6))
+        self.assertEqual("edited kor 5", paralleldata.load_coco_split("train", ["kor"]).column("kor")[-1].as_py())
+        self.assertEqual("edited kor 5", paralleldata.coco_data("ko", "en")["train"]["translation"][-1]["kor"])
+
+    def test_line_mask(self):
+        mask = paralleldata.line_mask(5, [3, 0, 3, 7])
+        self.assertEqual([True, False, False, True, False], mask.tolist())
+        self.assertTrue(paralleldata.line_mask(3).all())
+
+
+def write_coco_data(data_dir):
+    """Writes six numbered lines for every split of every language (line 1 is missing in German)."""
+    for lang, dataset in paralleldata.coco_datasets.items():
+        lang_dir = f"{data_dir}/coco4mt-shared-task/{dataset}/{lang}"
+        os.makedirs(lang_dir)
+        for filename in ["train", "dev", "test"]:
+            with open(f"{lang_dir}/{filename}.txt", 'w') as writer:
+                for i in range(6):
+                    writer.write("\n" if lang == "deu" and i == 1 else f"{lang} {i}\n")
+
+
+class TestTraining(unittest.TestCase):
+
+    def setUp(self):
+        from tokenizers import Tokenizer, models, pre_tokenizers
+        from transformers import PreTrainedTokenizerFast
+        self.data_dir = tempfile.mkdtemp()
+        write_coco_data(self.data_dir)
+        self.saved = paralleldata.DATA_DIR, paralleldata.COCO_STORE_DIR
+        paralleldata.DATA_DIR = self.data_dir
+        paralleldata.COCO_STORE_DIR = os.path.join(self.data_dir, "store")
+        words = ["<unk>", "eng", "deu"] + [str(i) for i in range(6)]
+        tokenizer = Tokenizer(models.WordLevel({w: i for i, w in enumerate(words)}, unk_token="<unk>"))
+        tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        self.tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>")
+        self.cache_dir = os.path.join(self.data_dir, "cache")
+
+    def tearDown(self):
+        paralleldata.DATA_DIR, paralleldata.COCO_STORE_DIR = self.saved
+        shutil.rmtree(self.data_dir)
+
+    def test_tokenized_splits(self):
+        splits = tokenized_splits("en", "de", self.tokenizer, lines={0, 1, 3}, model_checkpoint="words",
+                                  cache_dir=self.cache_dir)
+        # line 1 has no German translation
+        self.assertEqual([[1, 3], [1, 6]], splits["train"]["input_ids"])
+        self.assertEqual([[2, 3], [2, 6]], splits["train"]["labels"])
+        self.assertEqual(5, len(splits["validation"]))
+        tokenized_dir = os.path.join(self.cache_dir, "tokenized")
+        subsets_dir = os.path.join(tokenized_dir, os.listdir(tokenized_dir)[0], "subsets")
+        self.assertEqual(1, len(os.listdir(subsets_dir)))
+        # the cached splits and rows are reused (and another line set gets its own rows)
+        again = tokenized_splits("en", "de", self.tokenizer, lines=[3, 0, 1], model_checkpoint="words",
+                                 cache_dir=self.cache_dir)
+        self.assertEqual(splits["train"]["input_ids"], again["train"]["input_ids"])
+        everything = tokenized_splits("en", "de", self.tokenizer, model_checkpoint="words", cache_dir=self.cache_dir)
+        self.assertEqual(5, len(everything["train"]))
+        self.assertEqual(1, len(os.listdir(subsets_dir)))
+        tokenized_splits("en", "de", self.tokenizer, lines={5}, model_checkpoint="words", cache_dir=self.cache_dir)
+        self.assertEqual(2, len(os.listdir(subsets_dir)))
+
+    def test_read_manifest(self):
+        manifest = os.path.join(self.data_dir, "manifest.txt")
+        with open(manifest, 'w') as writer:
+            writer.write("# src tgt lines [split]\n\nen de delfy.txt\n  ko fr simcse.txt test  \n")
+        self.assertEqual([("en", "de", "delfy.txt", "validation"), ("ko", "fr", "simcse.txt", "test")],
+                         read_manifest(manifest))
+        for bad_line in ["en de\n", "en de delfy.txt test extra\n", "en xx delfy.txt\n", "en en delfy.txt\n"]:
+            with open(manifest, 'w') as writer:
+                writer.write("en fr lines.txt\n" + bad_line)
+            with self.assertRaises(ValueError) as context:
+                read_manifest(manifest)
+            self.assertIn("line 2", str(context.exception).lower())
+
+    def test_reset_model(self):
+        import torch
+        from transformers import MBartConfig, MBartForConditionalGeneration
+        torch.manual_seed(0)
+        config = MBartConfig(vocab_size=len(self.tokenizer), d_model=8, encoder_layers=1, decoder_layers=1,
+                             encoder_attention_heads=1, decoder_attention_heads=1, encoder_ffn_dim=8,
+                             decoder_ffn_dim=8, max_position_embeddings=16)
+        session = TrainingSession(model=MBartForConditionalGeneration(config), tokenizer=self.tokenizer)
+        original = {name: tensor.clone() for name, tensor in session.model.state_dict().items()}
+        # the tied embeddings are copied once
+        self.assertIs(session.base_weights["model.shared.weight"], session.base_weights["lm_head.weight"])
+        self.assertIs(session.base_weights["model.shared.weight"],
+                      session.base_weights["model.encoder.embed_tokens.weight"])
+        optimizer = torch.optim.SGD(session.model.parameters(), lr=1.0)
+        batch = torch.tensor([[1, 3, 4]])
+        session.model(input_ids=batch, labels=batch).loss.backward()
+        optimizer.step()
+        self.assertFalse(all(torch.equal(original[name], tensor)
+                             for name, tensor in session.model.state_dict().items()))
+        session.reset_model()
+        for name, tensor in session.model.state_dict().items():
+            self.assertTrue(torch.equal(original[name], tensor), name)
+        self.assertEqual(session.model.model.shared.weight.data_ptr(), session.model.lm_head.weight.data_ptr())
+
+
+class TestEvaluation(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        write_coco_data(self.data_dir)
+        self.saved = paralleldata.DATA_DIR, paralleldata.COCO_STORE_DIR
+        paralleldata.DATA_DIR = self.data_dir
+        paralleldata.COCO_STORE_DIR = os.path.join(self.data_dir, "store")
+        self.checkpoint = os.path.join(self.data_dir, "checkpoint")
+        os.makedirs(self.checkpoint)
+        with open(os.path.join(self.checkpoint, "config.json"), 'w') as writer:
+            writer.write('{"d_model": 8}')
+        self.write_weights(b"weights")
+        self.cache_dir = os.path.join(self.data_dir, "cache")
+        self.generated = []
+
+    def tearDown(self):
+        paralleldata.DATA_DIR, paralleldata.COCO_STORE_DIR = self.saved
+        shutil.rmtree(self.data_dir)
+
+    def write_weights(self, weights):
+        with open(os.path.join(self.checkpoint, "model.safetensors"), 'wb') as writer:
+            writer.write(weights)
+
+    def generate(self, checkpoint, sources, src, tgt, max_length, num_beams, max_tokens):
+        """A stand-in for checkpoint_translations that records its calls."""
+        self.generated.append((checkpoint, src, tgt, num_beams))
+        return [source.replace("eng", tgt) for source in sources]
+
+    def test_checkpoint_fingerprint(self):
+        fingerprint = checkpoint_fingerprint(self.checkpoint)
+        self.assertEqual(fingerprint, checkpoint_fingerprint(self.checkpoint))
+        # retraining into the same directory changes the weights
+        self.write_weights(b"retrained weights")
+        self.assertNotEqual(fingerprint, checkpoint_fingerprint(self.checkpoint))
+        # a checkpoint that is not a local directory is identified by its name
+        self.assertEqual("facebook/mbart-large-50", checkpoint_fingerprint("facebook/mbart-large-50"))
+
+    def test_cached_hypotheses(self):
+        hypotheses, references = cached_hypotheses(self.checkpoint, "en", "de", cache_dir=self.cache_dir,
+                                                   generate=self.generate)
+        # line 1 has no German translation
+        self.assertEqual(["de 0", "de 2", "de 3", "de 4", "de 5"], hypotheses)
+        self.assertEqual(["deu 0", "deu 2", "deu 3", "deu 4", "deu 5"], references)
+        self.assertEqual(1, len(self.generated))
+        # scoring again reuses the cached translations
+        self.assertEqual(hypotheses, cached_hypotheses(self.checkpoint, "en", "de", cache_dir=self.cache_dir,
+                                                       generate=self.generate)[0])
+        self.assertEqual(1, len(self.generated))
+        # other generation settings, splits and retrained weights are generated again
+        cached_hypotheses(self.checkpoint, "en", "de", num_beams=4, cache_dir=self.cache_dir, generate=self.generate)
+        cached_hypotheses(self.checkpoint, "en", "de", "test", cache_dir=self.cache_dir, generate=self.generate)
+        self.write_weights(b"retrained weights")
+        cached_hypotheses(self.checkpoint, "en", "de", cache_dir=self.cache_dir, generate=self.generate)
+        self.assertEqual(4, len(self.generated))
+        self.assertEqual(4, len(os.listdir(os.path.join(self.cache_dir, "hypotheses"))))
+
+
+class TestTokenization(unittest.TestCase):
+
+    def setUp(self):
+        from tokenizers import Tokenizer, models, pre_tokenizers
+        from transformers import PreTrainedTokenizerFast
+        words = ["<unk>", "my", "favorite", "meat", "is", "hot", "dog"]
+        tokenizer = Tokenizer(models.WordLevel({w: i for i, w in enumerate(words)}, unk_token="<unk>"))
+        tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        self.checkpoint = tempfile.mkdtemp()
+        PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>").save_pretrained(self.checkpoint)
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.checkpoint, ignore_errors=True)
+        shutil.rmtree(self.cache_dir)
+
+    def test_tokenize_lines(self):
+        lines = ["my favorite meat", "", "hot dog is my favorite", "hamburger"]
+        matrix = tokenize_lines(lines, self.checkpoint, "pieces", self.cache_dir, batch_size=3)
+        self.assertEqual([[1, 2, 3], [], [5, 6, 4, 1, 2], [0]], matrix.tolist())
+        self.assertEqual([3, 0, 5, 1], matrix.lengths().tolist())
+
+    def test_cached(self):
+        lines = ["my favorite meat", "hot dog"]
+        tokenize_lines(lines, self.checkpoint, "pieces", self.cache_dir)
+        shutil.rmtree(self.checkpoint)
+        # the checkpoint is gone, so this only works if the cached store is used
+        matrix = tokenize_lines(lines, self.checkpoint, "pieces", self.cache_dir)
+        self.assertEqual([[1, 2, 3], [5, 6]], matrix.tolist())
+        self.assertEqual(1, len(os.listdir(os.path.join(self.cache_dir, "tokens"))))
+
+
+class CountingEncoder:
+    """A small stand-in for SimCSE that embeds a sentence by its character counts."""
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, sents, batch_size=64, normalize_to_unit=True, return_numpy=True):
+        self.encoded.extend(sents)
+        vectors = np.array([[sent.count(c) for c in "aeiou"] for sent in sents], dtype=np.float32) + 1
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_reuse(self):
+        encoder = CountingEncoder()
+        lines = ["my favorite meat", "is hot dog", "by the way"]
+        first = cached_embeddings(encoder, "counting", lines, self.cache_dir)
+        self.assertEqual(lines, encoder.encoded)
+        again = cached_embeddings(encoder, "counting", lines, self.cache_dir)
+        self.assertEqual(3, len(encoder.encoded))
+        self.assertTrue(np.array_equal(first, again))
+        changed = ["my favorite meat", "is hamburger", "by the way", "is hot dog"]
+        embeddings = cached_embeddings(encoder, "counting", changed, self.cache_dir)
+        self.assertEqual(lines + ["is hamburger"], encoder.encoded)
+        self.assertTrue(np.allclose(CountingEncoder().encode(changed), embeddings))
+
+    def test_orphan_hashes(self):
+        # a build that was killed before its embeddings were saved
+        model_dir = os.path.join(self.cache_dir, "embeddings", cache_key("counting"))
+        os.makedirs(model_dir)
+        np.save(os.path.join(model_dir, "orphan.hashes.npy"), line_hashes(["is hot dog"]))
+        encoder = CountingEncoder()
+        embeddings = cached_embeddings(encoder, "counting", ["is hot dog", "by the way"], self.cache_dir)
+        self.assertEqual(["is hot dog", "by the way"], encoder.encoded)
+        self.assertTrue(np.allclose(CountingEncoder().encode(["is hot dog", "by the way"]), embeddings))
+
+    def test_empty_corpus(self):
+        embeddings = cached_embeddings(CountingEncoder(), "counting", [], self.cache_dir)
+        self.assertEqual((0, CountingEncoder().encode(["a"]).shape[1]), embeddings.shape)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "embeddings")))
+
+
+class TestNearestNeighbors(unittest.TestCase):
+
+    def test_matches_full_search(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(50, 8)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        expected = np.argsort(-(vectors @ vectors.T), axis=1, kind="stable")[:, :3]
+        for block_size, num_threads in [(7, 1), (50, 1), (16, 3)]:
+            indices, scores = nearest_neighbors(vectors, k=3, block_size=block_size, num_threads=num_threads)
+            self.assertTrue(np.array_equal(expected, indices))
+            self.assertTrue(np.all(scores[:, :-1] >= scores[:, 1:]))
+            self.assertTrue(np.array_equal(np.arange(50), indices[:, 0]))
+
+
+class TestAnnIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(10, 8))
+        self.vectors = (centers[rng.integers(0, 10, 400)] + 0.3 * rng.normal(size=(400, 8))).astype(np.float32)
+        self.vectors /= np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        self.index = IVFIndex.build(self.vectors, nlist=16)
+
+    def test_exhaustive_search(self):
+        expected, expected_scores = nearest_neighbors(self.vectors[:50], self.vectors, k=2)
+        indices, scores = self.index.search(self.vectors, self.vectors[:50], k=2, nprobe=16, query_block=7)
+        self.assertTrue(np.allclose(expected_scores, scores, atol=1e-5))
+        self.assertEqual(sorted(range(400)), sorted(self.index.ids.tolist()))
+
+    def test_save_load(self):
+        index_dir = tempfile.mkdtemp()
+        try:
+            self.index.save(os.path.join(index_dir, "index"))
+            loaded = IVFIndex.load(os.path.join(index_dir, "index"))
+            self.assertTrue(np.array_equal(self.index.search(self.vectors, self.vectors, nprobe=2)[0],
+                                           loaded.search(self.vectors, self.vectors, nprobe=2)[0]))
+        finally:
+            shutil.rmtree(index_dir)
+
+    def test_recall_report(self):
+        report = recall_report(self.index, self.vectors, nprobes=[1, 16], sample_size=100)
+        self.assertEqual([None, 1, 16], [row["nprobe"] for row in report])
+        self.assertLessEqual(report[1]["recall"], report[2]["recall"])
+        self.assertEqual(1.0, report[2]["recall"])
+
+    def test_approximate_ranker(self):
+        lines = SyntheticCorpus(300, vocab_size=50, seed=2).lines
+        exact = SimCSERanker(lines, "length", cache_dir=None, model=StubEncoder(dim=16))
+        approximate = SimCSERanker(lines, "length", cache_dir=None, model=StubEncoder(dim=16),
+                                   approximate=True, nlist=8, nprobe=8)
+        self.assertEqual(list(exact.rank(lines)), list(approximate.rank(lines)))
+        # probing a quarter of the lists finds most neighbors, and keeps the top of the ranking
+        approximate = SimCSERanker(lines, "length", cache_dir=None, model=StubEncoder(dim=16),
+                                   approximate=True, nlist=16, nprobe=4)
+        report = recall_report(approximate.index, approximate.embeddings, nprobes=[4], sample_size=300)
+        self.assertGreaterEqual(report[1]["recall"], 0.95)
+        top = set(list(exact.rank(lines))[:150]) & set(list(approximate.rank(lines))[:150])
+        self.assertGreaterEqual(len(top), 140)
+
+    def test_custom_model_is_not_cached(self):
+        # the embeddings of a stand-in model must not be cached under the name of the real one
+        self.assertRaises(ValueError, SimCSERanker, ["a line"], "length", model=StubEncoder(dim=16))
+
 
 class TestSimCSERankerBudget(unittest.TestCase):
 
@@ -122,6 +884,59 @@ class TestSimCSERankerBudget(unittest.TestCase):
         ranking = ranker.rank(self.mitt)
         self.assertEqual(ranking, [4, 0, 2, 1, 3])
 
+    def test_rank_duplicates(self):
+        sents = self.mitt + [self.mitt[1], self.mitt[4]]
+        ranker = SimCSERanker(sents, "length", "princeton-nlp/sup-simcse-bert-base-uncased")
+        ranking = ranker.rank(sents)
+        self.assertEqual(list(range(len(sents))), sorted(ranking))
+        self.assertEqual({4, 6}, set(ranking[:2]))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_delfy_metrics(self):
+        sents = [['a', 'a', 'b'], ['b', 'c'], ['a', 'd', 'd', 'b'], ['c', 'c', 'e'], ['e', 'a']]
+        for backend in ["python", "numpy"]:
+            metrics = profiling.Metrics()
+            expected = run_delfy(sents, 0.4, "sentence", 2, backend)
+            self.assertEqual(expected, run_delfy(sents, 0.4, "sentence", 2, backend, metrics=metrics))
+            self.assertEqual([1, 2], [report["round"] for report in metrics.rounds])
+            self.assertEqual(2, metrics.phases["delfy.scoring"]["calls"])
+            self.assertEqual(5 + 4, metrics.counters["delfy.sentences_scored"])
+            self.assertIsInstance(profiling.current(), profiling.NullMetrics)
+            self.assertNotIsInstance(profiling.current(), profiling.Metrics)
+
+    def test_use(self):
+        metrics = profiling.Metrics()
+        previous = profiling.use(metrics)
+        try:
+            with profiling.phase("outer"):
+                with profiling.phase("inner"):
+                    profiling.count("things", 3)
+        finally:
+            profiling.use(previous)
+        profiling.count("things")
+        report = metrics.report()
+        self.assertEqual({"things": 3}, report["counters"])
+        self.assertEqual(["inner", "outer"], list(report["phases"]))
+        self.assertGreaterEqual(report["phases"]["outer"]["seconds"], report["phases"]["inner"]["seconds"])
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_synthetic_corpus(self):
+        corpus = SyntheticCorpus(50, vocab_size=100, seed=1)
+        self.assertEqual(50, len(corpus.lines))
+        self.assertEqual(corpus.tokens.lengths().tolist(), [len(line.split()) for line in corpus.lines])
+        embeddings = StubEncoder(dim=8).encode(corpus.lines)
+        self.assertTrue(np.allclose(1.0, np.linalg.norm(embeddings, axis=1)))
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(["weighted_sample", "delfy-python"], [20, 100001], repeat=1, memory=False)
+        self.assertEqual(4, len(results))
+        self.assertIn("seconds", results[0])
+        self.assertIn("skipped", results[3])
+
 
 if __name__ == "__main__":
     unittest.main()   